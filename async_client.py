@@ -0,0 +1,171 @@
+'''
+Asyncio interface to the pub/sub middleware in middleware.py
+
+AsyncClient wraps a Client, so it speaks the same protocol over the same single set of
+connections to the broker: one I/O thread per AsyncClient answers heartbeats and moves every
+message, however many topics are registered. Requests return awaitables instead of blocking,
+and subscribe() returns an async iterator. Many iterators can run concurrently, one per topic,
+each woken only when a message of its topic arrives.
+
+Usage:
+    client = await AsyncClient.create(req_addr='tcp://localhost:7777', sub_addr='tcp://localhost:7778')
+    await client.register_pub('topic1', 1, 0)
+    await client.publish('topic1', 'hello')
+
+    async for msg in client.subscribe('topic2'):
+        ...
+'''
+
+import asyncio
+
+from middleware import Client, MSG_DISCONNECT, topic_envelope, gather_futures
+from topic_trie import is_pattern
+
+
+class AsyncClient:
+    '''
+    client: The Client to wrap (see create())
+    loop: Event loop the AsyncClient is used from
+    '''
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+
+        # asyncio.Event per topic envelope, set when a message of the topic is queued, plus one (under None)
+        # set for messages of any topic. Waiters clear their event, look at the queues, then wait on it
+        self.events = {}
+
+        # Envelopes whose events are already being set on the loop, so the I/O thread calls into the loop
+        # once per burst of messages rather than once per message
+        self.signalled = set()
+        client.publication_listener = self.publication_queued
+
+    '''
+    Function that creates a Client without blocking the event loop and wraps it
+    Returns the AsyncClient once the Client is registered with the broker, so requests made from the loop
+    never wait for the registration. Takes the arguments of Client
+    '''
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        client = await loop.run_in_executor(None, lambda: Client(*args, **kwargs))
+        await asyncio.wrap_future(gather_futures(client.registrations))
+        return cls(client, loop)
+
+    async def close(self):
+        await self.loop.run_in_executor(None, self.client.close)
+
+    async def register_pub(self, topic, ownership_strength=0, history=0, compression=None, dictionary=None):
+        return await asyncio.wrap_future(self.client.send_register_pub(topic, ownership_strength, history,
+                                                                       compression, dictionary))
+
+    async def unregister_pub(self, topic):
+        return await asyncio.wrap_future(self.client.send_request(MSG_DISCONNECT, self.client.topic_ids.get(topic, 0),
+                                                                  shard=self.client.topic_shard(topic)))
+
+    '''
+    Function that publishes content on a topic
+    With block set, waits for the broker's response and returns it. Otherwise the content is batched
+    as by Client.publish(block=False), and an awaitable acknowledgement is returned if batch_acks is set
+    '''
+    async def publish(self, topic, content, block=True):
+        if block:
+            return await asyncio.wrap_future(self.client.send_publish(topic, content))
+        future = self.client.publish(topic, content, block=False)
+        return None if future is None else asyncio.wrap_future(future)
+
+    async def publish_many(self, topic, contents):
+        return await asyncio.wrap_future(self.client.publish_many(topic, contents, ack=True))
+
+    async def register_sub(self, topic, history=0):
+        return await asyncio.wrap_future(self.client.send_register_sub(topic, history))
+
+    async def register_many(self, registrations):
+        return await asyncio.wrap_future(self.client.send_register_many(registrations))
+
+    async def replay(self, topic, from_seq):
+        return await asyncio.wrap_future(self.client.send_replay(topic, from_seq))
+
+    async def shutdown_broker(self):
+        return await self.loop.run_in_executor(None, self.client.shutdown_broker)
+
+    '''
+    Function that waits for the next message of a topic
+    Returns the message, or None once the client was disconnected as a slow consumer
+    '''
+    async def notify(self, topic):
+        result = await self.poll([topic])
+        return None if result is None else result[1]
+
+    '''
+    Function that waits for the oldest received message of any of the given topics
+    Returns the tuple (topic, msg), or None once the client was disconnected as a slow consumer
+    topics: Topics to wait for (default None, any subscribed topic)
+    '''
+    async def poll(self, topics=None):
+        keys = [None] if topics is None else [topic_envelope(topic) for topic in topics]
+        events = [self.event(key) for key in keys]
+        while True:
+            for event in events:
+                event.clear()
+            result = self.client.poll_nowait(topics)
+            if result is not None:
+                return result
+            if self.client.sub_drops['disconnected']:
+                return None
+            if len(events) == 1:
+                await events[0].wait()
+            else:
+                waiters = [asyncio.ensure_future(event.wait()) for event in events]
+                done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in pending:
+                    waiter.cancel()
+
+    '''
+    Function that registers a subscriber and iterates over the messages of its topic
+    history: Messages of history to receive first (see Client.register_sub())
+    Iteration ends if the client is disconnected as a slow consumer. Run one iterator per topic: iterators
+    of the same topic share its messages. Iterators of a wildcard topic yield (topic, msg)
+    '''
+    async def subscribe(self, topic, history=0):
+        wildcard = is_pattern(topic)
+        for item in await self.register_sub(topic, history) or []:
+            yield item
+        while True:
+            result = await self.poll([topic])
+            if result is None:
+                return
+            yield result if wildcard else result[1]
+
+    '''
+    Function that returns the event of a topic envelope (None for any topic), creating it on first use
+    '''
+    def event(self, key):
+        event = self.events.get(key)
+        if event is None:
+            event = self.events[key] = asyncio.Event()
+        return event
+
+    '''
+    Function that the Client's I/O thread calls when it queues a message (None when it dropped the queues)
+    '''
+    def publication_queued(self, envelope):
+        if envelope not in self.signalled:
+            self.signalled.add(envelope)
+            self.loop.call_soon_threadsafe(self.wake, envelope)
+
+    '''
+    Function that wakes the waiters of a topic envelope and the waiters for any topic. Runs on the event loop
+    '''
+    def wake(self, envelope):
+        self.signalled.discard(envelope)
+        if envelope is None:
+            for event in self.events.values():
+                event.set()
+            return
+        event = self.events.get(envelope)
+        if event is not None:
+            event.set()
+        event = self.events.get(None)
+        if event is not None:
+            event.set()
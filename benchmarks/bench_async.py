@@ -0,0 +1,77 @@
+'''
+Measures one process hosting many publishers and subscribers with AsyncClient.
+One AsyncClient publishes on N topics and another runs one subscribe() iterator per topic, all
+in a single event loop. Reports delivered messages/sec and the number of threads the process
+uses (which does not grow with the number of topics).
+
+Usage: python3 benchmarks/bench_async.py [messages_per_topic] [topic_counts...]
+'''
+
+import os
+import sys
+import time
+import asyncio
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from middleware import Broker
+from async_client import AsyncClient
+
+broker_rep_address = "tcp://127.0.0.1:7777"
+broker_pub_address = "tcp://127.0.0.1:7778"
+
+
+def run_broker():
+    broker = Broker(pub_addr=broker_pub_address, rep_addr=broker_rep_address)
+    broker.run()
+
+
+async def measure(num_topics, count):
+    publisher = await AsyncClient.create(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-apub')
+    subscriber = await AsyncClient.create(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-asub')
+    topics = ['bench-%d-%d' % (num_topics, i) for i in range(num_topics)]
+    await asyncio.gather(*[publisher.register_pub(topic) for topic in topics])
+
+    async def consume(topic):
+        received = 0
+        async for msg in subscriber.subscribe(topic):
+            received += 1
+            if received == count:
+                return received
+
+    consumers = [asyncio.ensure_future(consume(topic)) for topic in topics]
+    await asyncio.sleep(0.5)
+
+    start_time = time.time()
+    for i in range(count):
+        await asyncio.gather(*[publisher.publish(topic, i) for topic in topics])
+    received = sum(await asyncio.gather(*consumers))
+    elapsed = time.time() - start_time
+    threads = threading.active_count()
+
+    await publisher.close()
+    await subscriber.close()
+    return received / elapsed, threads
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    topic_counts = [int(n) for n in sys.argv[2:]] or [10, 100, 500]
+
+    broker = multiprocessing.Process(target=run_broker)
+    broker.start()
+    time.sleep(0.5)
+
+    print('topics  messages/sec  threads')
+    for num_topics in topic_counts:
+        rate, threads = asyncio.run(measure(num_topics, count))
+        print('%6d  %12.0f  %7d' % (num_topics, rate, threads))
+
+    async def shutdown():
+        admin = await AsyncClient.create(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-admin')
+        await admin.shutdown_broker()
+        await admin.close()
+    asyncio.run(shutdown())
+    broker.join()
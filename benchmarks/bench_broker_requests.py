@@ -0,0 +1,89 @@
+'''
+Measures broker requests/sec versus the number of concurrent Client instances.
+Every client process registers one publisher and then calls publish() in a loop for a fixed duration.
+
+With a pipeline depth > 1 each client keeps that many publish requests in flight
+(needs Client.send_publish, so older revisions only support a depth of 1).
+
+Usage: python3 benchmarks/bench_broker_requests.py [duration_sec] [pipeline_depth] [client_counts...]
+'''
+
+import os
+import sys
+import time
+import collections
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from middleware import Broker, Client
+
+broker_rep_address = "tcp://127.0.0.1:7777"
+broker_pub_address = "tcp://127.0.0.1:7778"
+
+
+def run_broker():
+    # The broker prints every request, keep that out of the results
+    sys.stdout = open(os.devnull, 'w')
+    broker = Broker(pub_addr=broker_pub_address, rep_addr=broker_rep_address)
+    broker.run()
+
+
+def run_client(index, start_event, duration, depth, results):
+    sys.stdout = open(os.devnull, 'w')
+    client = Client(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-%d' % index)
+    topic = 'bench-topic-%d' % index
+    client.register_pub(topic, 0, 1)
+
+    start_event.wait()
+    count = 0
+    end_time = time.time() + duration
+    if depth == 1:
+        while time.time() < end_time:
+            client.publish(topic, count)
+            count += 1
+    else:
+        in_flight = collections.deque()
+        while time.time() < end_time:
+            while len(in_flight) < depth:
+                in_flight.append(client.send_publish(topic, count))
+            in_flight.popleft().result()
+            count += 1
+        for future in in_flight:
+            future.result()
+    results.put(count)
+
+
+def measure(num_clients, duration, depth):
+    start_event = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=run_client, args=(i, start_event, duration, depth, results))
+               for i in range(num_clients)]
+    for proc in clients:
+        proc.start()
+
+    # Give every client time to connect and register before the clock starts
+    time.sleep(0.5 + 0.05 * num_clients)
+    start_event.set()
+    total = sum(results.get() for _ in clients)
+    for proc in clients:
+        proc.join()
+    return total / duration
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    client_counts = [int(n) for n in sys.argv[3:]] or [1, 2, 4, 8, 16]
+
+    broker = multiprocessing.Process(target=run_broker)
+    broker.start()
+    time.sleep(0.5)
+
+    print('clients  requests/sec')
+    for num_clients in client_counts:
+        print('%7d  %12.0f' % (num_clients, measure(num_clients, duration, depth)))
+
+    sys.stdout = open(os.devnull, 'w')
+    Client(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-admin').shutdown_broker()
+    broker.join()
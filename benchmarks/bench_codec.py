@@ -0,0 +1,73 @@
+'''
+Micro-benchmark of the wire format for one publication, comparing the old pickle path
+(a pickled request dict for client -> broker, a topic string plus pickled content for broker -> subscriber)
+with the codec path (fixed binary header plus a content frame).
+
+Reports bytes per message and encode/decode ns per message for a few typical contents.
+
+Usage: python3 benchmarks/bench_codec.py [iterations]
+'''
+
+import os
+import sys
+import time
+import pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from codec import *
+
+
+contents = {'int': 12345,
+            'str100': 'x' * 100,
+            'reading': {'sensor': 'floor3/room12/temp', 'value': 21.5, 'ts': 1700000000.123},
+            'bytes1k': b'\x01' * 1024}
+
+
+def pickle_encode(content):
+    request = pickle.dumps({'type': 'pub', 'addr': '10.0.0.2', 'topic': 'topic1', 'content': content, 'id': 7})
+    return [request], ['topic1'.encode(), pickle.dumps(content)]
+
+
+def pickle_decode(request_frames, fanout_frames):
+    pickle.loads(request_frames[0])
+    fanout_frames[0].decode()
+    return pickle.loads(fanout_frames[1])
+
+
+def codec_encode(content):
+    codec, frame = encode_content(content)
+    request = [encode_header(MSG_PUB, FLAG_ACK, codec, 1, 2, 7), frame]
+    return request, [b'topic1', encode_header(MSG_PUB, 0, codec, 1), frame]
+
+
+def codec_decode(request_frames, fanout_frames):
+    decode_header(request_frames[0])
+    fanout_frames[0].decode()
+    codec = decode_header(fanout_frames[1])[2]
+    return decode_content(codec, fanout_frames[2])
+
+
+def measure(encode, decode, content, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        request_frames, fanout_frames = encode(content)
+    encode_ns = (time.perf_counter() - start) * 1e9 / iterations
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decode(request_frames, fanout_frames)
+    decode_ns = (time.perf_counter() - start) * 1e9 / iterations
+
+    size = sum(len(frame) for frame in request_frames + fanout_frames)
+    return size, encode_ns, decode_ns
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('content codec: %s' % ('msgpack' if default_content_codec == CODEC_MSGPACK else 'json'))
+    print('%-8s %-6s %14s %10s %10s' % ('content', 'path', 'bytes/msg', 'enc ns', 'dec ns'))
+    for name, content in contents.items():
+        for path, encode, decode in (('pickle', pickle_encode, pickle_decode), ('codec', codec_encode, codec_decode)):
+            size, encode_ns, decode_ns = measure(encode, decode, content, iterations)
+            print('%-8s %-6s %14d %10.0f %10.0f' % (name, path, size, encode_ns, decode_ns))
@@ -0,0 +1,63 @@
+'''
+Measures the broker's client expiry cost as the number of registered clients grows.
+Clients are registered directly through the broker's handlers (no sockets per client), then the
+broker's expiry is driven through simulated time while every client keeps sending traffic,
+and finally while all of them go silent and are evicted.
+
+Usage: python3 benchmarks/bench_expiry.py [client_counts...]
+'''
+
+import io
+import os
+import sys
+import time
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from middleware import Broker, expiry_tick_ms
+
+broker_rep_address = "tcp://127.0.0.1:7777"
+broker_pub_address = "tcp://127.0.0.1:7778"
+
+
+def measure(num_clients):
+    broker = Broker(pub_addr=broker_pub_address, rep_addr=broker_rep_address)
+    now = time.time()
+    for i in range(num_clients):
+        addr = 'client-%d' % i
+        broker.handle_client_reg({'addr': addr})
+        broker.handle_pub_reg({'addr': addr, 'topic': 'topic-%d' % (i % 100), 'ownStr': i % 7, 'history_cnt': 0})
+
+    # Ten seconds of live clients: every client refreshes once per simulated second
+    ticks = int(10 * 1000 / expiry_tick_ms)
+    tick_time = 0
+    for tick in range(ticks):
+        now += expiry_tick_ms / 1000
+        if tick % (1000 // expiry_tick_ms) == 0:
+            for addr in broker.hb_dict:
+                broker.refresh_client(addr, now)
+        start = time.perf_counter()
+        broker.expire_clients(now)
+        tick_time += time.perf_counter() - start
+
+    # All clients go silent and get evicted
+    start = time.perf_counter()
+    while broker.hb_dict:
+        now += expiry_tick_ms / 1000
+        broker.expire_clients(now)
+    evict_time = time.perf_counter() - start
+    broker.stop_listening()
+    return tick_time * 1e6 / ticks, evict_time * 1e6 / num_clients
+
+
+if __name__ == '__main__':
+    client_counts = [int(n) for n in sys.argv[1:]] or [1000, 10000, 50000]
+
+    # Live clients are rescheduled once per timeout, so the cost per client should stay flat
+    print('clients  us/tick (live)  ns/client/sec  us/eviction')
+    for num_clients in client_counts:
+        with contextlib.redirect_stdout(io.StringIO()):
+            per_tick, per_eviction = measure(num_clients)
+        per_client = per_tick * 1000 * (1000 / expiry_tick_ms) / num_clients
+        print('%7d %15.1f %14.1f %12.2f' % (num_clients, per_tick, per_client, per_eviction))
@@ -0,0 +1,99 @@
+'''
+Measures broker failover with two local broker processes, a primary and its standby.
+A publisher publishes with acknowledgement in a loop while a subscriber receives. After a while
+the primary is killed with SIGKILL. Reports the publish latency with the standby attached, the
+longest time the publisher went without an acknowledgement (the failover time), and how many
+acknowledged messages the subscriber never received (should be 0) or received twice.
+
+Usage: python3 benchmarks/bench_failover.py [seconds_before_kill] [seconds_after_kill]
+'''
+
+import os
+import sys
+import time
+import signal
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from middleware import Broker, Client, heartbeat_interval_ms
+
+primary_addrs = {'rep_addr': "tcp://127.0.0.1:7777", 'pub_addr': "tcp://127.0.0.1:7778",
+                 'replica_addr': "tcp://127.0.0.1:7779"}
+standby_addrs = {'rep_addr': "tcp://127.0.0.1:7787", 'pub_addr': "tcp://127.0.0.1:7788",
+                 'replica_addr': "tcp://127.0.0.1:7789"}
+client_addrs = {'req_addr': primary_addrs['rep_addr'], 'sub_addr': primary_addrs['pub_addr'],
+                'standby_req_addr': standby_addrs['rep_addr'], 'standby_sub_addr': standby_addrs['pub_addr']}
+
+
+def run_primary():
+    Broker(**primary_addrs).run()
+
+
+def run_standby():
+    Broker(primary_addr=primary_addrs['replica_addr'], **standby_addrs).run()
+
+
+def run_subscriber(ready, results):
+    subscriber = Client(ip='bench-sub', **client_addrs)
+    subscriber.register_sub('failover')
+    ready.set()
+    received = []
+    while True:
+        msg = subscriber.notify('failover', timeout_ms=5 * heartbeat_interval_ms)
+        if msg is None:
+            break
+        received.append(msg)
+    results.put(received)
+    subscriber.close()
+
+
+if __name__ == '__main__':
+    before_kill = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    after_kill = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    primary = multiprocessing.Process(target=run_primary)
+    standby = multiprocessing.Process(target=run_standby)
+    primary.start()
+    standby.start()
+    time.sleep(1)
+
+    ready = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    subscriber = multiprocessing.Process(target=run_subscriber, args=(ready, results))
+    subscriber.start()
+    ready.wait()
+
+    publisher = Client(ip='bench-pub', **client_addrs)
+    publisher.register_pub('failover')
+    acked = []
+    latencies = []
+    longest_gap = 0
+    kill_time = None
+    start_time = last_ack = time.time()
+    while kill_time is None or time.time() - kill_time < after_kill:
+        if kill_time is None and time.time() - start_time >= before_kill:
+            os.kill(primary.pid, signal.SIGKILL)
+            kill_time = time.time()
+        sent = time.time()
+        if publisher.publish('failover', len(acked))['result']:
+            now = time.time()
+            if kill_time is None:
+                latencies.append(now - sent)
+            longest_gap = max(longest_gap, now - last_ack)
+            last_ack = now
+            acked.append(len(acked))
+
+    received = results.get()
+    subscriber.join()
+    publisher.shutdown_broker()
+    standby.join()
+    publisher.close()
+
+    latencies.sort()
+    print('publish latency with standby: p50 %.0f us, p99 %.0f us' % (latencies[len(latencies) // 2] * 1e6,
+                                                                     latencies[int(len(latencies) * 0.99)] * 1e6))
+    print('failover: longest wait for an acknowledgement %.2f s (heartbeat interval %.1f s)'
+          % (longest_gap, heartbeat_interval_ms / 1000))
+    print('acknowledged %d, received %d, acknowledged but lost %d, received twice %d'
+          % (len(acked), len(received), len(set(acked) - set(received)), len(received) - len(set(received))))
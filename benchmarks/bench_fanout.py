@@ -0,0 +1,95 @@
+'''
+Measures broker CPU time per published message for different payload sizes.
+One publisher sends raw bytes payloads through the broker to one subscriber, and the broker's
+CPU time (from /proc, so Linux only) is divided by the number of messages delivered.
+Both the broker's Python thread and the whole process (including the zmq I/O threads that move
+the bytes through the kernel) are reported.
+
+Usage: python3 benchmarks/bench_fanout.py [messages_per_size]
+'''
+
+import os
+import sys
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from middleware import Broker, Client
+
+broker_rep_address = "tcp://127.0.0.1:7777"
+broker_pub_address = "tcp://127.0.0.1:7778"
+
+payload_sizes = [1024, 64 * 1024, 1024 * 1024]
+
+
+def run_broker():
+    sys.stdout = open(os.devnull, 'w')
+    broker = Broker(pub_addr=broker_pub_address, rep_addr=broker_rep_address)
+    broker.run()
+
+
+def run_subscriber(topic, count, ready, results):
+    sys.stdout = open(os.devnull, 'w')
+    client = Client(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-sub-' + topic)
+    client.register_sub(topic)
+    ready.set()
+    received = 0
+    while received < count and client.notify(topic, 0, timeout_ms=10000) is not None:
+        received += 1
+    results.put(received)
+
+
+def cpu_seconds(pid, thread=False):
+    # utime and stime are fields 14 and 15 of /proc/<pid>/stat, in clock ticks.
+    # The main thread's own task entry has the same id as the process
+    path = '/proc/%d/task/%d/stat' % (pid, pid) if thread else '/proc/%d/stat' % pid
+    with open(path) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    broker = multiprocessing.Process(target=run_broker)
+    broker.start()
+    time.sleep(0.5)
+
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    publisher = Client(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-pub')
+    sys.stdout = real_stdout
+
+    print('payload   msgs  thread us/msg  process us/msg    msgs/sec')
+    for size in payload_sizes:
+        topic = 'size-%d' % size
+        sys.stdout = open(os.devnull, 'w')
+        publisher.register_pub(topic)
+        sys.stdout = real_stdout
+
+        ready = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        subscriber = multiprocessing.Process(target=run_subscriber, args=(topic, count, ready, results))
+        subscriber.start()
+        ready.wait()
+        time.sleep(0.5)
+
+        payload = os.urandom(size)
+        cpu_start = cpu_seconds(broker.pid)
+        thread_start = cpu_seconds(broker.pid, thread=True)
+        start = time.time()
+        for _ in range(count):
+            publisher.publish(topic, payload)
+        received = results.get()
+        elapsed = time.time() - start
+        cpu_used = cpu_seconds(broker.pid) - cpu_start
+        thread_used = cpu_seconds(broker.pid, thread=True) - thread_start
+        subscriber.join()
+
+        received_count = max(received, 1)
+        print('%7d %6d %14.1f %15.1f %11.0f' % (size, received, thread_used * 1e6 / received_count,
+                                                cpu_used * 1e6 / received_count, received / elapsed))
+
+    sys.stdout = open(os.devnull, 'w')
+    publisher.shutdown_broker()
+    broker.join()
@@ -0,0 +1,94 @@
+'''
+Measures the memory used per retained history message, comparing the old per-publisher
+deques of (codec, zmq.Frame) with the broker's HistoryStore, for several payload sizes.
+Messages are received over an inproc socket pair so that they are real zmq.Frames, as in the broker.
+Memory is the growth of the process RSS (from /proc/self/statm, so Linux only) while the
+messages are retained, each measurement in a fresh process. Also reports the cost of appending under eviction once the budget is full.
+
+Usage: python3 benchmarks/bench_history.py [messages_per_size] [payload_sizes...]
+'''
+
+import os
+import sys
+import time
+import collections
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import zmq
+from history import HistoryStore
+
+num_topics = 100
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def receive_frames(count, size):
+    context = zmq.Context.instance()
+    sender = context.socket(zmq.PAIR)
+    receiver = context.socket(zmq.PAIR)
+    sender.bind('inproc://bench-history')
+    receiver.connect('inproc://bench-history')
+    payload = os.urandom(size)
+    for _ in range(count):
+        sender.send(payload, copy=False)
+        yield receiver.recv(copy=False)
+    sender.close()
+    receiver.close()
+
+
+def measure_deques(count, size):
+    start = rss()
+    deques = [collections.deque(maxlen=count) for _ in range(num_topics)]
+    for i, frame in enumerate(receive_frames(count, size)):
+        deques[i % num_topics].append((2, frame))
+    return (rss() - start) / count
+
+
+def measure_store(count, size):
+    start = rss()
+    store = HistoryStore(1 << 40)
+    topics = ['topic-%d' % i for i in range(num_topics)]
+    for topic in topics:
+        store.set_capacity(topic, count)
+    for i, frame in enumerate(receive_frames(count, size)):
+        store.append(topics[i % num_topics], 2, [frame], i // num_topics + 1, 0.0)
+    return (rss() - start) / count
+
+
+'''
+Function that runs a measurement in a new process, so memory freed by earlier ones is not reused
+'''
+def in_process(function, *args):
+    with multiprocessing.Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def measure_eviction(count, size):
+    # Budget for a tenth of the messages, so nine in ten appends evict
+    store = HistoryStore(count * (size + 64) // 10)
+    topics = ['topic-%d' % i for i in range(num_topics)]
+    for topic in topics:
+        store.set_capacity(topic, count)
+    frames = list(receive_frames(count, size))
+    start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        store.append(topics[i % num_topics], 2, [frame], i // num_topics + 1, 0.0)
+    elapsed = time.perf_counter() - start
+    return elapsed / count * 1e9, store.evictions
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    sizes = [int(n) for n in sys.argv[2:]] or [16, 100, 1000, 8192]
+
+    print('payload  deque bytes/msg  store bytes/msg  append ns/msg (evicting)')
+    for size in sizes:
+        deque_bytes = in_process(measure_deques, count, size)
+        store_bytes = in_process(measure_store, count, size)
+        append_ns, evictions = in_process(measure_eviction, count, size)
+        print('%7d  %15.0f  %15.0f  %8.0f (%d evicted)' % (size, deque_bytes, store_bytes, append_ns, evictions))
@@ -0,0 +1,195 @@
+'''
+Measures the transport of large and repetitive publications.
+
+Compression: bytes per message and encode+decode time per message for repetitive sensor payloads,
+small (one reading) and large (a block of readings), sent as is, compressed with zlib, and compressed
+with zlib and a dictionary of typical content (see codec.py).
+
+Head-of-line blocking: a subscriber receives, over an emulated slow link (a local relay forwarding at
+link_rate bytes per second), a stream of large raw messages on one topic and a small message published
+on another topic every few milliseconds. Reports the end-to-end latency of the small messages with the
+broker sending large messages whole, and in chunks paced below the link rate (Broker arguments
+chunk_bytes and chunk_rate_bytes).
+
+Usage: python3 benchmarks/bench_payloads.py [seconds] [large_message_bytes] [link_rate_bytes]
+'''
+
+import os
+import sys
+import time
+import struct
+import random
+import socket
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from middleware import Broker, Client, default_chunk_bytes
+from codec import encode_content, decode_content, compress_content, register_dictionary
+
+broker_rep_address = "tcp://127.0.0.1:7777"
+broker_pub_address = "tcp://127.0.0.1:7778"
+link_port = 7790
+
+# Time a small message was sent, at the start of its content
+SEND_TIME = struct.Struct('!Q')
+
+small_interval = 0.005
+
+# The large messages use this much of the link, and the chunks are paced to chunk_share of it
+large_share = 0.6
+chunk_share = 0.8
+
+
+'''
+Function that returns one sensor reading, like the ones published in bulk by the test nodes
+'''
+def reading(rng, index):
+    return {'sensor': 'building1/floor3/room%d/temperature' % (index % 40), 'unit': 'celsius',
+            'value': round(rng.uniform(18, 26), 2), 'time': 1700000000 + index, 'status': 'ok'}
+
+
+def measure_compression(rng):
+    dictionary = encode_content([reading(rng, index) for index in range(20)])[1]
+    dictionary_id = register_dictionary(dictionary)
+    payloads = {'small': [reading(rng, index) for index in range(2000)],
+                'large': [[reading(rng, index * 500 + offset) for offset in range(500)] for index in range(20)]}
+    print('payload  compression       bytes/msg  ratio  encode+decode us/msg')
+    for name, messages in payloads.items():
+        plain = sum(len(encode_content(message)[1]) for message in messages) / len(messages)
+        for label, compressor, dictionary in (('none', None, 0), ('zlib', 'zlib', 0), ('zlib+dictionary', 'zlib', dictionary_id)):
+            start = time.perf_counter()
+            size = 0
+            for message in messages:
+                codec, buf = encode_content(message)
+                if compressor is not None:
+                    codec, buf = compress_content(codec, buf, compressor, dictionary)
+                size += len(buf)
+                decode_content(codec, buf)
+            elapsed = (time.perf_counter() - start) / len(messages)
+            print('%-8s %-16s %10.0f  %5.1f  %20.1f' % (name, label, size / len(messages),
+                                                       plain / (size / len(messages)), elapsed * 1e6))
+
+
+def run_broker(chunk_bytes, chunk_rate_bytes):
+    sys.stdout = open(os.devnull, 'w')
+    Broker(pub_addr=broker_pub_address, rep_addr=broker_rep_address,
+           chunk_bytes=chunk_bytes, chunk_rate_bytes=chunk_rate_bytes).run()
+
+
+def run_large_publisher(size, rate, ready, stop):
+    client = Client(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-large')
+    client.register_pub('large')
+    payload = os.urandom(size)
+    ready.wait()
+    next_time = time.time()
+    while not stop.is_set():
+        client.publish_many('large', [payload])
+        next_time += size / rate
+        time.sleep(max(0, next_time - time.time()))
+    client.close()
+
+
+'''
+Function that emulates a slow link: forwards each connection made to link_port on to the broker's
+PUB socket, and the broker's data back at most rate bytes per second
+'''
+def run_link(rate):
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', link_port))
+    server.listen()
+
+    def forward(source, target, limit):
+        next_time = time.time()
+        while True:
+            data = source.recv(16 * 1024)
+            if not data:
+                break
+            target.sendall(data)
+            if limit:
+                next_time = max(next_time, time.time() - 0.01) + len(data) / limit
+                time.sleep(max(0, next_time - time.time()))
+        target.close()
+
+    while True:
+        downstream, _ = server.accept()
+        upstream = socket.create_connection(('127.0.0.1', int(broker_pub_address.rsplit(':', 1)[1])))
+        for socket_pair in ((downstream, upstream, 0), (upstream, downstream, rate)):
+            threading.Thread(target=forward, args=socket_pair, daemon=True).start()
+
+
+'''
+Function that runs one head-of-line measurement
+Returns the small messages' latencies in seconds, sorted, and the large messages received per second
+'''
+def measure_latency(seconds, size, link_rate, chunk_bytes, chunk_rate_bytes):
+    broker = multiprocessing.Process(target=run_broker, args=(chunk_bytes, chunk_rate_bytes))
+    broker.start()
+    link = multiprocessing.Process(target=run_link, args=(link_rate,), daemon=True)
+    link.start()
+    time.sleep(0.5)
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    large = multiprocessing.Process(target=run_large_publisher, args=(size, link_rate * large_share, ready, stop))
+    large.start()
+
+    subscriber = Client(req_addr=broker_rep_address, sub_addr='tcp://127.0.0.1:%d' % link_port, ip='bench-sub')
+    subscriber.register_sub('large')
+    subscriber.register_sub('small')
+    publisher = Client(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-small')
+    publisher.register_pub('small')
+    time.sleep(0.5)
+    ready.set()
+
+    def publish_small():
+        while not stop.is_set():
+            publisher.publish('small', SEND_TIME.pack(time.time_ns()))
+            time.sleep(small_interval)
+
+    sender = threading.Thread(target=publish_small)
+    sender.start()
+    latencies = []
+    large_count = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        message = subscriber.poll(timeout_ms=100)
+        if message is None:
+            continue
+        if message[0] == 'small':
+            latencies.append((time.time_ns() - SEND_TIME.unpack_from(message[1])[0]) / 1e9)
+        else:
+            large_count += 1
+    stop.set()
+    sender.join()
+    large.join()
+    publisher.shutdown_broker()
+    broker.join()
+    link.terminate()
+    publisher.close()
+    subscriber.close()
+    latencies.sort()
+    return latencies, large_count / seconds
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024 * 1024
+    link_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 10e6
+
+    measure_compression(random.Random(1))
+
+    print()
+    print('%d byte messages streamed on one topic at %d%% of a %.0f MB/s link, small messages every %d ms on another'
+          % (size, large_share * 100, link_rate / 1e6, small_interval * 1000))
+    print('large messages sent          small p50 ms  small p99 ms  large msgs/s')
+    for label, chunk_bytes, chunk_rate_bytes in (('whole', size, 0),
+                                                 ('chunked, %.0f MB/s' % (link_rate * chunk_share / 1e6),
+                                                  default_chunk_bytes, int(link_rate * chunk_share))):
+        latencies, large_rate = measure_latency(seconds, size, link_rate, chunk_bytes, chunk_rate_bytes)
+        if not latencies:
+            print('%-28s no small messages received' % label)
+            continue
+        print('%-28s %12.1f  %12.1f  %12.1f' % (label, latencies[len(latencies) // 2] * 1000,
+                                                latencies[int(len(latencies) * 0.99)] * 1000, large_rate))
@@ -0,0 +1,58 @@
+'''
+Measures the durable history log (segment_log.py) with 1M retained messages on one topic:
+append throughput (with the broker's batched fsync), time to recover the log when a broker
+starts, and replay latency for the last N messages.
+The log is written to a temporary directory, which is removed afterwards.
+
+Usage: python3 benchmarks/bench_segment_log.py [num_messages] [payload_bytes] [directory]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from codec import CODEC_RAW
+from segment_log import SegmentLog
+
+batch_size = 100
+
+
+if __name__ == '__main__':
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    payload_bytes = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    directory = tempfile.mkdtemp(dir=sys.argv[3] if len(sys.argv) > 3 else None)
+
+    try:
+        log = SegmentLog(directory)
+        log.set_capacity('bench', num_messages)
+        batch = [os.urandom(payload_bytes) for _ in range(batch_size)]
+
+        # Appends in batches, syncing whenever the broker loop would
+        start = time.perf_counter()
+        for first_seq in range(1, num_messages + 1, batch_size):
+            log.append('bench', CODEC_RAW, batch, first_seq, time.time())
+            log.sync(time.time())
+        log.close()
+        elapsed = time.perf_counter() - start
+        print('append:   %10.0f msgs/sec  %8.1f MB/sec' % (num_messages / elapsed,
+                                                           num_messages * payload_bytes / elapsed / 1e6))
+
+        start = time.perf_counter()
+        log = SegmentLog(directory)
+        print('recover:  %10.1f ms  (%d messages, %.1f MB on disk)' % ((time.perf_counter() - start) * 1000,
+                                                                     log.messages, log.bytes / 1e6))
+
+        for count in (1, 1000, 100000, num_messages):
+            start = time.perf_counter()
+            messages = log.get('bench', count)
+            elapsed = time.perf_counter() - start
+            assert len(messages) == count and len(messages[-1][2]) == payload_bytes
+            print('replay:   %10.3f ms  for the last %d messages' % (elapsed * 1000, count))
+        del messages
+        log.close()
+    finally:
+        shutil.rmtree(directory)
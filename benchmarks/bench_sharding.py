@@ -0,0 +1,88 @@
+'''
+Measures publish throughput of a sharded broker versus the number of shards.
+For every shard count a fresh ShardedBroker is started, and each client process publishes
+round-robin on its own set of topics (spread over the shards by the hash ring), keeping
+several publish requests in flight.
+
+Shards only add throughput when there are spare cores for them: on a machine with fewer
+cores than shards plus clients, the numbers show the overhead of sharding rather than its gain.
+
+Usage: python3 benchmarks/bench_sharding.py [duration_sec] [num_clients] [shard_counts...]
+'''
+
+import os
+import sys
+import time
+import collections
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from middleware import Client
+from sharding import ShardedBroker, shard_addresses
+
+topics_per_client = 16
+pipeline_depth = 16
+
+
+def run_client(index, rep_addrs, pub_addrs, start_event, duration, results):
+    sys.stdout = open(os.devnull, 'w')
+    client = Client(req_addr=rep_addrs, sub_addr=pub_addrs, ip='bench-%d' % index)
+    topics = ['bench-%d-%d' % (index, i) for i in range(topics_per_client)]
+    for topic in topics:
+        client.register_pub(topic, 0, 1)
+
+    start_event.wait()
+    count = 0
+    in_flight = collections.deque()
+    end_time = time.time() + duration
+    while time.time() < end_time:
+        while len(in_flight) < pipeline_depth:
+            in_flight.append(client.send_publish(topics[count % topics_per_client], count))
+            count += 1
+        in_flight.popleft().result()
+    for future in in_flight:
+        future.result()
+    client.close()
+    results.put(count)
+
+
+def measure(num_shards, num_clients, duration):
+    rep_addrs, pub_addrs = shard_addresses(num_shards, '127.0.0.1')
+    broker = ShardedBroker(num_shards, pub_addrs, rep_addrs)
+    # The broker prints every request, keep that out of the results (shard processes inherit stdout)
+    sys.stdout = open(os.devnull, 'w')
+    broker.start()
+    sys.stdout = sys.__stdout__
+    time.sleep(0.5)
+
+    start_event = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=run_client, args=(i, rep_addrs, pub_addrs, start_event, duration, results))
+               for i in range(num_clients)]
+    for proc in clients:
+        proc.start()
+
+    # Give every client time to connect and register before the clock starts
+    time.sleep(0.5 + 0.05 * num_clients)
+    start_event.set()
+    total = sum(results.get() for _ in clients)
+    for proc in clients:
+        proc.join()
+
+    sys.stdout = open(os.devnull, 'w')
+    Client(req_addr=rep_addrs, sub_addr=pub_addrs, ip='bench-admin').shutdown_broker()
+    sys.stdout = sys.__stdout__
+    broker.join()
+    return total / duration
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    num_clients = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    shard_counts = [int(n) for n in sys.argv[3:]] or [1, 2, 4]
+
+    print('cpus: %d, clients: %d' % (os.cpu_count(), num_clients))
+    print('shards  publishes/sec')
+    for num_shards in shard_counts:
+        print('%6d  %13.0f' % (num_shards, measure(num_shards, num_clients, duration)))
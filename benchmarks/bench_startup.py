@@ -0,0 +1,91 @@
+'''
+Measures the cold start of a client process: the time from the start of a fresh Python process to
+its first acknowledged publication, for a client that registers as publisher and subscriber of many
+topics. Reports the time to import the middleware, create the Client, register every topic, and
+publish once. Registration is done with one register_pub()/register_sub() call per topic, or with
+one register_many() call (mode "many"). The "each" mode only uses calls that older revisions have,
+so the script can be run against them to compare before and after.
+
+Usage: python3 benchmarks/bench_startup.py [num_topics] [each|many|both]
+'''
+
+import os
+import sys
+import json
+import time
+import subprocess
+import multiprocessing
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo_dir)
+
+broker_rep_address = "tcp://127.0.0.1:7777"
+broker_pub_address = "tcp://127.0.0.1:7778"
+
+# Run in a fresh interpreter, so the import is cold. Prints the phase times as JSON
+client_script = '''
+import sys, time, json
+start = time.time()
+sys.path.insert(0, %(repo_dir)r)
+from middleware import Client
+imported = time.time()
+client = Client(req_addr=%(rep)r, sub_addr=%(pub)r, ip='bench-startup')
+created = time.time()
+topics = ['startup/%%d' %% i for i in range(%(topics)d)]
+if %(many)r:
+    client.register_many([('pub', topic, 1, 1) for topic in topics] + [('sub', topic, 0) for topic in topics])
+else:
+    for topic in topics:
+        client.register_pub(topic, 1, 1)
+        client.register_sub(topic, 0)
+registered = time.time()
+result = client.publish(topics[0], b'first')['result']
+published = time.time()
+client.close()
+print(json.dumps({'import': imported - start, 'create': created - imported, 'register': registered - created,
+                  'publish': published - registered, 'result': result}))
+'''
+
+
+def run_broker():
+    sys.stdout = open(os.devnull, 'w')
+    from middleware import Broker
+    Broker(pub_addr=broker_pub_address, rep_addr=broker_rep_address).run()
+
+
+'''
+Function that starts a client process and returns its phase times, measured from the process's start
+'''
+def measure(num_topics, many):
+    script = client_script % {'repo_dir': repo_dir, 'rep': broker_rep_address, 'pub': broker_pub_address,
+                              'topics': num_topics, 'many': many}
+    start = time.time()
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    phases = json.loads(output.strip().splitlines()[-1])
+    phases['total'] = time.time() - start
+    return phases
+
+
+if __name__ == '__main__':
+    num_topics = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'both'
+
+    broker = multiprocessing.Process(target=run_broker)
+    broker.start()
+    time.sleep(0.5)
+
+    print('%d topics, publisher and subscriber of each' % num_topics)
+    print('registration        import ms  create ms  register ms  publish ms  total ms')
+    for many in ([False, True] if mode == 'both' else [mode == 'many']):
+        # The first run warms the broker and the file system cache, the second is reported
+        measure(num_topics, many)
+        phases = measure(num_topics, many)
+        print('%-18s %10.1f %10.1f %12.1f %11.1f %9.1f' % ('register_many' if many else 'one call per topic',
+                                                          *(phases[key] * 1000 for key in ('import', 'create', 'register',
+                                                                                          'publish', 'total'))))
+
+    from middleware import Client
+    client = Client(req_addr=broker_rep_address, sub_addr=broker_pub_address, ip='bench-shutdown')
+    client.shutdown_broker()
+    client.close()
+    broker.join()
@@ -0,0 +1,103 @@
+'''
+Measures the cost of matching topics against wildcard subscriptions, as the broker does for every
+topic it forwards (see topic_trie.py). Builds 100k distinct five-level topics and 10k distinct
+wildcard patterns over them, then reports the time to match each topic with the trie against a
+linear scan of every pattern, and how the trie's cost changes with the number of patterns.
+
+Usage: python3 benchmarks/bench_wildcards.py [num_topics] [num_patterns]
+'''
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from topic_trie import TopicTrie, topic_matches
+
+levels = ['region', 'building', 'floor', 'room', 'sensor']
+
+# Topics matched with a linear scan, which is too slow to run over all of them
+scan_sample = 500
+
+
+'''
+Function that returns num_topics distinct topics of the form region3/building1/floor7/room2/sensor5
+'''
+def make_topics(num_topics):
+    width = 1
+    while width ** len(levels) < num_topics:
+        width += 1
+    topics = []
+    for i in range(num_topics):
+        parts = []
+        for name in reversed(levels):
+            parts.append('%s%d' % (name, i % width))
+            i //= width
+        topics.append('/'.join(reversed(parts)))
+    return topics
+
+
+'''
+Function that returns num_patterns distinct patterns made from random topics, with some levels
+replaced by '+' and some ending early with '#'
+'''
+def make_patterns(topics, num_patterns, rng):
+    patterns = set()
+    while len(patterns) < num_patterns:
+        parts = rng.choice(topics).split('/')
+        for index in rng.sample(range(len(parts)), rng.randint(0, 2)):
+            parts[index] = '+'
+        if rng.random() < 0.3:
+            parts = parts[:rng.randint(1, len(parts) - 1)] + ['#']
+        pattern = '/'.join(parts)
+        if '+' in parts or '#' in parts:
+            patterns.add(pattern)
+    return sorted(patterns)
+
+
+'''
+Function that returns the time in microseconds to match each topic with the trie, and the matches found
+'''
+def measure_trie(trie, topics):
+    start = time.perf_counter()
+    matches = sum(len(trie.match(topic)) for topic in topics)
+    return (time.perf_counter() - start) / len(topics) * 1e6, matches
+
+
+def measure_scan(patterns, topics):
+    start = time.perf_counter()
+    matches = sum(1 for topic in topics for pattern in patterns if topic_matches(pattern, topic))
+    return (time.perf_counter() - start) / len(topics) * 1e6, matches
+
+
+if __name__ == '__main__':
+    num_topics = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_patterns = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    rng = random.Random(1)
+
+    topics = make_topics(num_topics)
+    patterns = make_patterns(topics, num_patterns, rng)
+
+    start = time.perf_counter()
+    trie = TopicTrie()
+    for pattern in patterns:
+        trie.add(pattern)
+    print('%d topics, %d patterns, trie built in %.0f ms' % (len(topics), trie.size, (time.perf_counter() - start) * 1000))
+
+    trie_us, matches = measure_trie(trie, topics)
+    sample = rng.sample(topics, scan_sample)
+    scan_us, scan_matches = measure_scan(patterns, sample)
+    sample_trie_us, sample_matches = measure_trie(trie, sample)
+    assert scan_matches == sample_matches
+    print('trie:  %8.2f us/topic  (%.2f matching patterns per topic)' % (trie_us, matches / len(topics)))
+    print('scan:  %8.2f us/topic  (%d topic sample, %.0fx slower)' % (scan_us, len(sample), scan_us / sample_trie_us))
+
+    print()
+    print('patterns  trie us/topic')
+    for count in (num_patterns // 100, num_patterns // 10, num_patterns):
+        subset = TopicTrie()
+        for pattern in patterns[::max(1, num_patterns // count)][:count]:
+            subset.add(pattern)
+        print('%8d  %13.2f' % (subset.size, measure_trie(subset, topics)[0]))
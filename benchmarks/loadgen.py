@@ -0,0 +1,366 @@
+'''
+Load generator and benchmark runner that runs without Mininet.
+Starts a Broker and one process per client node on localhost, over ipc:// or loopback TCP, and
+reports throughput, end-to-end latency and the broker's CPU time and memory as JSON lines that
+can be compared across commits.
+
+Workloads use the node.json command vocabulary of test.py (see tests/README.md), so a Mininet
+test case can be run as is with --scenario. A few additions are understood by this runner only:
+    ["p",<topic>,<content>,<count>]    publish count times (default 1)
+    ["n",<topic or null>,<value>,<count>]  receive count messages (default 1), null for any subscribed topic
+    ["s"]                              wait until every node reached its "s", then start the clock
+Every published payload starts with its send time, so subscribers can measure latency. Content
+is sent as its string form after the send time, padded to --payload bytes. "sb" commands are
+ignored: the runner shuts the broker down once every node is done.
+
+Without --scenario, one workload is generated for every combination of the swept values: each
+publisher registers on one topic (publisher i on topic i % topics, with strength i) and each
+subscriber on every topic. The strongest publisher of a topic owns it from its first message, and
+its messages are the ones forwarded.
+
+Usage:
+    python3 benchmarks/loadgen.py [--publishers 1,2] [--subscribers 1,4] [--topics 1] [--payload 64]
+                                  [--history 0] [--messages 2000] [--transport ipc|tcp] [--batch] [--direct]
+                                  [--rate 0] [--output results.jsonl]
+    python3 benchmarks/loadgen.py --scenario tests/test1 [--output results.jsonl]
+    python3 benchmarks/loadgen.py --compare old.jsonl new.jsonl
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import array
+import struct
+import argparse
+import itertools
+import subprocess
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from middleware import Broker, Client, heartbeat_interval_ms
+from metrics import query_metrics
+from bench_fanout import cpu_seconds
+
+# Send time at the start of every payload, in ns since the epoch
+SEND_TIME = struct.Struct('!Q')
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+'''
+Function that returns the broker's request, publication and metrics addresses, and a function that
+returns the data address of client node i (for direct publishing)
+transport: 'ipc' (sockets in a fresh temporary directory) or 'tcp' (loopback)
+'''
+def broker_addresses(transport):
+    if transport == 'ipc':
+        directory = tempfile.mkdtemp(prefix='loadgen-')
+        return (tuple('ipc://' + os.path.join(directory, name) for name in ('rep', 'pub', 'metrics')) +
+                (lambda i: 'ipc://' + os.path.join(directory, 'data-%d' % i),))
+    return 'tcp://127.0.0.1:7777', 'tcp://127.0.0.1:7778', 'tcp://127.0.0.1:9777', lambda i: 'tcp://127.0.0.1:%d' % (7800 + i)
+
+
+def run_broker(rep_addr, pub_addr, metrics_addr):
+    broker = Broker(pub_addr=pub_addr, rep_addr=rep_addr, metrics_addr=metrics_addr)
+    broker.run()
+
+
+'''
+Function that runs the commands of one client node. Target of each node process
+Puts (index, published, received, missed, latencies in us, finish time) on results
+'''
+def run_node(index, commands, rep_addr, pub_addr, data_addr, options, ready, start, results):
+    client = Client(req_addr=rep_addr, sub_addr=pub_addr, ip='loadgen-%d' % index, data_addr=data_addr)
+    padding = max(0, options['payload'] - SEND_TIME.size)
+    timeout_ms = options['timeout_ms']
+    published = received = missed = 0
+    latencies = array.array('q')
+
+    for command in commands:
+        if command[0] == 'rp':
+            strength = command[2] if len(command) >= 3 else 0
+            hist = command[3] if len(command) >= 4 else 0
+            client.register_pub(command[1], strength, hist)
+
+        elif command[0] == 'rs':
+            client.register_sub(command[1], history=command[2] if len(command) >= 3 else 0)
+
+        elif command[0] == 's':
+            ready.put(index)
+            start.wait()
+
+        elif command[0] == 'p':
+            topic = command[1]
+            body = str(command[2]).encode().ljust(padding, b'.')
+            count = command[3] if len(command) >= 4 else 1
+            # With a rate, messages are sent on a fixed schedule instead of as fast as possible
+            interval = 1 / options['rate'] if options['rate'] else 0
+            next_time = time.time()
+            for _ in range(count):
+                if interval:
+                    next_time += interval
+                    delay = next_time - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                client.publish(topic, SEND_TIME.pack(time.time_ns()) + body, block=not options['batch'])
+            client.flush()
+            published += count
+
+        elif command[0] == 'n':
+            topics = None if command[1] is None else [command[1]]
+            count = command[3] if len(command) >= 4 else 1
+            for done in range(count):
+                result = client.poll(topics, timeout_ms)
+                if result is None:
+                    # Nothing arrived in time, the rest is not coming either
+                    missed += count - done
+                    break
+                latencies.append((time.time_ns() - SEND_TIME.unpack_from(result[1])[0]) // 1000)
+                received += 1
+
+        elif command[0] == 'w':
+            if len(command) == 2:
+                time.sleep(command[1])
+
+    finish_time = time.time()
+    client.close()
+    results.put((index, published, received, missed, latencies.tobytes(), finish_time))
+
+
+'''
+Function that generates a workload in the node.json vocabulary
+Returns the list of client nodes, publishers first
+'''
+def make_workload(publishers, subscribers, topics, history, messages):
+    topic_names = ['load-%d' % i for i in range(topics)]
+    nodes = []
+    for i in range(publishers):
+        topic = topic_names[i % topics]
+        nodes.append({'middlewareType': 'client',
+                      'commands': [['rp', topic, i, history], ['s'], ['p', topic, i, messages]]})
+    # Every message of the strongest publisher of each topic is forwarded (it owns the topic from its first one)
+    expected = messages * min(topics, publishers)
+    for i in range(subscribers):
+        nodes.append({'middlewareType': 'client',
+                      'commands': [['rs', topic, history] for topic in topic_names] +
+                                  [['s'], ['n', None, 0, expected]]})
+    return nodes
+
+
+'''
+Function that loads a test case directory (see tests/README.md)
+Returns the list of client nodes and the test's MAX_RUNTIME
+'''
+def load_scenario(directory):
+    with open(os.path.join(directory, 'config.json')) as config_file:
+        config = json.load(config_file)
+    nodes = []
+    for number in range(1, config['NUM_NODES'] + 1):
+        with open(os.path.join(directory, 'node%d.json' % number)) as node_file:
+            node = json.load(node_file)
+        # The runner starts the broker itself
+        if node['middlewareType'] == 'client':
+            nodes.append(node)
+    return nodes, config['MAX_RUNTIME']
+
+
+'''
+Function that returns the resident and peak resident memory of a process in KB (Linux only)
+'''
+def memory_kb(pid):
+    sizes = {}
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                key, value = line.split(':')
+                sizes[key] = int(value.split()[0])
+    return sizes.get('VmRSS', 0), sizes.get('VmHWM', 0)
+
+
+'''
+Function that returns a percentile of sorted values, or None if there are none
+'''
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+'''
+Function that runs one workload against a fresh broker
+Returns the measurements as a dict
+nodes: Client nodes, as loaded from node.json files
+options: Runner options (payload, rate, batch, direct, timeout_ms, transport)
+max_runtime: Seconds to wait for the nodes before giving up
+'''
+def run_workload(nodes, options, max_runtime):
+    rep_addr, pub_addr, metrics_addr, data_addr = broker_addresses(options['transport'])
+    broker = multiprocessing.Process(target=run_broker, args=(rep_addr, pub_addr, metrics_addr))
+    broker.start()
+    time.sleep(0.5)
+
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    start = multiprocessing.Event()
+    procs = [multiprocessing.Process(target=run_node,
+                                     args=(i, node['commands'], rep_addr, pub_addr,
+                                           data_addr(i) if options['direct'] else None, options, ready, start, results))
+             for i, node in enumerate(nodes)]
+    for proc in procs:
+        proc.start()
+
+    # Start the clock once every node that waits for it has finished its setup
+    waiting = sum(1 for node in nodes if ['s'] in node['commands'])
+    for _ in range(waiting):
+        ready.get(timeout=max_runtime)
+    # Subscribers connect to a direct publisher once the broker announces it, within one heartbeat
+    if options['direct']:
+        time.sleep(heartbeat_interval_ms / 1000 + 0.5)
+    start_cpu = cpu_seconds(broker.pid)
+    start_time = time.time()
+    start.set()
+
+    node_results = []
+    try:
+        for _ in procs:
+            node_results.append(results.get(timeout=max_runtime))
+    except queue.Empty:
+        print('%d of %d nodes did not finish within %d s' % (len(procs) - len(node_results), len(procs), max_runtime),
+              file=sys.stderr)
+    end_time = max([result[5] for result in node_results] or [time.time()])
+    broker_cpu = cpu_seconds(broker.pid) - start_cpu
+    rss_kb, peak_rss_kb = memory_kb(broker.pid)
+    broker_metrics = query_metrics(metrics_addr)
+
+    for proc in procs:
+        proc.join(1)
+        if proc.is_alive():
+            proc.terminate()
+    Client(req_addr=rep_addr, sub_addr=pub_addr, ip='loadgen-admin').shutdown_broker()
+    broker.join()
+
+    latencies = array.array('q')
+    for result in node_results:
+        latencies.frombytes(result[4])
+    latencies = sorted(latencies)
+    elapsed = max(end_time - start_time, 1e-9)
+    published = sum(result[1] for result in node_results)
+    received = sum(result[2] for result in node_results)
+    return {'elapsed_sec': elapsed,
+            'published': published,
+            'received': received,
+            'missed': sum(result[3] for result in node_results),
+            'publish_rate': published / elapsed,
+            'receive_rate': received / elapsed,
+            'latency_us': {'p50': percentile(latencies, 0.5),
+                           'p99': percentile(latencies, 0.99),
+                           'p999': percentile(latencies, 0.999),
+                           'max': latencies[-1] if latencies else None},
+            'broker_cpu_sec': broker_cpu,
+            'broker_cpu_util': broker_cpu / elapsed,
+            'broker_rss_kb': rss_kb,
+            'broker_peak_rss_kb': peak_rss_kb,
+            'broker_request_latency_us': broker_metrics and broker_metrics['request_latency_us'],
+            'broker_queue_depth': broker_metrics and broker_metrics['queue_depth']}
+
+
+'''
+Function that returns the commit being measured, or None outside a git checkout
+'''
+def git_commit():
+    try:
+        output = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir,
+                                capture_output=True, text=True, check=True).stdout
+        return output.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+'''
+Function that prints throughput and latency side by side for the runs of two result files
+Runs are matched by their workload parameters
+'''
+def compare(old_path, new_path):
+    def load(path):
+        with open(path) as results_file:
+            runs = [json.loads(line) for line in results_file if line.strip()]
+        return {json.dumps(run['params'], sort_keys=True): run for run in runs}
+
+    old_runs, new_runs = load(old_path), load(new_path)
+    print('%-60s %12s %12s %10s %10s' % ('params', 'old msg/s', 'new msg/s', 'old p99', 'new p99'))
+    for key, new in new_runs.items():
+        old = old_runs.get(key)
+        if old is None:
+            continue
+        print('%-60s %12.0f %12.0f %10s %10s' % (key[:60], old['receive_rate'], new['receive_rate'],
+                                                 old['latency_us']['p99'], new['latency_us']['p99']))
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for the pub/sub middleware')
+    parser.add_argument('--publishers', type=int_list, default=[1])
+    parser.add_argument('--subscribers', type=int_list, default=[1])
+    parser.add_argument('--topics', type=int_list, default=[1])
+    parser.add_argument('--payload', type=int_list, default=[64], help='payload sizes in bytes')
+    parser.add_argument('--history', type=int_list, default=[0], help='history depths')
+    parser.add_argument('--messages', type=int, default=2000, help='messages per publisher')
+    parser.add_argument('--transport', choices=['ipc', 'tcp'], default='ipc')
+    parser.add_argument('--batch', action='store_true', help='publish without waiting for the broker')
+    parser.add_argument('--direct', action='store_true', help='publish straight to the subscribers')
+    parser.add_argument('--rate', type=int, default=0, help='messages/sec per publisher (0 for as fast as possible)')
+    parser.add_argument('--timeout-ms', type=int, default=2000, help='how long a subscriber waits for a message')
+    parser.add_argument('--max-runtime', type=int, default=300, help='seconds to wait for a run to finish')
+    parser.add_argument('--scenario', help='run a test case directory instead of generated workloads')
+    parser.add_argument('--output', help='append results to this file, one JSON object per run')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    if args.scenario:
+        nodes, max_runtime = load_scenario(args.scenario)
+        workloads = [({'scenario': os.path.basename(os.path.normpath(args.scenario)), 'payload': args.payload[0]},
+                      nodes, max_runtime)]
+    else:
+        workloads = []
+        for publishers, subscribers, topics, payload, history in itertools.product(
+                args.publishers, args.subscribers, args.topics, args.payload, args.history):
+            params = {'publishers': publishers, 'subscribers': subscribers, 'topics': topics,
+                      'payload': payload, 'history': history, 'messages': args.messages}
+            workloads.append((params, make_workload(publishers, subscribers, topics, history, args.messages),
+                              args.max_runtime))
+
+    commit = git_commit()
+    output = open(args.output, 'a') if args.output else None
+    print('%-70s %10s %10s %8s %8s %8s %6s %8s' % ('params', 'pub/s', 'recv/s', 'p50 us', 'p99 us', 'p999 us',
+                                                  'cpu', 'rss KB'))
+    for params, nodes, max_runtime in workloads:
+        params = dict(params, transport=args.transport, batch=args.batch)
+        if args.direct:
+            params['direct'] = True
+        if args.rate:
+            params['rate'] = args.rate
+        options = {'payload': params['payload'], 'rate': args.rate, 'batch': args.batch, 'direct': args.direct,
+                   'timeout_ms': args.timeout_ms, 'transport': args.transport}
+        result = run_workload(nodes, options, max_runtime)
+        record = dict(result, params=params, commit=commit, cpus=os.cpu_count(), time=time.time())
+        if output is not None:
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+        latency = result['latency_us']
+        print('%-70s %10.0f %10.0f %8s %8s %8s %6.2f %8d' % (json.dumps(params, sort_keys=True)[:70],
+                                                           result['publish_rate'], result['receive_rate'],
+                                                           latency['p50'], latency['p99'], latency['p999'],
+                                                           result['broker_cpu_util'], result['broker_peak_rss_kb']))
+    if output is not None:
+        output.close()
@@ -1,7 +1,35 @@
 # Requires sortedcontainers for maintaining sorted list efficiently (pip install sortedcontainers)
+# Usage: python3 broker.py [number of shards] [history directory, or - for none] [metrics log interval in ms]
+#                          [host of the primary broker, to run as its standby]
+
+import sys
+import logging
 
 from middleware import Broker
+from sharding import ShardedBroker
+
+# Metrics of shard i are served on this port + i (see metrics.query_metrics())
+metrics_base_port = 9777
 
-broker = Broker()
+# A single broker streams its state to a standby on this port (see Broker arguments replica_addr and primary_addr)
+replica_port = 7776
 
-broker.run()
+if __name__ == '__main__':
+    # Set the level to logging.DEBUG to log every request the broker handles
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    num_shards = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    # With a history directory, history is kept on disk and survives restarts
+    history_dir = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != '-' else None
+    metrics_interval_ms = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    # A standby takes over from the primary on the given host if it fails (single broker only)
+    primary_host = sys.argv[4] if len(sys.argv) > 4 else None
+    metrics_addrs = ['tcp://*:%d' % (metrics_base_port + shard) for shard in range(num_shards)]
+    if num_shards > 1:
+        # One broker process per shard, on ports 7777/7778, 7779/7780, ...
+        ShardedBroker(num_shards, history_dir=history_dir, metrics_addrs=metrics_addrs,
+                      metrics_interval_ms=metrics_interval_ms).run()
+    else:
+        primary_addr = None if primary_host is None else 'tcp://%s:%d' % (primary_host, replica_port)
+        broker = Broker(history_dir=history_dir, metrics_addr=metrics_addrs[0], metrics_interval_ms=metrics_interval_ms,
+                        replica_addr='tcp://*:%d' % replica_port, primary_addr=primary_addr)
+        broker.run()
@@ -0,0 +1,279 @@
+'''
+Compact wire codec shared by the Broker and Client in middleware.py
+
+Every message starts with a fixed binary header frame:
+    message type (1 byte), flags (1 byte), content codec (1 byte),
+    topic id (4 bytes), address id (4 bytes), request id (8 bytes)
+Publications sent by the broker to subscribers carry the topic's sequence number in place of
+the request id. Sequence numbers start at 1 and grow by one with every message of a topic.
+Publications sent straight from a publisher to its subscribers (direct mode, see middleware.py)
+carry the publisher's address id and the publisher's own sequence numbers for the topic.
+Topic and address strings are interned by the broker at registration time, so
+the hot path (publish, fan-out, ping) never carries them as strings.
+
+Registration and reply fields travel in a small body frame encoded with msgpack
+(or JSON if msgpack is not installed). Published content travels as separate
+frames: bytes-like content is passed through untouched, anything else is encoded
+by a content codec. Pickle is never used to decode data from the network.
+
+Content of topics registered with compression is compressed after encoding and sent with
+the codec CODEC_COMPRESSED. The frame starts with a small prefix naming the compressor, the
+codec of the content inside and the compression dictionary (0 for none), so the broker can
+store and forward it like any other content and only the subscriber decompresses it.
+Dictionaries are identified by a 64-bit BLAKE2b hash and must be registered on the subscriber
+too (the Client does this with the dictionaries the broker hands out). A dictionary whose id is
+taken by another one is refused rather than replacing it.
+'''
+
+import json
+import struct
+import zlib
+import hashlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Message types
+MSG_UNKNOWN = 0
+MSG_CLIENT_REG = 1
+MSG_PUB_REG = 2
+MSG_SUB_REG = 3
+MSG_PUB = 4
+MSG_PUB_BATCH = 5
+MSG_PING = 6
+MSG_DISCONNECT = 7
+MSG_SHUTDOWN = 8
+MSG_HEARTBEAT = 9
+MSG_REPLAY = 10
+MSG_OWNER = 11
+MSG_SUPPRESS = 12
+MSG_DICTIONARY = 13
+MSG_REG_MANY = 14
+
+msg_type_names = {MSG_UNKNOWN: 'unknown',
+                  MSG_CLIENT_REG: 'client_reg',
+                  MSG_PUB_REG: 'pub_reg',
+                  MSG_SUB_REG: 'sub_reg',
+                  MSG_PUB: 'pub',
+                  MSG_PUB_BATCH: 'pub_batch',
+                  MSG_PING: 'ping',
+                  MSG_DISCONNECT: 'disconnect',
+                  MSG_SHUTDOWN: 'shutdown',
+                  MSG_HEARTBEAT: 'heartbeat',
+                  MSG_REPLAY: 'replay',
+                  MSG_OWNER: 'owner',
+                  MSG_SUPPRESS: 'suppress',
+                  MSG_DICTIONARY: 'dictionary',
+                  MSG_REG_MANY: 'reg_many'}
+msg_type_ids = {name: msg_type for msg_type, name in msg_type_names.items()}
+
+# Header flags
+FLAG_ACK = 0x01     # Request wants a reply (only optional for publications)
+FLAG_RESULT = 0x02  # Reply reports success
+FLAG_SUPPRESSED = 0x04  # Publication from a publisher that was told it does not own the topic (MSG_SUPPRESS)
+FLAG_MORE = 0x08    # Publication sent in chunks: more chunks of the message follow
+FLAG_CHUNK = 0x10   # Publication sent in chunks: this chunk continues the previous one
+
+# Content codecs. CODEC_NONE marks messages without content frames
+CODEC_NONE = 0
+CODEC_RAW = 1
+CODEC_MSGPACK = 2
+CODEC_JSON = 3
+CODEC_COMPRESSED = 4
+
+HEADER = struct.Struct('!BBBIIQ')
+
+# Prefix of compressed content: compressor id, codec of the content inside, dictionary id
+COMPRESSED_PREFIX = struct.Struct('!BBQ')
+
+
+'''
+Function that packs a message header
+Returns the header as bytes
+'''
+def encode_header(msg_type, flags=0, codec=CODEC_NONE, topic_id=0, addr_id=0, req_id=0):
+    return HEADER.pack(msg_type, flags, codec, topic_id, addr_id, req_id)
+
+
+'''
+Function that unpacks a message header
+Returns the tuple (msg_type, flags, codec, topic_id, addr_id, req_id)
+buf: bytes, memoryview or zmq.Frame holding the header
+'''
+def decode_header(buf):
+    if not isinstance(buf, (bytes, bytearray, memoryview)):
+        buf = buf.buffer
+    return HEADER.unpack_from(buf)
+
+
+def encode_json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def decode_json(buf):
+    if not isinstance(buf, (bytes, bytearray)):
+        buf = bytes(buf)
+    return json.loads(buf)
+
+
+# Body frames hold the few fields that are not worth a fixed slot in the header
+if msgpack is not None:
+    def encode_body(body):
+        return msgpack.packb(body, use_bin_type=True)
+
+    def decode_body(buf):
+        return msgpack.unpackb(buf, raw=False)
+else:
+    encode_body = encode_json
+    decode_body = decode_json
+
+
+# Registered content codecs: codec id -> (encode, decode)
+content_codecs = {CODEC_JSON: (encode_json, decode_json)}
+if msgpack is not None:
+    content_codecs[CODEC_MSGPACK] = (lambda obj: msgpack.packb(obj, use_bin_type=True),
+                                     lambda buf: msgpack.unpackb(buf, raw=False))
+    default_content_codec = CODEC_MSGPACK
+else:
+    default_content_codec = CODEC_JSON
+
+
+'''
+Function that adds a content codec, or replaces an existing one
+codec: Codec id carried in the header (CODEC_RAW and CODEC_NONE are reserved)
+encode: Function that turns a content object into bytes
+decode: Function that turns a buffer back into the content object
+'''
+def register_content_codec(codec, encode, decode):
+    if codec in (CODEC_NONE, CODEC_RAW, CODEC_COMPRESSED) or not 0 < codec < 256:
+        raise ValueError('Invalid content codec id %r' % codec)
+    content_codecs[codec] = (encode, decode)
+
+
+'''
+Function that encodes published content
+Returns the tuple (codec, buffer). Bytes-like content is returned as is, so it can be sent without a copy
+content: The content being published
+codec: Codec to use. By default bytes-like content is passed through raw and anything else uses
+       msgpack (JSON without msgpack)
+'''
+def encode_content(content, codec=None):
+    if codec is None:
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return CODEC_RAW, content
+        codec = default_content_codec
+    elif codec == CODEC_RAW:
+        return CODEC_RAW, content
+    return codec, content_codecs[codec][0](content)
+
+
+'''
+Function that decodes published content
+Raw content is returned as a memoryview over the received buffer instead of being copied
+codec: Codec id from the message header
+buf: bytes, memoryview or zmq.Frame holding the content
+'''
+def decode_content(codec, buf):
+    if not isinstance(buf, (bytes, bytearray, memoryview)):
+        buf = buf.buffer
+    if codec == CODEC_RAW:
+        return memoryview(buf)
+    if codec == CODEC_COMPRESSED:
+        return decompress_content(buf)
+    return content_codecs[codec][1](buf)
+
+
+'''
+Function that deflates with zlib, without the zlib header and checksum (the transport checks the data)
+'''
+def zlib_compress(data, dictionary):
+    if dictionary is None:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=dictionary)
+    return compressor.compress(data) + compressor.flush()
+
+
+def zlib_decompress(data, dictionary):
+    if dictionary is None:
+        decompressor = zlib.decompressobj(-15)
+    else:
+        decompressor = zlib.decompressobj(-15, zdict=dictionary)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+# Registered compressors: name -> (compressor id, compress, decompress), and compressor id -> name
+compressors = {'zlib': (1, zlib_compress, zlib_decompress)}
+compressor_names = {1: 'zlib'}
+
+# Registered compression dictionaries: dictionary id -> dictionary
+dictionaries = {}
+
+
+'''
+Function that adds a compressor, or replaces an existing one
+compressor_id: Id carried in the prefix of compressed content (1 to 255)
+name: Name that publishers ask for when registering a topic
+compress: Function that takes (bytes-like data, dictionary bytes or None) and returns the compressed bytes
+decompress: Function that takes (bytes-like data, dictionary bytes or None) and returns the data
+'''
+def register_compressor(compressor_id, name, compress, decompress):
+    if not 0 < compressor_id < 256:
+        raise ValueError('Invalid compressor id %r' % compressor_id)
+    compressors[name] = (compressor_id, compress, decompress)
+    compressor_names[compressor_id] = name
+
+
+'''
+Function that adds a compression dictionary: sample content that small, repetitive messages share,
+which lets them compress even though each one is too short on its own
+Returns the id of the dictionary
+Raises ValueError if another dictionary has the same id, as messages compressed with either one
+could then not be told apart
+'''
+def register_dictionary(dictionary):
+    dictionary = bytes(dictionary)
+    dictionary_id = dictionary_id_of(dictionary)
+    known = dictionaries.setdefault(dictionary_id, dictionary)
+    if known != dictionary:
+        raise ValueError('Compression dictionary id %016x is taken by another dictionary' % dictionary_id)
+    return dictionary_id
+
+
+'''
+Function that returns the id of a dictionary, without registering it. Id 0 stands for no dictionary
+'''
+def dictionary_id_of(dictionary):
+    return int.from_bytes(hashlib.blake2b(dictionary, digest_size=8).digest(), 'big') or 1
+
+
+'''
+Function that compresses encoded content
+Returns the tuple (CODEC_COMPRESSED, bytes)
+codec, buf: Encoded content, as returned by encode_content()
+compressor: Name of a registered compressor
+dictionary_id: Id of a registered dictionary, or 0 for none
+'''
+def compress_content(codec, buf, compressor, dictionary_id=0):
+    compressor_id, compress, decompress = compressors[compressor]
+    compressed = compress(buf, dictionaries[dictionary_id] if dictionary_id else None)
+    return CODEC_COMPRESSED, COMPRESSED_PREFIX.pack(compressor_id, codec, dictionary_id) + compressed
+
+
+'''
+Function that decompresses and decodes content compressed by compress_content()
+buf: bytes-like compressed content
+'''
+def decompress_content(buf):
+    compressor_id, codec, dictionary_id = COMPRESSED_PREFIX.unpack_from(buf)
+    dictionary = None
+    if dictionary_id:
+        dictionary = dictionaries.get(dictionary_id)
+        if dictionary is None:
+            raise ValueError('Unknown compression dictionary %016x, see register_dictionary()' % dictionary_id)
+    decompress = compressors[compressor_names[compressor_id]][2]
+    data = decompress(memoryview(buf)[COMPRESSED_PREFIX.size:], dictionary)
+    return decode_content(codec, data)
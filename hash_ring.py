@@ -0,0 +1,42 @@
+'''
+Consistent hash ring that maps topics to broker shards
+
+Each shard is placed at many points on the ring and a topic belongs to the shard of the first
+point at or after the topic's hash, so adding a shard only moves about 1/N of the topics.
+Hashes come from md5, so every host and every Python run agrees on the placement.
+'''
+
+import bisect
+import hashlib
+
+# Points per shard on the ring. More points spread topics more evenly
+ring_points_per_shard = 64
+
+
+class HashRing:
+    '''
+    num_shards: Number of shards, numbered 0 to num_shards - 1
+    '''
+    def __init__(self, num_shards):
+        self.num_shards = num_shards
+        points = sorted((ring_hash('%d-%d' % (shard, point)), shard)
+                        for shard in range(num_shards) for point in range(ring_points_per_shard))
+        self.hashes = [point_hash for point_hash, shard in points]
+        self.shards = [shard for point_hash, shard in points]
+
+    '''
+    Function that returns the shard a topic belongs to
+    topic: Topic string
+    '''
+    def shard_for(self, topic):
+        if self.num_shards == 1:
+            return 0
+        position = bisect.bisect_left(self.hashes, ring_hash(topic)) % len(self.hashes)
+        return self.shards[position]
+
+
+'''
+Function that hashes a string onto the ring
+'''
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
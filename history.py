@@ -0,0 +1,229 @@
+'''
+History store used by the Broker in middleware.py
+
+History is kept per topic rather than per publisher: every topic has one ring buffer holding
+the last messages that were forwarded to its subscribers, sized for the publisher of the topic
+that keeps the most history. A ring holds consecutive sequence numbers, so only the sequence
+number of its newest message is stored. All rings share one byte budget. When it is exceeded, the oldest
+messages of the topic that was published on least recently are evicted first.
+
+Each retained message costs one ring slot, one codec byte, its arrival time and its content. Small contents are
+copied out of their zmq.Frame into a bytes object, since a Frame costs a few hundred bytes on
+its own. Large contents keep the received Frame, so they are never copied.
+'''
+
+import collections
+from array import array
+
+# Contents up to this size are copied into bytes, larger ones keep their zmq.Frame
+history_copy_max = 4096
+
+# Approximate memory per retained message on top of its content (measured with benchmarks/bench_history.py)
+bytes_entry_overhead = 72
+frame_entry_overhead = 264
+
+
+class TopicHistory:
+    '''
+    capacity: Number of messages the ring holds
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Grown as messages arrive, up to capacity, so large capacities cost nothing until used.
+        # Until the ring is full, the messages held always end at the end of the slots
+        self.slots = []
+        self.codecs = bytearray()
+        # Time each message was forwarded at, in seconds since the epoch
+        self.times = array('d')
+        # Index of the oldest message, number of messages held and sequence number of the newest
+        self.start = 0
+        self.count = 0
+        self.last_seq = 0
+
+    '''
+    Function that returns the slot index of the i-th oldest message
+    '''
+    def index(self, i):
+        return (self.start + i) % self.capacity
+
+    '''
+    Function that returns the last count messages, oldest first, as a list of (seq, codec, content)
+    timed: Return (seq, codec, content, time) instead
+    '''
+    def last(self, count, timed=False):
+        count = max(0, min(count, self.count))
+        first_seq = self.last_seq - count + 1
+        indexes = [self.index(i) for i in range(self.count - count, self.count)]
+        if timed:
+            return [(first_seq + n, self.codecs[i], self.slots[i], self.times[i]) for n, i in enumerate(indexes)]
+        return [(first_seq + n, self.codecs[i], self.slots[i]) for n, i in enumerate(indexes)]
+
+
+'''
+Function that returns the memory charged to the budget for one retained content
+'''
+def entry_cost(content):
+    if isinstance(content, bytes):
+        return len(content) + bytes_entry_overhead
+    return len(content) + frame_entry_overhead
+
+
+class HistoryStore:
+    '''
+    budget_bytes: Most memory that all rings together may use, in bytes
+    '''
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.bytes = 0
+        self.messages = 0
+        self.evictions = 0
+
+        # topic -> TopicHistory
+        self.topics = {}
+
+        # Topics holding messages, least recently published on first. Eviction starts at the front
+        self.lru = collections.OrderedDict()
+
+    '''
+    Function that sets how many messages are kept for a topic, dropping the oldest ones if it shrinks
+    topic: Topic string
+    capacity: Number of messages to keep (0 drops the topic's history)
+    '''
+    def set_capacity(self, topic, capacity):
+        ring = self.topics.get(topic)
+        if ring is not None and ring.capacity == capacity:
+            return
+        entries = []
+        if ring is not None:
+            entries = ring.last(capacity, timed=True)
+            self.drop_oldest(ring, topic, ring.count)
+            del self.topics[topic]
+        if capacity > 0:
+            ring = self.topics[topic] = TopicHistory(capacity)
+            for seq, codec, content, sent in entries:
+                self.push(ring, topic, codec, content, sent)
+                ring.last_seq = seq
+            if ring.count:
+                self.lru[topic] = ring
+
+    '''
+    Function that returns how many messages are kept for a topic (0 if none)
+    '''
+    def capacity(self, topic):
+        ring = self.topics.get(topic)
+        return 0 if ring is None else ring.capacity
+
+    '''
+    Function that returns the sequence number of the newest message kept for every topic
+    '''
+    def last_seqs(self):
+        return {topic: ring.last_seq for topic, ring in self.topics.items() if ring.count}
+
+    '''
+    Function that appends forwarded messages to the history of their topic
+    Does nothing for topics that keep no history
+    topic: Topic string
+    codec: Content codec of the messages
+    contents: List of contents (zmq.Frame), oldest first
+    first_seq: Sequence number of the first message
+    now: Time the messages were forwarded at, in seconds
+    '''
+    def append(self, topic, codec, contents, first_seq, now):
+        ring = self.topics.get(topic)
+        if ring is None:
+            return
+        # Messages that did not reach the ring break its run of sequence numbers, so it starts over
+        if ring.count and ring.last_seq != first_seq - 1:
+            self.drop_oldest(ring, topic, ring.count)
+        # Only the messages the ring can hold are kept
+        for content in contents[-ring.capacity:]:
+            if len(content) <= history_copy_max:
+                content = content.bytes
+            self.push(ring, topic, codec, content, now)
+        ring.last_seq = first_seq + len(contents) - 1
+
+        self.lru[topic] = ring
+        self.lru.move_to_end(topic)
+        self.evict()
+
+    '''
+    Function that returns the last count messages of a topic, oldest first, as a list of (seq, codec, content)
+    '''
+    def get(self, topic, count):
+        ring = self.topics.get(topic)
+        if ring is None:
+            return []
+        return ring.last(count)
+
+    '''
+    Function that returns the last count messages of a topic, oldest first, as a list of (seq, codec, content, time)
+    '''
+    def get_timed(self, topic, count):
+        ring = self.topics.get(topic)
+        if ring is None:
+            return []
+        return ring.last(count, timed=True)
+
+    '''
+    Function that returns the messages of a topic from a sequence number onwards, as a list of (seq, codec, content)
+    Starts at the oldest message kept if from_seq is older
+    '''
+    def get_from(self, topic, from_seq):
+        ring = self.topics.get(topic)
+        if ring is None:
+            return []
+        return ring.last(ring.last_seq - from_seq + 1)
+
+    '''
+    Function for the Broker's periodic call to write history to disk. In-memory history has nothing to write
+    Returns None, as there is nothing waiting
+    '''
+    def sync(self, now):
+        return None
+
+    def close(self):
+        self.topics.clear()
+        self.lru.clear()
+
+    '''
+    Function that adds one message to a ring, overwriting its oldest message when it is full
+    '''
+    def push(self, ring, topic, codec, content, sent):
+        if ring.count == ring.capacity:
+            self.drop_oldest(ring, topic, 1)
+        index = ring.index(ring.count)
+        if index == len(ring.slots):
+            ring.slots.append(content)
+            ring.codecs.append(codec)
+            ring.times.append(sent)
+        else:
+            ring.slots[index] = content
+            ring.codecs[index] = codec
+            ring.times[index] = sent
+        ring.count += 1
+        self.bytes += entry_cost(content)
+        self.messages += 1
+
+    '''
+    Function that removes the oldest messages of a ring
+    count: Number of messages to remove
+    '''
+    def drop_oldest(self, ring, topic, count):
+        for _ in range(count):
+            self.bytes -= entry_cost(ring.slots[ring.start])
+            ring.slots[ring.start] = None
+            ring.start = (ring.start + 1) % ring.capacity
+            ring.count -= 1
+            self.messages -= 1
+        if ring.count == 0:
+            self.lru.pop(topic, None)
+
+    '''
+    Function that evicts the oldest messages of the least recently published topics until the
+    store fits its budget
+    '''
+    def evict(self):
+        while self.bytes > self.budget_bytes and self.lru:
+            topic, ring = next(iter(self.lru.items()))
+            self.drop_oldest(ring, topic, 1)
+            self.evictions += 1
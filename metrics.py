@@ -0,0 +1,180 @@
+'''
+Metrics kept by the Broker in middleware.py
+
+The Broker counts every request and publication as it handles them. Only integer additions are
+done on the hot path; percentiles, rates and the JSON snapshot are computed when asked for.
+A snapshot can be read in process (Broker.metrics.snapshot()), queried over the Broker's metrics
+socket (see query_metrics()), or logged periodically.
+'''
+
+import json
+import time
+
+import zmq
+
+# Histograms have one bucket per power of two: bucket i counts values below 2**i (bucket 0 counts
+# zeros), and the last bucket also counts anything larger
+histogram_buckets = 32
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * histogram_buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    '''
+    Function that records one value
+    value: Non-negative integer (microseconds for latencies)
+    '''
+    def add(self, value):
+        self.counts[min(value.bit_length(), histogram_buckets - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    '''
+    Function that returns a percentile, as the upper bound of the bucket it falls in (at most the largest value)
+    fraction: Percentile as a fraction (0.99 for p99)
+    '''
+    def percentile(self, fraction):
+        if self.count == 0:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(1 << bucket, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0,
+                'p50': self.percentile(0.5),
+                'p99': self.percentile(0.99),
+                'p999': self.percentile(0.999),
+                'max': self.max}
+
+
+class BrokerMetrics:
+    def __init__(self):
+        self.start_time = time.time()
+
+        # Message type -> Histogram of the time from receiving a request to sending its reply, in microseconds
+        self.requests = {}
+
+        # Topic -> [messages published, bytes published, messages forwarded, bytes forwarded]
+        self.topics = {}
+
+        # Requests read per wake-up of the broker loop: how many were queued on the ROUTER socket
+        self.queue_depths = Histogram()
+        self.last_queue_depth = 0
+
+        self.evicted_clients = 0
+
+        # Times a topic went to another publisher (see PublisherRegistry.arbitrate() in registry.py)
+        self.ownership_changes = 0
+
+        # Large messages not sent to subscribers because too many chunks were waiting (see Broker.send_chunks())
+        self.chunk_drops = 0
+
+        # Time spent in registry lookups and in decoding requests / encoding replies, in nanoseconds
+        self.lookup_ns = 0
+        self.decode_ns = 0
+        self.encode_ns = 0
+
+        # Counters at the previous snapshot, for rates
+        self.last_snapshot_time = self.start_time
+        self.last_topic_counts = {}
+
+    '''
+    Function that records a handled request
+    msg_type: Message type name
+    elapsed_ns: Time from receiving the request to sending its reply
+    '''
+    def record_request(self, msg_type, elapsed_ns):
+        histogram = self.requests.get(msg_type)
+        if histogram is None:
+            histogram = self.requests[msg_type] = Histogram()
+        histogram.add(elapsed_ns // 1000)
+
+    '''
+    Function that records publications on a topic
+    count, num_bytes: Number and total size of the messages
+    forwarded: Whether they were forwarded to subscribers
+    '''
+    def record_publish(self, topic, count, num_bytes, forwarded):
+        counts = self.topics.get(topic)
+        if counts is None:
+            counts = self.topics[topic] = [0, 0, 0, 0]
+        counts[0] += count
+        counts[1] += num_bytes
+        if forwarded:
+            counts[2] += count
+            counts[3] += num_bytes
+
+    '''
+    Function that records how many requests the broker loop read in one wake-up
+    '''
+    def record_queue_depth(self, depth):
+        self.last_queue_depth = depth
+        self.queue_depths.add(depth)
+
+    '''
+    Function that returns every metric as a dict that can be encoded as JSON
+    Rates are per second since the previous snapshot
+    broker: The Broker, for the state that is read rather than counted (clients, subscriber drops, history)
+    '''
+    def snapshot(self, broker):
+        now = time.time()
+        interval = max(now - self.last_snapshot_time, 1e-9)
+        topics = {}
+        for topic, counts in self.topics.items():
+            last = self.last_topic_counts.get(topic, [0, 0, 0, 0])
+            topics[topic] = {'published': counts[0],
+                             'published_bytes': counts[1],
+                             'forwarded': counts[2],
+                             'forwarded_bytes': counts[3],
+                             'publish_rate': (counts[0] - last[0]) / interval,
+                             'forward_rate': (counts[2] - last[2]) / interval,
+                             'forward_bytes_rate': (counts[3] - last[3]) / interval}
+        self.last_topic_counts = {topic: list(counts) for topic, counts in self.topics.items()}
+        self.last_snapshot_time = now
+
+        return {'time': now,
+                'uptime': now - self.start_time,
+                'request_latency_us': {msg_type: histogram.to_dict() for msg_type, histogram in self.requests.items()},
+                'topics': topics,
+                'queue_depth': dict(self.queue_depths.to_dict(), last=self.last_queue_depth),
+                'clients': {'registered': len(broker.hb_dict), 'evicted': self.evicted_clients},
+                'wildcard_patterns': broker.patterns.size,
+                'ownership_changes': self.ownership_changes,
+                'chunks': {'backlog_bytes': broker.chunk_backlog, 'dropped_messages': self.chunk_drops},
+                'subscriber_drops': {addr: entry['drops'] for addr, entry in broker.hb_dict.items() if 'drops' in entry},
+                'history': {'bytes': broker.history.bytes, 'messages': broker.history.messages,
+                            'evictions': broker.history.evictions},
+                'time_ms': {'registry_lookup': self.lookup_ns / 1e6, 'decode': self.decode_ns / 1e6,
+                            'encode': self.encode_ns / 1e6}}
+
+
+'''
+Function that asks a Broker's metrics socket for a snapshot
+Returns the snapshot dict, or None if the broker does not answer in time
+metrics_addr: Address of the broker's metrics socket (include protocol)
+timeout_ms: How long to wait for the answer
+'''
+def query_metrics(metrics_addr, timeout_ms=1000):
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(metrics_addr)
+    try:
+        socket.send(b'metrics')
+        if not socket.poll(timeout_ms):
+            return None
+        return json.loads(socket.recv())
+    finally:
+        socket.close()
@@ -4,12 +4,30 @@ functions for the publisher, subscriber, and broker to use
 '''
 
 import zmq
+import os
+import base64
 import socket
 import collections
-import threading
 import time
-from sortedcontainers import SortedListWithKey
+import json
+import logging
+import struct
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
 
+from codec import *
+from registry import PublisherRegistry
+from timer_wheel import TimerWheel
+from hash_ring import HashRing
+from history import HistoryStore
+from segment_log import SegmentLog
+from metrics import BrokerMetrics
+from topic_trie import TopicTrie, is_pattern, check_pattern, topic_matches
+
+# Lifecycle events are logged at INFO, every request at DEBUG. Use logging.basicConfig() to see them
+logger = logging.getLogger('middleware')
 
 default_broker_pub_address = "tcp://*:7778"
 default_broker_rep_address = "tcp://*:7777"
@@ -19,251 +37,1216 @@ client_connect_sub_address = "tcp://localhost:7778"
 heartbeat_interval_ms = 1000
 starting_heartbeat_count = 3
 
+# Resolution of client expiry. A client is evicted between its deadline and one tick later
+expiry_tick_ms = 100
+
+# Memory the broker may use for the history of all topics together
+default_history_budget_bytes = 64 * 1024 * 1024
+
+# Most history messages sent in one reply. Longer histories are sent as several replies
+history_chunk_msgs = 256
+
+# Most requests the broker reads per wake-up before it checks heartbeats and expiry again
+broker_burst = 256
+
+# Given a chunk_rate_bytes, publications larger than chunk_bytes are sent to subscribers in chunks, taking
+# turns with the other topics, at most chunk_rate_bytes per second together. Set below the speed of the
+# subscribers' links, the chunks never fill the connections, so small messages go out without waiting behind
+# large ones. Large messages that would make more than chunk_backlog_seconds of chunks wait are dropped,
+# like messages beyond a subscriber's sub_hwm (they stay in the history). 0 sends every message whole
+default_chunk_bytes = 64 * 1024
+default_chunk_rate_bytes = 0
+chunk_backlog_seconds = 1
+
+# Limits for coalescing non-blocking publishes into one batch message
+default_batch_max_msgs = 256
+default_batch_max_bytes = 64 * 1024
+default_batch_linger_ms = 5
+
+# A topic's owner loses it to another publisher once it has published nothing for this long (see registry.py).
+# Publishers that do not own their topic send one sample every half of it
+default_ownership_deadline_ms = heartbeat_interval_ms * starting_heartbeat_count
+
+# A standby broker takes over once it has not heard from its primary for this long (see Broker)
+default_failover_timeout_ms = 2 * heartbeat_interval_ms
+
+# Records of the replication link from a primary broker to its standby, and back
+REPL_REQUEST = b'Q'    # [REPL_REQUEST, REPL_SEQ, request frames as received]: a request to apply
+REPL_EVICT = b'E'      # [REPL_EVICT, REPL_SEQ, addr]: a client evicted by the primary
+REPL_SNAPSHOT = b'P'   # [REPL_SNAPSHOT, REPL_SEQ, state, history contents...]: the primary's whole state
+REPL_HEARTBEAT = b'H'  # [REPL_HEARTBEAT, epoch]: the primary is alive. The epoch changes when it restarts
+REPL_SYNC = b'Y'       # [REPL_SYNC]: the standby asks for a snapshot
+REPL_ACK = b'A'        # [REPL_ACK, REPL_SEQ]: the standby applied every record up to REPL_SEQ. Also its heartbeat
+REPL_SEQ = struct.Struct('!Q')
+
+# Most records queued on the replication link. A standby that falls this far behind is dropped until it resyncs
+replica_hwm = 100000
+
+# Requests the standby does not need to see
+unreplicated_requests = ('ping', 'unknown')
+
+# Most messages the broker queues for one subscriber connection (SNDHWM of its PUB socket). Beyond it
+# the broker drops that subscriber's newest messages, so a slow subscriber never holds up the others
+default_broker_sub_hwm = 1000
+
+# Lazy Pirate retries: a request left unanswered for request_timeout_ms is sent again on a new connection,
+# to the shard's standby broker if it has one, and fails with TimeoutError after request_retries attempts.
+# The timeout is longer than a standby takes over, so the first retry finds it ready
+default_request_timeout_ms = default_failover_timeout_ms + heartbeat_interval_ms // 2
+default_request_retries = 3
+
+# Most received messages a Client queues for notify()/poll(), and what it does with the next one
+default_sub_hwm = 100000
+slow_consumer_policies = ('drop_oldest', 'drop_newest', 'disconnect')
+
+# Commands sent from the Client API to the Client's I/O thread
+CMD_SEND = b'S'       # [CMD_SEND, SHARD_INFO, request frames...]: forward a request to a broker shard
+CMD_BATCH = b'B'      # [CMD_BATCH, BATCH_INFO, content]: add a publication to the batch of its topic
+CMD_FLUSH = b'F'      # [CMD_FLUSH]: send all pending batches
+CMD_SUBSCRIBE = b'U'  # [CMD_SUBSCRIBE, (topic, owner)...]: subscribe the SUB socket to topics (owner is empty if none)
+CMD_DIRECT = b'D'     # [CMD_DIRECT, topic, (header, content)...]: publish on the client's own data socket
+CMD_REPLAY = b'R'     # [CMD_REPLAY, SHARD_INFO, topic, SEQ_INFO, request frames...]: resume a topic from a sequence number
+CMD_STOP = b'X'       # [CMD_STOP]: send pending batches and stop the I/O thread
+
+# Broker shard that a CMD_SEND request goes to
+SHARD_INFO = struct.Struct('!H')
+
+# Shard, topic id, content codec and ack token (0 for none) of a publication for CMD_BATCH
+BATCH_INFO = struct.Struct('!HIBI')
+
+# Sequence number for CMD_REPLAY
+SEQ_INFO = struct.Struct('!Q')
+
+# Most messages the client I/O thread reads from one socket before serving the others
+io_burst = 256
+
+# Messages from the broker's PUB socket start with the topic followed by this terminator.
+# ZeroMQ subscriptions match prefixes, so without it a subscription to "A" would also receive "AB".
+# Messages sent to wildcard subscriptions start with the pattern and the terminator instead, followed by the topic
+topic_terminator = b'\0'
+broker_cmd_topic = b"BROKER_CMD" + topic_terminator
+
+# Topic the shards of a sharded broker announce client evictions to each other on. It has no terminator,
+# so no client subscription (every one ends with topic_terminator) matches it
+peer_evict_topic = b"BROKER_EVICT"
+
+
+'''
+Function that returns the envelope frame that starts every PUB message for a topic
+'''
+def topic_envelope(topic):
+    return topic.encode() + topic_terminator
+
+
+'''
+Function that returns the topic a PUB message was published on, from its envelope frame
+'''
+def envelope_topic(envelope):
+    pattern, _, topic = envelope.partition(topic_terminator)
+    return (topic or pattern).decode()
+
 
 class Broker:
     def __init__(self,
                  pub_addr = default_broker_pub_address,
-                 rep_addr = default_broker_rep_address):
+                 rep_addr = default_broker_rep_address,
+                 shard_id = 0,
+                 history_budget_bytes = default_history_budget_bytes,
+                 history_dir = None,
+                 metrics_addr = None,
+                 metrics_interval_ms = 0,
+                 sub_hwm = default_broker_sub_hwm,
+                 replica_addr = None,
+                 primary_addr = None,
+                 failover_timeout_ms = default_failover_timeout_ms,
+                 ownership_deadline_ms = default_ownership_deadline_ms,
+                 chunk_bytes = default_chunk_bytes,
+                 chunk_rate_bytes = default_chunk_rate_bytes,
+                 peer_addrs = None):
         self.pub_addr = pub_addr
         self.rep_addr = rep_addr
+        # Position of this broker among the shards of a sharded broker (see sharding.py)
+        self.shard_id = shard_id
+        # PUB addresses of the other shards. A client evicted by one shard is evicted by all of them, so
+        # that its registrations and the ownership of its topics never differ between shards
+        self.peer_addrs = peer_addrs or []
+        self.peer_socket = None
         self.context = zmq.Context()
         self.pub_socket = self.context.socket(zmq.PUB)
-        self.rep_socket = self.context.socket(zmq.REP)
-
-        # Dictionary that topics to sorted lists that keep track of the avaialable publishers
-        # (sorted on ownership strength)
-        self.topics_dict = {}
-
-        # Dictionary for keeping track of clients that are still alive
-        self.hb_mutex = threading.Lock()
+        # The limit applies to each subscriber connection on its own
+        self.pub_socket.setsockopt(zmq.SNDHWM, sub_hwm)
+        # ROUTER instead of REP so that the broker is not forced into recv/send lockstep.
+        # Each request arrives prefixed with the identity of the sending client and
+        # replies are routed back by that identity, in whatever order they complete.
+        self.router_socket = self.context.socket(zmq.ROUTER)
+
+        # Maps message type to the function that handles it. Handlers return the
+        # response to send, or None if the reply is sent later through reply()
+        self.handlers = {'pub_reg': self.handle_pub_reg,
+                         'sub_reg': self.handle_sub_reg,
+                         'pub': self.handle_pub,
+                         'pub_batch': self.handle_pub_batch,
+                         'shutdown': self.handle_shutdown,
+                         'disconnect': self.handle_disconnect,
+                         'client_reg': self.handle_client_reg,
+                         'ping': self.handle_ping,
+                         'replay': self.handle_replay,
+                         'reg_many': self.handle_reg_many}
+        self.running = False
+
+        # Topic and client address strings are interned to the small integer ids used on the wire.
+        # Id 0 is never assigned, so it marks an unknown topic or unregistered client
+        self.topic_ids = {}
+        self.topic_names = {}
+        self.topic_frames = {}
+        self.addr_ids = {}
+        self.addr_names = {}
+
+        # Available publishers, indexed by (topic, address), ownership strength and history.
+        # Each topic is owned by one publisher, which loses it after ownership_deadline_ms without publishing
+        self.registry = PublisherRegistry()
+        self.ownership_deadline = ownership_deadline_ms / 1000
+
+        # Owner announced to the subscribers of each topic that is (or was) published directly, as
+        # (address id, data address). Address id 0 and no data address mean the topic goes through the broker
+        self.topic_owners = {}
+
+        # Wildcard subscriptions ('+' and '#', see topic_trie.py) compiled into a trie, with the number of
+        # clients subscribed to each pattern. The envelopes each topic's messages are sent again on, one per
+        # matching pattern, are cached until a pattern is added or removed
+        self.patterns = TopicTrie()
+        self.pattern_refs = {}
+        self.pattern_frames = {}
+
+        # Last messages forwarded on each topic, as many as its publishers keep. Kept in memory within
+        # one budget, or, given a history_dir, in a log on disk that survives restarts (see segment_log.py)
+        if history_dir is None:
+            self.history = HistoryStore(history_budget_bytes)
+        else:
+            self.history = SegmentLog(history_dir)
+
+        # Sequence number of the last message forwarded on each topic. A durable history continues its numbering
+        self.topic_seqs = self.history.last_seqs()
+
+        # Compression dictionaries of the publishers of each topic, as {dictionary id: dictionary}. Subscribers
+        # are given them when they subscribe, and the new ones are announced on the topic (see codec.py)
+        self.topic_dictionaries = {}
+
+        # Given a chunk_rate_bytes, messages larger than chunk_bytes are sent to subscribers in chunks of that size,
+        # one chunk per topic in turn, paced to that rate, so that large messages do not hold up the small ones
+        # (sent right away) on the same connections. Topic -> deque of [envelopes, header fields, content, offset]
+        # of the messages still being sent. Later messages of the topic queue up behind them, to stay in order
+        self.chunk_bytes = chunk_bytes
+        self.chunk_rate = chunk_rate_bytes
+        self.chunk_queues = {}
+        self.chunk_backlog = 0
+        self.next_chunk_time = 0
+
+        # Counters and latency histograms (see metrics.py). Snapshots are served as JSON on a REP socket
+        # bound to metrics_addr, if given, and logged every metrics_interval_ms, if set
+        self.metrics = BrokerMetrics()
+        self.metrics_addr = metrics_addr
+        self.metrics_socket = None
+        self.metrics_interval = metrics_interval_ms / 1000
+        self.next_metrics_time = time.time() + self.metrics_interval if metrics_interval_ms else None
+
+        # Dictionary for keeping track of clients that are still alive, keyed by address.
+        # Each entry holds the client's liveness 'deadline', 'topics', the set of topics it publishes, and
+        # 'patterns', the wildcard patterns it subscribes to.
+        # Subscribers that lost messages also have the 'drops' they reported in their pings
         self.hb_dict = {}
 
-        # Send first heartbeat
-        self.send_hb()
-
+        # Every client is scheduled on the wheel. Traffic only pushes the deadline in hb_dict back;
+        # the wheel entry is rescheduled when it comes due, so refreshing a client costs O(1)
+        self.client_timeout = heartbeat_interval_ms * starting_heartbeat_count / 1000
+        self.expiry_wheel = TimerWheel(expiry_tick_ms, int(2 * self.client_timeout * 1000 / expiry_tick_ms) + 1, time.time())
+        self.next_hb_time = time.time()
+        self.hb_body = encode_body({'shard': shard_id})
+
+        # High availability. A primary given a replica_addr streams every change of its state to the standby
+        # broker connected there, and holds back the replies to requests until the standby has applied them,
+        # so nothing acknowledged is lost if the primary dies. A broker given a primary_addr is that standby:
+        # it follows the primary, and takes over (binding pub_addr and rep_addr) once it has heard nothing
+        # from it for failover_timeout_ms. A standby that took over accepts a new standby on its own replica_addr
+        self.replica_addr = replica_addr
+        self.primary_addr = primary_addr
+        self.failover_timeout = failover_timeout_ms / 1000
+        self.active = primary_addr is None
+        self.replica_socket = None
+        # Changes when the broker restarts, so a standby notices a restarted primary and syncs again
+        self.epoch = os.urandom(8).hex()
+        # Number of the last record sent (primary) or applied (standby)
+        self.repl_seq = 0
+        # Primary: whether a standby is synced, when it was last heard from, and the replies waiting for it
+        # as (record number, envelope, request, response)
+        self.standby_attached = False
+        self.standby_seen = 0
+        self.held_replies = collections.deque()
+        # Standby: whether it holds the primary's state, the primary's epoch and when it was last heard from
+        self.synced = False
+        self.primary_epoch = None
+        self.primary_seen = 0
+
+        if self.active:
+            self.bind_sockets()
+        else:
+            logger.info('Broker connecting to primary %s as its standby', self.primary_addr)
+            self.replica_socket = self.context.socket(zmq.PAIR)
+            self.replica_socket.connect(self.primary_addr)
+        if self.peer_addrs:
+            self.peer_socket = self.context.socket(zmq.SUB)
+            self.peer_socket.setsockopt(zmq.SUBSCRIBE, peer_evict_topic)
+            for peer_addr in self.peer_addrs:
+                logger.info('Broker connecting peer socket to %s', peer_addr)
+                self.peer_socket.connect(peer_addr)
 
-        '''
-        Funtion that binds a socket for the broker to receive messages from the publishers and subscribers
-        Returns the bound socket
-        address: Address to bind the socket to (include protocol)
-        '''
-        print('Broker binding pub socket to ', self.pub_addr)
+    '''
+    Funtion that binds the sockets the broker serves clients on, the replication link for a standby, and
+    the metrics socket. A standby binds them when it takes over, so it can run on the same host as its
+    primary with the same addresses
+    '''
+    def bind_sockets(self):
+        logger.info('Broker binding pub socket to %s', self.pub_addr)
         self.pub_socket.bind(self.pub_addr)
-        print('Broker binding rep socket to ', self.rep_addr)
-        self.rep_socket.bind(self.rep_addr)
+        logger.info('Broker binding router socket to %s', self.rep_addr)
+        self.router_socket.bind(self.rep_addr)
+        if self.replica_addr is not None:
+            logger.info('Broker binding replica socket to %s', self.replica_addr)
+            self.replica_socket = self.context.socket(zmq.PAIR)
+            self.replica_socket.setsockopt(zmq.SNDHWM, replica_hwm)
+            self.replica_socket.bind(self.replica_addr)
+        if self.metrics_addr is not None:
+            logger.info('Broker binding metrics socket to %s', self.metrics_addr)
+            self.metrics_socket = self.context.socket(zmq.REP)
+            self.metrics_socket.bind(self.metrics_addr)
 
     # Some helper functions
+    '''
+    Function that broadcasts a heartbeat to all clients. Called from the run() loop
+    '''
     def send_hb(self):
-        topic = "BROKER_CMD"
-        hb_msg = {'type': 'heartbeat'}
-        self.pub_socket.send_string(topic, zmq.SNDMORE)
-        self.pub_socket.send_pyobj(hb_msg)
-
-        # Entries in hb_dict are sorted by ip address.
-        # Each entry is another dict containing 'count' (hb timeout count) and 'topics' (list of published topics)
-        pub_removal_list = []
-        addr_removal_list = []
-        self.hb_mutex.acquire()
-        for addr, value in self.hb_dict.items():
-            #print(value)
-            value['count'] = value['count'] - 1
-
-            # If node has responded before count hits 0, done
-            if value['count'] > 0:
+        # Heartbeats name the shard, so clients of a sharded broker ping the shard that sent them
+        self.pub_socket.send_multipart([broker_cmd_topic, encode_header(MSG_HEARTBEAT), self.hb_body])
+        if self.replica_socket is not None:
+            try:
+                self.replica_socket.send_multipart([REPL_HEARTBEAT, self.epoch.encode()], zmq.NOBLOCK)
+            except zmq.error.Again:
+                pass
+        # Owners are announced again with every heartbeat, for subscribers that missed a change
+        for topic in self.topic_owners:
+            self.send_owner(topic)
+        self.next_hb_time = time.time() + heartbeat_interval_ms / 1000
+
+    '''
+    Function that marks a registered client as alive. Any request from a client counts, not only pings
+    addr: Address of the client
+    Returns False if the client is not registered
+    '''
+    def refresh_client(self, addr, now):
+        hb_entry = self.hb_dict.get(addr)
+        if hb_entry is None:
+            return False
+        hb_entry['deadline'] = now + self.client_timeout
+        return True
+
+    '''
+    Function that evicts the clients whose deadline has passed, with all of their publishers
+    Only clients in the timer wheel slots that came due are looked at
+    now: Current time in seconds
+    '''
+    def expire_clients(self, now):
+        for addr in self.expiry_wheel.advance(now):
+            hb_entry = self.hb_dict.get(addr)
+            if hb_entry is None:
+                continue
+            # Heard from the client since it was scheduled
+            if hb_entry['deadline'] > now:
+                self.expiry_wheel.schedule(addr, hb_entry['deadline'])
                 continue
 
-            # Else, assume node has died. Find all published topics and mark for removal
-            addr_removal_list.append(addr)
-            for topic in value['topics']:
-                for publisher in self.topics_dict[topic]:
-                    if publisher['addr'] == addr:
-                        pub_removal_list.append(publisher)
-        # Don't like holding a mutex (or mutexes in general) this long, but should always be released.
-        self.hb_mutex.release()
+            # Client is assumed dead, by every shard
+            self.remove_client(addr)
+            if self.peer_socket is not None:
+                self.pub_socket.send_multipart([peer_evict_topic, addr.encode()])
 
-        # Remove associated publisher(s) from topics_dict and remove client node from registered list (HB list)
-        # NOTE: This is done here to prevent changing the size of topics_dict and hb_dict while iterating over them
-        for pub in pub_removal_list:
-            self.topics_dict[topic].remove(pub)
-        for addr in addr_removal_list:
-            self.hb_dict.pop(addr, None)
-            print("removed ",addr," from hb_dict")
+    '''
+    Function that evicts a client that has expired here or on another shard
+    '''
+    def remove_client(self, addr):
+        if self.standby_attached:
+            self.replicate(REPL_EVICT, [addr.encode()])
+        self.evict_client(addr)
+        self.metrics.evicted_clients += 1
+        logger.info('Removed %s from hb_dict', addr)
 
-        # Start next HB timer. Python doesn't seem to offer a reoccuring timer, so this ugly solution is what we get
-        self.hb_timer = threading.Timer(heartbeat_interval_ms / 1000, self.send_hb)
-        self.hb_timer.start()
+    '''
+    Function that evicts the clients that other shards announced as expired
+    '''
+    def handle_peer_messages(self):
+        while True:
+            try:
+                frames = self.peer_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+            addr = frames[1].decode()
+            if addr in self.hb_dict:
+                self.remove_client(addr)
 
+    '''
+    Function that removes a client with all of its publishers and wildcard subscriptions
+    '''
+    def evict_client(self, addr):
+        # The client's own reverse index lists the publishers to remove
+        hb_entry = self.hb_dict.pop(addr)
+        for topic in list(hb_entry['topics']):
+            self.remove_publisher(addr, topic)
+        for pattern in hb_entry['patterns']:
+            self.release_pattern(pattern)
 
     '''
     Funtion that destroys the provided socket
     socket: Socket to destroy
     '''
     def stop_listening(self):
+        self.history.close()
         self.pub_socket.close()
-        self.rep_socket.close()
+        self.router_socket.close()
+        if self.replica_socket is not None:
+            self.replica_socket.close(linger=0)
+        if self.peer_socket is not None:
+            self.peer_socket.close()
+        if self.metrics_socket is not None:
+            self.metrics_socket.close()
         # print("Sockets closed")
         self.context.destroy()
         # print("Context destroyed")
-        self.hb_timer.cancel()
 
     '''
-    Function that adds the provided publisher to topics_dict
+    Function that returns the wire id of a topic, assigning a new one on first use
+    topic: Topic string
+    '''
+    def intern_topic(self, topic):
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            topic_id = len(self.topic_ids) + 1
+            self.topic_ids[topic] = topic_id
+            self.topic_names[topic_id] = topic
+            self.topic_frames[topic] = topic_envelope(topic)
+        return topic_id
+
+    '''
+    Function that returns the wire id of a client address, assigning a new one on first use
+    addr: Client address string
+    '''
+    def intern_addr(self, addr):
+        addr_id = self.addr_ids.get(addr)
+        if addr_id is None:
+            addr_id = len(self.addr_ids) + 1
+            self.addr_ids[addr] = addr_id
+            self.addr_names[addr_id] = addr
+        return addr_id
+
+    '''
+    Function that adds the provided publisher to the registry
     publisher_info: Information on the publisher
-    Publisher is of the form : (address, ownership_strength, history count, history list)
+    Publisher is of the form : (address, ownership_strength, history count)
     '''
     def add_publisher(self, publisher_info):
         # print(publisher_info)
         # Verify publisher is part of a registered client
         publisher_entry = self.hb_dict.get(publisher_info['addr'])
-        print("Publisher entry is :", publisher_entry)
         if publisher_entry is None:
             return False
 
+        # A client registering the same topic again replaces its earlier registration
         topic = publisher_info['topic']
-        publisher_entry['topics'].append(topic) # Add topic to heartbeat dict
-        publisher = {'addr': publisher_info['addr'],
-                     'ownStr': int(publisher_info['ownStr']),
-                     'history_cnt': int(publisher_info['history_cnt']),
-                     'history_deque': collections.deque(maxlen=publisher_info['history_cnt'])}
-        if topic in self.topics_dict:
-            self.topics_dict[topic].add(publisher)
+        self.registry.add(topic, publisher_info['addr'],
+                          int(publisher_info['ownStr']), int(publisher_info['history_cnt']),
+                          publisher_info.get('data_addr'))
+        publisher_entry['topics'].add(topic) # Add topic to heartbeat dict
+        self.history.set_capacity(topic, self.registry.max_history(topic))
+        self.announce_owner(topic)
+
+        return True
+
+    '''
+    Function that removes a disconnected publisher from the registry
+    publisher_addr: Address of the publisher that got disconnected
+    topic: Topic that the publisher was serving content for
+    '''
+    def remove_publisher(self, publisher_addr, topic):
+        hb_entry = self.hb_dict.get(publisher_addr)
+        if hb_entry is not None:
+            hb_entry['topics'].discard(topic)
+        if self.registry.remove(topic, publisher_addr) is not None:
+            self.history.set_capacity(topic, self.registry.max_history(topic))
+            self.announce_owner(topic)
+
+    '''
+    Function that adds a client's subscription to a wildcard pattern
+    '''
+    def add_pattern(self, pattern):
+        count = self.pattern_refs.get(pattern, 0)
+        self.pattern_refs[pattern] = count + 1
+        if count == 0:
+            self.patterns.add(pattern)
+            self.pattern_frames.clear()
+
+    '''
+    Function that removes a client's subscription to a wildcard pattern, and the pattern with the last one
+    '''
+    def release_pattern(self, pattern):
+        self.pattern_refs[pattern] -= 1
+        if self.pattern_refs[pattern] == 0:
+            del self.pattern_refs[pattern]
+            self.patterns.remove(pattern)
+            self.pattern_frames.clear()
+
+    '''
+    Function that returns the envelopes a topic's messages are sent on for wildcard subscriptions, one per
+    matching pattern. Matched through the trie on first use and cached
+    '''
+    def match_patterns(self, topic):
+        frames = self.pattern_frames.get(topic)
+        if frames is None:
+            frames = self.pattern_frames[topic] = [topic_envelope(pattern) + topic.encode()
+                                                   for pattern in self.patterns.match(topic)]
+        return frames
+
+    '''
+    Function that tells the subscribers of a topic where to receive it from, if its owner changed
+    Only topics whose owner publishes directly (registered with a data_addr) are announced, and topics
+    that had such an owner before, so that their subscribers go back to receiving them through the broker
+    topic: Topic whose publishers changed
+    '''
+    def announce_owner(self, topic):
+        # Direct publications never pass through the broker, so there are no samples to arbitrate on
+        # and a direct topic belongs to its strongest publisher
+        owner = self.registry.strongest(topic)
+        data_addr = None if owner is None else owner['data_addr']
+        announced = self.topic_owners.get(topic)
+        if announced is None and data_addr is None:
+            return
+        owner_id = 0 if data_addr is None else self.intern_addr(owner['addr'])
+        if announced == (owner_id, data_addr):
+            return
+        self.topic_owners[topic] = (owner_id, data_addr)
+        self.send_owner(topic)
+
+    '''
+    Function that sends the owner of a topic to its subscribers, on the topic itself
+    '''
+    def send_owner(self, topic):
+        owner_id, data_addr = self.topic_owners[topic]
+        self.pub_socket.send_multipart([self.topic_frames[topic],
+                                        encode_header(MSG_OWNER, 0, CODEC_NONE, self.topic_ids[topic], owner_id),
+                                        encode_body({'data_addr': data_addr})])
+
+    '''
+    Function that decodes a request into a dict
+    Topic and address ids from the header are resolved to their strings ('topic' and 'addr')
+    frames: Request frames, starting with the header
+    '''
+    def decode_request(self, frames):
+        msg_type, flags, codec, topic_id, addr_id, req_id = decode_header(frames[0])
+        msg_dict = {'type': msg_type_names.get(msg_type, 'unknown'), 'flags': flags, 'id': req_id,
+                    'topic': self.topic_names.get(topic_id), 'addr': self.addr_names.get(addr_id)}
+
+        # Publications carry content frames (zmq.Frame) that the broker passes along without
+        # decoding or copying. Everything else may carry one body frame with the remaining request fields
+        if msg_type == MSG_PUB or msg_type == MSG_PUB_BATCH:
+            msg_dict['codec'] = codec
+            msg_dict['contents'] = frames[1:]
+        elif len(frames) > 1:
+            msg_dict.update(decode_body(frames[1].buffer))
+        return msg_dict
+
+    '''
+    Function that sends a response back to the client that made a request
+    envelope: Routing frames received with the request (client identity and, for REQ clients, the empty delimiter)
+    request: The request being answered. Its 'id' is echoed so clients can match out of order replies
+    response: Response dict to send. 'type', 'result', 'topic_id' and 'addr_id' go into the header,
+              'frames' are appended as content frames and all other fields go into the body frame
+    '''
+    def reply(self, envelope, request, response):
+        start = time.perf_counter_ns()
+        body = dict(response)
+        msg_type = msg_type_ids.get(body.pop('type'), MSG_UNKNOWN)
+        flags = FLAG_RESULT if body.pop('result', False) else 0
+        header = encode_header(msg_type, flags, CODEC_NONE, body.pop('topic_id', 0),
+                               body.pop('addr_id', 0), request['id'])
+        frames = body.pop('frames', [])
+        if body or frames:
+            parts = envelope + [header, encode_body(body)] + frames
         else:
-            # Created new sorted list sorted by -x['ownStr'] (negative of ownership strength)
-            self.topics_dict[topic] = SortedListWithKey(key=lambda x: x['ownStr'])
-            self.topics_dict[topic].add(publisher)
+            parts = envelope + [header]
+        self.metrics.encode_ns += time.perf_counter_ns() - start
+        self.router_socket.send_multipart(parts, copy=False)
+
+    # Request handlers. Each one takes the request dict and returns the response dict
+    def handle_pub_reg(self, msg_dict):
+        # If new publisher registers, then add them to the registry appropriately
+        topic_id = self.intern_topic(msg_dict['topic'])
+        result = self.add_publisher(msg_dict)
+        response = {'type': 'pub_reg', 'result': result, 'topic_id': topic_id}
+
+        # Compression is agreed on at registration. The broker never decompresses, but it only accepts
+        # compressors registered with it, as its subscribers are set up the same way
+        compression = msg_dict.get('compression')
+        if result and compression is not None:
+            response['compression'] = compression if compression in compressors else None
+            # A dictionary whose id is taken by another one would be mixed up with it by subscribers
+            if response['compression'] is not None and msg_dict.get('dictionary') is not None:
+                if not self.add_dictionary(msg_dict['topic'], base64.b64decode(msg_dict['dictionary'])):
+                    response['compression'] = None
+        return response
 
+    '''
+    Function that keeps a compression dictionary of a topic, and announces it to the topic's subscribers
+    Announcements go out on the PUB socket ahead of any message compressed with the dictionary
+    Returns False if another dictionary, of any topic, has the same id
+    '''
+    def add_dictionary(self, topic, dictionary):
+        dictionary_id = dictionary_id_of(dictionary)
+        for known in self.topic_dictionaries.values():
+            if known.get(dictionary_id, dictionary) != dictionary:
+                return False
+        topic_dictionaries = self.topic_dictionaries.setdefault(topic, {})
+        if dictionary_id in topic_dictionaries:
+            return True
+        topic_dictionaries[dictionary_id] = dictionary
+        header = encode_header(MSG_DICTIONARY, 0, CODEC_NONE, self.topic_ids[topic])
+        for envelope in [self.topic_frames[topic]] + self.match_patterns(topic):
+            self.pub_socket.send_multipart([envelope, header, dictionary])
         return True
 
     '''
-    Function that searches for the best available publisher based on the requirements of the subscriber
-    topic: Topic that the subscriber wants to subscribe to
-    history_cnt (Optional): Minimum history that the subscriber is looking for
-    addr (Optional): Unique publisher address desired
-    '''
-    def find_publisher(self, topic, history_cnt=None, addr=None):
-        # print("topics_dict is: ",self.topics_dict)
-        # print("Hist count and topic are: ", history_cnt,topic)
-        if topic in self.topics_dict and len(self.topics_dict[topic]) > 0:
-            for publisher in self.topics_dict[topic]:
-                if history_cnt is not None:
-                    if publisher['history_cnt'] >= history_cnt:
-                        history_satisfied = True
-                    else:
-                        history_satisfied = False
-                else:
-                    history_satisfied = True
+    Function that returns the compression dictionaries of some topics, as base64 text for a response
+    '''
+    def encoded_dictionaries(self, topics):
+        return [base64.b64encode(dictionary).decode() for topic in topics
+                for dictionary in self.topic_dictionaries.get(topic, {}).values()]
 
-                if addr is not None:
-                    if publisher['addr'] == addr:
-                        addr_satisfied = True
-                    else:
-                        addr_satisfied = False
-                else:
-                    addr_satisfied = True
+    def handle_sub_reg(self, msg_dict):
+        if is_pattern(msg_dict['topic']):
+            return self.subscribe_pattern(msg_dict)
 
-                if history_satisfied and addr_satisfied:
-                    return publisher
+        response, history = self.subscribe_topic(msg_dict['topic'], msg_dict['history_cnt'])
+        if history is None:
+            return response
+        return self.send_history(msg_dict, response, history)
 
-        # Return None if no publishers for the topic, not enough history maintained, or incorrect address
-        return None
+    '''
+    Function that registers a subscriber of a topic (not a wildcard)
+    Returns the sub_reg response without the history, and the history (None if the topic has no publishers,
+    or the broker does not keep as much as the subscriber wants for the topic)
+    '''
+    def subscribe_topic(self, topic, history_cnt):
+        # Subscribers of a topic published directly learn its owner with the reply
+        topic_id = self.intern_topic(topic)
+        response = {'type': 'sub_reg', 'topic_id': topic_id}
+        if topic in self.topic_owners:
+            response['owner_id'], response['data_addr'] = self.topic_owners[topic]
+        if topic in self.topic_dictionaries:
+            response['dictionaries'] = self.encoded_dictionaries([topic])
+
+        # History comes from the topic's publishers, as a subscriber can only ask for what they keep
+        if not self.registry.has_publishers(topic) or history_cnt > self.history.capacity(topic):
+            return dict(response, result=False), None
+        return dict(response, result=True), self.history.get(topic, history_cnt)
+
+    def handle_reg_many(self, msg_dict):
+        # Registrations of many publishers ('pubs', with the fields of pub_reg requests) and subscribers ('subs',
+        # with the fields of sub_reg requests, no wildcards) of topics on this shard, answered with one reply.
+        # Each is handled like its own request, and the histories of all subscribers are sent together
+        # (in chunks if long), with the number of messages of each in its result's 'count'
+        pub_results = []
+        for values in msg_dict['pubs']:
+            response = self.handle_pub_reg(dict(msg_dict, **values))
+            del response['type']
+            pub_results.append(response)
+
+        sub_results = []
+        dictionaries = []
+        history = []
+        for values in msg_dict['subs']:
+            if is_pattern(values['topic']):
+                sub_results.append({'result': False, 'count': 0})
+                continue
+            response, sub_history = self.subscribe_topic(values['topic'], values['history_cnt'])
+            del response['type']
+            dictionaries += response.pop('dictionaries', [])
+            response['count'] = len(sub_history) if sub_history is not None else 0
+            history += sub_history or []
+            sub_results.append(response)
+
+        # Only the last chunk carries the results, as the lists of all chunks are joined by the client
+        response = self.send_history(msg_dict, {'type': 'reg_many', 'result': True}, history)
+        response.update(pubs=pub_results, subs=sub_results)
+        if dictionaries:
+            response['dictionaries'] = dictionaries
+        return response
 
     '''
-    Function that removes a disconnected publisher from the list of publishers
-    publisher_addr: Address of the publisher that got disconnected
-    topic: Topic that the publisher was serving content for
+    Function that registers a client's wildcard subscription
+    Returns the response with the last history_cnt messages of all matching topics together, in the order they
+    were forwarded, and the topic and forwarding time of each message in 'topics' and 'times'
+    msg_dict: The sub_reg request. Its topic is the pattern
     '''
-    def remove_publisher(self, publisher_addr, topic):
-        if topic in self.topics_dict and len(self.topics_dict[topic]) > 0:
-            lists = self.topics_dict[topic]
-            for i in range(len(lists)):
-                # Address should be unique, so this check is sufficient
-                if lists[i]['addr'] == publisher_addr:
-                    lists.pop(i)
-                    break
+    def subscribe_pattern(self, msg_dict):
+        pattern = msg_dict['topic']
+        try:
+            check_pattern(pattern)
+        except ValueError:
+            return {'type': 'sub_reg', 'result': False}
+        # Patterns are released when the client expires, so only registered clients may subscribe to them
+        hb_entry = self.hb_dict.get(msg_dict['addr'])
+        if hb_entry is None:
+            return {'type': 'sub_reg', 'result': False}
+        if pattern not in hb_entry['patterns']:
+            hb_entry['patterns'].add(pattern)
+            self.add_pattern(pattern)
+
+        # Each topic's history is in forwarding order already, so merging them is enough
+        history_cnt = msg_dict['history_cnt']
+        merged = []
+        if history_cnt > 0:
+            histories = [[(topic, entry) for entry in self.history.get_timed(topic, history_cnt)]
+                         for topic in self.history.last_seqs() if topic_matches(pattern, topic)]
+            merged = collections.deque(heapq.merge(*histories, key=lambda item: item[1][3]), maxlen=history_cnt)
+        response = {'type': 'sub_reg', 'result': True}
+        dictionaries = self.encoded_dictionaries([topic for topic in self.topic_dictionaries if topic_matches(pattern, topic)])
+        if dictionaries:
+            response['dictionaries'] = dictionaries
+        return self.send_history(msg_dict, response,
+                                 [entry for topic, entry in merged], [topic for topic, entry in merged])
+
+    def handle_replay(self, msg_dict):
+        # Messages of a topic from a sequence number onwards. The replay is complete (result True) unless
+        # some of the messages asked for are no longer kept
+        topic = msg_dict['topic']
+        from_seq = msg_dict['from_seq']
+        last_seq = self.topic_seqs.get(topic, 0)
+        history = self.history.get_from(topic, from_seq)
+        complete = from_seq > last_seq or (len(history) > 0 and history[0][0] <= from_seq)
+        response = {'type': 'replay', 'result': complete, 'topic_id': self.intern_topic(topic), 'last_seq': last_seq}
+        if topic in self.topic_dictionaries:
+            response['dictionaries'] = self.encoded_dictionaries([topic])
+        return self.send_history(msg_dict, response, history)
 
-    def run(self):
-        # TODO: How to terminate loop?
-        # Listen to incoming publisher and subscriber requests
-        while True:
-            msg_dict = self.rep_socket.recv_pyobj()
-            print(msg_dict)
-
-            # If new publisher registers, then add them to topics_dict appropriately
-            if msg_dict['type'] == 'pub_reg':
-                result = self.add_publisher(msg_dict)
-                response = {'type': 'pub_reg', 'result': result}
-                self.rep_socket.send_pyobj(response)
-                # print(self.topics_dict)
-
-            # If new subscriber registration received, try to find suitable publisher with desired history
-            elif msg_dict['type'] == 'sub_reg':
-                publisher = self.find_publisher(msg_dict['topic'], history_cnt=msg_dict['history_cnt'])
-                if publisher is not None:
-                    response = {'type': 'sub_reg', 'result': True, 'history': publisher['history_deque']}
-                    self.rep_socket.send_pyobj(response)  # encode() uses utf-8 encoding by default
-                else:
-                    response = {'type': 'sub_reg', 'result': False}
-                    self.rep_socket.send_pyobj(response)
-
-            # Received message to publish
-            elif msg_dict['type'] == 'pub':
-                # Find which publisher sent message
-                publisher = self.find_publisher(msg_dict['topic'], addr=msg_dict['addr'])
-
-                # If the publisher is valid (has up-to-date registration)
-                if publisher is not None:
-                    # Add to this publisher's history regardless of ownership strength
-                    publisher['history_deque'].append(msg_dict['content'])
-                    # print(self.topics_dict)
-
-                    # Only send publication to subs if this is the highest ownership publisher
-                    highestPub = (self.topics_dict.get(msg_dict['topic']))[0]
-                    # print("Highest pub: ",highestPub)
-                    if publisher['ownStr'] >= highestPub['ownStr']:
-                        self.pub_socket.send_string(msg_dict['topic'], zmq.SNDMORE)
-                        self.pub_socket.send_pyobj(msg_dict['content'])
-
-                    response = {'type': 'pub', 'result': True}
-                else:
-                    # Failed to find valid publisher
-                    response = {'type': 'pub', 'result': False}
-                self.rep_socket.send_pyobj(response)
-
-            # Shutdown message. Cleanup and shutdown broker
-            elif msg_dict['type'] == 'shutdown':
-                response = {'type': 'shutdown', 'result': True}
-                self.rep_socket.send_pyobj(response)
-                break
-
-            # Publisher has notified broker that it will no longer be publishing
-            elif msg_dict['type'] == 'disconnect':
-                self.remove_publisher(msg_dict['addr'], msg_dict['topic'])
-                self.rep_socket.send(b"ACK")
-
-            # New client registration request. Add to heartbeat dict
-            elif msg_dict['type'] == 'client_reg':
-                response = {'type': 'client_reg', 'result': True}
-                self.hb_dict[ msg_dict['addr'] ] = {'count': starting_heartbeat_count, 'topics': []}
-                self.rep_socket.send_pyobj(response)
-
-            # Response to heartbeat message
-            elif msg_dict['type'] == 'ping':
-                hb_entry = self.hb_dict.get(msg_dict['addr'])
-                if hb_entry is not None:
-                    self.hb_mutex.acquire()
-                    hb_entry['count'] = starting_heartbeat_count
-                    self.hb_mutex.release()
-                    response = {'type': 'ping', 'result': True}
+    '''
+    Function that sends history to a subscriber
+    Returns the response of the last chunk, for run() to send
+    History is sent as stored, one frame per message with the codec of each in the body and the
+    sequence number of the first message as 'seq'. Long histories are streamed in chunks of
+    history_chunk_msgs, all but the last marked 'more'
+    msg_dict: The request being answered
+    response: Fields of the response other than the history
+    history: List of (seq, codec, content), or of (seq, codec, content, time) if topics is given
+    topics: Topic of each message, for the history of a wildcard subscription. Sent in 'topics',
+            with the forwarding time of each message in 'times'
+    '''
+    def send_history(self, msg_dict, response, history, topics=None):
+        response = dict(response, seq=history[0][0] if history else 0)
+        start = 0
+        while len(history) - start > history_chunk_msgs:
+            self.reply(msg_dict['envelope'], msg_dict,
+                       dict(self.history_chunk(response, history, topics, start, start + history_chunk_msgs), more=True))
+            start += history_chunk_msgs
+        return self.history_chunk(response, history, topics, start, len(history))
+
+    '''
+    Function that returns the response carrying the messages of a history from index start up to end
+    '''
+    def history_chunk(self, response, history, topics, start, end):
+        chunk = history[start:end]
+        response = dict(response, codecs=[entry[1] for entry in chunk], frames=[entry[2] for entry in chunk])
+        if topics is not None:
+            response['topics'] = topics[start:end]
+            response['times'] = [entry[3] for entry in chunk]
+        return response
+
+    def handle_pub(self, msg_dict):
+        result = self.publish_contents(msg_dict)
+        return {'type': 'pub', 'result': result}
+
+    def handle_pub_batch(self, msg_dict):
+        result = self.publish_contents(msg_dict)
+
+        # Fire-and-forget batches get no reply at all
+        if not msg_dict['flags'] & FLAG_ACK:
+            return None
+        return {'type': 'pub_batch', 'result': result, 'count': len(msg_dict['contents'])}
+
+    '''
+    Function that stores and forwards published messages on behalf of a publisher
+    Returns False if the publisher has no up-to-date registration for the topic
+    msg_dict: The pub or pub_batch request. Its 'contents' are the encoded messages, in publication order,
+              all in content codec 'codec' (they are never decoded by the broker)
+    '''
+    def publish_contents(self, msg_dict):
+        topic = msg_dict['topic']
+        contents = msg_dict['contents']
+        # Find which publisher sent message, and the topic's owner
+        start = time.perf_counter_ns()
+        publisher = self.registry.get(topic, msg_dict['addr'])
+        self.metrics.lookup_ns += time.perf_counter_ns() - start
+
+        # Failed to find valid publisher (no up-to-date registration)
+        if publisher is None:
+            return False
+
+        # Only the owner's publications are sent to subs (see registry.py for how it is picked).
+        # The publisher's frame is forwarded as is, so the cost does not depend on the payload size.
+        # History holds what subscribers were sent. Every message is sent again for each matching
+        # wildcard pattern, on an envelope naming the pattern and the topic
+        owner = self.registry.owner(topic)
+        forwarded = self.registry.arbitrate(publisher, time.time(), self.ownership_deadline)
+        if forwarded and owner is not publisher:
+            self.metrics.ownership_changes += 1
+            logger.info('Publisher %s now owns topic %s', publisher['addr'], topic)
+        # A publisher that does not know whether it owns the topic is told, so the others hold back
+        if forwarded == bool(msg_dict['flags'] & FLAG_SUPPRESSED):
+            self.send_suppress(msg_dict['envelope'], topic, forwarded)
+
+        self.metrics.record_publish(topic, len(contents), sum(len(content) for content in contents), forwarded)
+        if forwarded:
+            codec = msg_dict['codec']
+            envelopes = [self.topic_frames[topic]] + self.match_patterns(topic)
+            topic_id = self.topic_ids[topic]
+            chunk_queue = self.chunk_queues.get(topic)
+            # Every forwarded message is numbered, so subscribers can tell when they missed one
+            first_seq = self.topic_seqs.get(topic, 0) + 1
+            for seq, content in enumerate(contents, first_seq):
+                # A standby sends nothing, so it has no chunks to take turns with
+                if chunk_queue is None and (len(content) <= self.chunk_bytes or not self.chunk_rate or not self.active):
+                    header = encode_header(MSG_PUB, 0, codec, topic_id, 0, seq)
+                    for envelope in envelopes:
+                        self.pub_socket.send_multipart([envelope, header, content], copy=False)
+                elif self.chunk_backlog and self.chunk_backlog + len(content) > self.chunk_rate * chunk_backlog_seconds:
+                    self.metrics.chunk_drops += 1
                 else:
-                    response = {'type': 'ping', 'result': False}
-                self.rep_socket.send_pyobj(response)
+                    if chunk_queue is None:
+                        chunk_queue = self.chunk_queues[topic] = collections.deque()
+                    chunk_queue.append([envelopes, codec, topic_id, seq, content, 0])
+                    self.chunk_backlog += len(content)
+            self.topic_seqs[topic] = first_seq + len(contents) - 1
+            self.history.append(topic, codec, contents, first_seq, time.time())
+
+        return True
 
+    '''
+    Function that tells a publisher whether it owns a topic. A publisher that does not sends only one
+    sample every sample_interval_ms, which keeps it in the running to take over
+    envelope: Routing frames of the publisher's client
+    topic: Topic the publisher published on
+    owner: Whether the publisher owns the topic
+    '''
+    def send_suppress(self, envelope, topic, owner):
+        owner_entry = self.registry.owner(topic)
+        response = {'type': 'suppress', 'result': owner, 'topic_id': self.topic_ids[topic],
+                    'addr_id': self.addr_ids.get(owner_entry['addr'], 0) if owner_entry is not None else 0}
+        if not owner:
+            response['sample_interval_ms'] = self.ownership_deadline * 1000 / 2
+        self.reply(envelope, {'id': 0}, response)
+
+    '''
+    Function that sends the next chunk of the oldest message still being sent on every topic, and sets
+    when the next ones may go out
+    Chunks are slices of the stored content, sent without copying. All but the last are flagged
+    FLAG_MORE and all but the first FLAG_CHUNK, and every chunk carries the message's sequence number
+    '''
+    def send_chunks(self, now):
+        sent = 0
+        for topic, chunk_queue in list(self.chunk_queues.items()):
+            message = chunk_queue[0]
+            envelopes, codec, topic_id, seq, content, offset = message
+            end = offset + self.chunk_bytes
+            flags = (FLAG_CHUNK if offset else 0) | (FLAG_MORE if end < len(content) else 0)
+            header = encode_header(MSG_PUB, flags, codec, topic_id, 0, seq)
+            chunk = content if not flags else memoryview(content)[offset:end]
+            for envelope in envelopes:
+                self.pub_socket.send_multipart([envelope, header, chunk], copy=False)
+            sent += len(chunk) * len(envelopes)
+            self.chunk_backlog -= len(chunk)
+            message[5] = end
+            if end >= len(content):
+                chunk_queue.popleft()
+                if not chunk_queue:
+                    del self.chunk_queues[topic]
+        self.next_chunk_time = now + sent / self.chunk_rate
+
+    def handle_shutdown(self, msg_dict):
+        # Cleanup and shutdown broker once the reply has gone out
+        self.running = False
+        return {'type': 'shutdown', 'result': True}
+
+    def handle_disconnect(self, msg_dict):
+        # Publisher has notified broker that it will no longer be publishing
+        self.remove_publisher(msg_dict['addr'], msg_dict['topic'])
+        return {'type': 'disconnect', 'result': True}
+
+    def handle_client_reg(self, msg_dict):
+        # New client registration request. Add to heartbeat dict (a client registering again keeps its publishers)
+        addr = msg_dict['addr']
+        deadline = time.time() + self.client_timeout
+        if addr in self.hb_dict:
+            self.hb_dict[addr]['deadline'] = deadline
+        else:
+            self.hb_dict[addr] = {'deadline': deadline, 'topics': set(), 'patterns': set()}
+            self.expiry_wheel.schedule(addr, deadline)
+        return {'type': 'client_reg', 'result': True, 'addr_id': self.intern_addr(msg_dict['addr'])}
+
+    def handle_ping(self, msg_dict):
+        # Response to heartbeat message. run() has already refreshed the client.
+        # Subscribers that dropped messages since their last ping report their totals
+        hb_entry = self.hb_dict.get(msg_dict['addr'])
+        if hb_entry is not None and 'dropped' in msg_dict:
+            if msg_dict['disconnected'] and not hb_entry.get('drops', {}).get('disconnected'):
+                logger.info('Subscriber %s disconnected as a slow consumer', msg_dict['addr'])
+            hb_entry['drops'] = {key: msg_dict[key] for key in ('dropped', 'lost', 'disconnected')}
+
+        # Clients answer heartbeats with one-way pings, which get no reply
+        if not msg_dict['flags'] & FLAG_ACK:
+            return None
+        return {'type': 'ping', 'result': msg_dict['addr'] in self.hb_dict}
+
+    '''
+    Function that handles one request read from the ROUTER socket and sends its reply
+    frames: Frames of the request, as received
+    '''
+    def handle_request(self, frames):
+        # Routing envelope is the client identity, plus an empty delimiter for REQ clients.
+        # The request header follows, then the body or content frames
+        start = time.perf_counter_ns()
+        split = 2 if len(frames) > 2 and len(frames[1]) == 0 else 1
+        envelope, msg_dict = frames[:split], self.decode_request(frames[split:])
+        self.metrics.decode_ns += time.perf_counter_ns() - start
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', msg_dict)
+        # Handlers that send more than one reply (or reply later) route them with the envelope
+        msg_dict['envelope'] = envelope
+        if msg_dict['addr'] is not None:
+            self.refresh_client(msg_dict['addr'], time.time())
+
+        # The standby applies the request as it was received, before its reply goes out
+        repl_seq = None
+        if self.standby_attached and msg_dict['type'] not in unreplicated_requests:
+            repl_seq = self.replicate(REPL_REQUEST, frames)
+
+        handler = self.handlers.get(msg_dict.get('type'))
+        if handler is None:
             # Unknown message type
+            response = {'type': 'unknown', 'result': False}
+        else:
+            response = handler(msg_dict)
+
+        if response is not None:
+            if repl_seq is not None and self.standby_attached:
+                self.held_replies.append((repl_seq, envelope, msg_dict, response))
             else:
-                response = {'type': 'unknown', 'result': False}
-                self.rep_socket.send_pyobj(response)
+                self.reply(envelope, msg_dict, response)
+        self.metrics.record_request(msg_dict['type'], time.perf_counter_ns() - start)
+
+    def serve_metrics(self):
+        self.metrics_socket.recv()
+        self.metrics_socket.send(encode_json(self.metrics.snapshot(self)))
+
+    # Functions for high availability
+    '''
+    Function that sends a record to the standby
+    Returns the number of the record
+    kind: One of the REPL_* record types
+    frames: Frames of the record after its number
+    '''
+    def replicate(self, kind, frames):
+        self.repl_seq += 1
+        try:
+            self.replica_socket.send_multipart([kind, REPL_SEQ.pack(self.repl_seq)] + list(frames), zmq.NOBLOCK, copy=False)
+        except zmq.error.Again:
+            self.detach_standby('replication link full')
+        return self.repl_seq
+
+    '''
+    Function that stops replicating to the standby and sends the replies waiting for it
+    '''
+    def detach_standby(self, reason):
+        logger.warning('Standby broker detached: %s', reason)
+        self.standby_attached = False
+        self.release_replies(self.repl_seq)
+
+    '''
+    Function that sends the held replies to the requests the standby has applied
+    acked_seq: Number of the last record the standby applied
+    '''
+    def release_replies(self, acked_seq):
+        while self.held_replies and self.held_replies[0][0] <= acked_seq:
+            repl_seq, envelope, request, response = self.held_replies.popleft()
+            self.reply(envelope, request, response)
 
-        # End while. Shutdown broker.
+    '''
+    Function that handles the messages of the standby on the replication link
+    A standby asking to sync, or acknowledging records while it is not attached (it missed some, or the
+    primary restarted), is sent a snapshot of the whole state
+    '''
+    def handle_replica_messages(self):
+        for _ in range(broker_burst):
+            try:
+                frames = self.replica_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+            self.standby_seen = time.time()
+            if frames[0] == REPL_SYNC or not self.standby_attached:
+                self.send_snapshot()
+            elif frames[0] == REPL_ACK:
+                self.release_replies(REPL_SEQ.unpack(frames[1])[0])
+
+    '''
+    Function that sends the standby the whole state of the broker, and attaches it
+    '''
+    def send_snapshot(self):
+        logger.info('Sending a snapshot to the standby broker')
+        now = time.time()
+        state = {'epoch': self.epoch,
+                 'topics': [self.topic_names[topic_id] for topic_id in range(1, len(self.topic_names) + 1)],
+                 'addrs': [self.addr_names[addr_id] for addr_id in range(1, len(self.addr_names) + 1)],
+                 'clients': {addr: [sorted(entry['topics']), sorted(entry['patterns'])] for addr, entry in self.hb_dict.items()},
+                 # The time of a publisher's last sample is sent as its age, as the clocks of the brokers may differ
+                 'publishers': [[publisher['topic'], publisher['addr'], publisher['ownStr'], publisher['history_cnt'],
+                                 publisher['data_addr'],
+                                 None if publisher['last_sample'] is None else now - publisher['last_sample'],
+                                 self.registry.owner(publisher['topic']) is publisher]
+                                for publisher in self.registry.all_publishers()],
+                 'topic_seqs': self.topic_seqs,
+                 'topic_owners': self.topic_owners,
+                 'dictionaries': {topic: self.encoded_dictionaries([topic]) for topic in self.topic_dictionaries},
+                 'history': []}
+        # History goes along as content frames, described in the state as [topic, capacity, [[seq, codec, time]...]]
+        contents = []
+        for topic in self.history.last_seqs():
+            capacity = self.history.capacity(topic)
+            entries = self.history.get_timed(topic, capacity)
+            state['history'].append([topic, capacity, [[seq, codec, sent] for seq, codec, content, sent in entries]])
+            contents.extend(content for seq, codec, content, sent in entries)
+        self.standby_attached = True
+        self.replicate(REPL_SNAPSHOT, [encode_body(state)] + contents)
+
+    '''
+    Function that replaces the state of a standby with the primary's snapshot
+    state: The decoded state of the snapshot
+    contents: History contents of the snapshot
+    '''
+    def load_snapshot(self, state, contents):
+        self.topic_ids, self.topic_names, self.topic_frames = {}, {}, {}
+        self.addr_ids, self.addr_names = {}, {}
+        for topic in state['topics']:
+            self.intern_topic(topic)
+        for addr in state['addrs']:
+            self.intern_addr(addr)
+
+        self.patterns, self.pattern_refs, self.pattern_frames = TopicTrie(), {}, {}
+        self.hb_dict = {}
+        now = time.time()
+        for addr, (topics, patterns) in state['clients'].items():
+            self.hb_dict[addr] = {'deadline': now + self.client_timeout, 'topics': set(topics), 'patterns': set(patterns)}
+            for pattern in patterns:
+                self.add_pattern(pattern)
+
+        # Publishers are added in registration order, so strength ties are broken as on the primary.
+        # Each topic keeps the owner arbitrated by the primary, and the publishers the times of their last samples
+        self.registry = PublisherRegistry()
+        for topic, addr, ownStr, history_cnt, data_addr, sample_age, owner in state['publishers']:
+            publisher = self.registry.add(topic, addr, ownStr, history_cnt, data_addr)
+            if sample_age is not None:
+                publisher['last_sample'] = now - sample_age
+            if owner:
+                self.registry.set_owner(publisher)
+        self.topic_owners = {topic: tuple(owner) for topic, owner in state['topic_owners'].items()}
+        self.topic_seqs = dict(state['topic_seqs'])
+        self.topic_dictionaries = {}
+        for topic, encoded in state['dictionaries'].items():
+            for dictionary in encoded:
+                self.add_dictionary(topic, base64.b64decode(dictionary))
+
+        # History is rebuilt from the snapshot. A durable log keeps its own messages where they continue the primary's
+        for topic in list(self.history.last_seqs()):
+            self.history.set_capacity(topic, 0)
+        for topic in self.registry.topics:
+            self.history.set_capacity(topic, self.registry.max_history(topic))
+        contents = iter(contents)
+        for topic, capacity, entries in state['history']:
+            self.history.set_capacity(topic, capacity)
+            for seq, codec, sent in entries:
+                self.history.append(topic, codec, [next(contents)], seq, sent)
+        self.primary_epoch = state['epoch']
+
+    '''
+    Function that applies a record received from the primary
+    Asks for a snapshot when records are missing or the primary restarted
+    '''
+    def apply_record(self, frames):
+        kind = frames[0].bytes
+        if kind == REPL_HEARTBEAT:
+            if self.synced and frames[1].bytes.decode() != self.primary_epoch:
+                logger.info('Primary broker restarted, syncing again')
+                self.request_sync()
+            return
+        repl_seq = REPL_SEQ.unpack(frames[1].buffer)[0]
+        if kind == REPL_SNAPSHOT:
+            self.load_snapshot(decode_body(frames[2].buffer), frames[3:])
+            self.repl_seq = repl_seq
+            self.synced = True
+            logger.info('Standby broker synced with the primary')
+            return
+        if not self.synced:
+            return
+        if repl_seq != self.repl_seq + 1:
+            logger.warning('Standby broker missed records of the primary, syncing again')
+            self.request_sync()
+            return
+        self.repl_seq = repl_seq
+        if kind == REPL_REQUEST:
+            self.handle_request(frames[2:])
+        elif kind == REPL_EVICT and frames[2].bytes.decode() in self.hb_dict:
+            self.evict_client(frames[2].bytes.decode())
+
+    def request_sync(self):
+        self.synced = False
+        self.send_to_primary([REPL_SYNC])
+
+    def send_ack(self):
+        self.send_to_primary([REPL_ACK, REPL_SEQ.pack(self.repl_seq)])
+
+    '''
+    Function that sends a message to the primary, dropping it if the replication link is not connected
+    '''
+    def send_to_primary(self, frames):
+        try:
+            self.replica_socket.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.error.Again:
+            pass
+
+    '''
+    Function that runs a standby until it takes over or is shut down along with its primary
+    Records of the primary are applied as they arrive and acknowledged after every burst, and at least
+    once per heartbeat interval. The standby takes over once the primary has been silent for
+    failover_timeout_ms, if it holds the primary's state
+    '''
+    def follow_primary(self):
+        poller = zmq.Poller()
+        poller.register(self.replica_socket, zmq.POLLIN)
+
+        self.primary_seen = time.time()
+        next_ack_time = next_sync_time = self.primary_seen
+        while self.running:
+            now = time.time()
+            if self.synced and now - self.primary_seen >= self.failover_timeout:
+                self.promote()
+                return
+            if not self.synced and now >= next_sync_time:
+                self.request_sync()
+                next_sync_time = now + self.failover_timeout
+            if now >= next_ack_time:
+                self.send_ack()
+                next_ack_time = now + heartbeat_interval_ms / 1000
+            sync_time = self.history.sync(now)
+
+            timeout = min(next_ack_time, self.primary_seen + self.failover_timeout, sync_time or float('inf')) - now
+            events = dict(poller.poll(max(0, timeout * 1000)))
+
+            if self.replica_socket in events:
+                for _ in range(broker_burst):
+                    try:
+                        frames = self.replica_socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.error.Again:
+                        break
+                    self.primary_seen = time.time()
+                    self.apply_record(frames)
+                    if not self.running:
+                        break
+                self.send_ack()
+
+    '''
+    Function that makes a standby the active broker: it binds the client sockets and gives every client
+    a full timeout to find it
+    '''
+    def promote(self):
+        logger.warning('Primary broker silent for %d ms, standby taking over', self.failover_timeout * 1000)
+        self.replica_socket.close(linger=0)
+        self.replica_socket = None
+        self.active = True
+        now = time.time()
+        self.expiry_wheel = TimerWheel(expiry_tick_ms, len(self.expiry_wheel.slots), now)
+        for addr, hb_entry in self.hb_dict.items():
+            hb_entry['deadline'] = now + self.client_timeout
+            self.expiry_wheel.schedule(addr, hb_entry['deadline'])
+        self.repl_seq = 0
+        self.bind_sockets()
+
+    def run(self):
+        self.running = True
+        if not self.active:
+            self.follow_primary()
+
+        poller = zmq.Poller()
+        poller.register(self.router_socket, zmq.POLLIN)
+        if self.metrics_socket is not None:
+            poller.register(self.metrics_socket, zmq.POLLIN)
+        if self.replica_socket is not None:
+            poller.register(self.replica_socket, zmq.POLLIN)
+        if self.peer_socket is not None:
+            poller.register(self.peer_socket, zmq.POLLIN)
+
+        # Listen to incoming publisher and subscriber requests.
+        # Heartbeats and client expiry are driven from this loop, so all broker state has a single owner
+        while self.running:
+            now = time.time()
+            if now >= self.next_hb_time:
+                self.send_hb()
+            self.expire_clients(now)
+            sync_time = self.history.sync(now)
+            if self.next_metrics_time is not None and now >= self.next_metrics_time:
+                logger.info('Broker metrics %s', json.dumps(self.metrics.snapshot(self)))
+                self.next_metrics_time = now + self.metrics_interval
+            if self.standby_attached and now - self.standby_seen >= self.failover_timeout:
+                self.detach_standby('silent for %d ms' % (self.failover_timeout * 1000))
+
+            # Wait for a request until the next heartbeat, expiry tick, history sync or metrics dump is due.
+            # Chunks of large messages go out between bursts of requests, without waiting
+            timeout = min(self.next_hb_time, self.expiry_wheel.next_tick_time(),
+                          sync_time or float('inf'), self.next_metrics_time or float('inf')) - now
+            if self.chunk_queues:
+                if now >= self.next_chunk_time:
+                    self.send_chunks(now)
+                timeout = min(timeout, self.next_chunk_time - now)
+            events = dict(poller.poll(max(0, timeout * 1000)))
+
+            if self.metrics_socket in events:
+                self.serve_metrics()
+
+            if self.replica_socket in events:
+                self.handle_replica_messages()
+
+            if self.peer_socket in events:
+                self.handle_peer_messages()
+
+            if self.router_socket in events:
+                # Read the requests that are already waiting, up to broker_burst of them.
+                # How many there were is the depth of the broker's request queue
+                depth = 0
+                while self.running and depth < broker_burst:
+                    try:
+                        frames = self.router_socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.error.Again:
+                        break
+                    depth += 1
+                    self.handle_request(frames)
+                self.metrics.record_queue_depth(depth)
+
+        # End while. Shutdown broker. A shutdown reached the standby too, so its reply need not wait
+        self.release_replies(self.repl_seq)
+        while self.chunk_queues:
+            self.send_chunks(time.time())
         self.stop_listening()
 
 
@@ -282,37 +1265,298 @@ def get_ip():
     return IP
 
 
+'''
+Function that returns a Future resolved with fn(result) once the given Future is resolved
+'''
+def chain_future(future, fn):
+    chained = Future()
+
+    def resolve(done):
+        try:
+            chained.set_result(fn(done.result()))
+        except Exception as error:
+            chained.set_exception(error)
+
+    future.add_done_callback(resolve)
+    return chained
+
+
+'''
+Function that returns a Future resolved with the list of results of the given Futures once all of them are resolved
+'''
+def gather_futures(futures):
+    gathered = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def resolve(done):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            gathered.set_result([future.result() for future in futures])
+        except Exception as error:
+            gathered.set_exception(error)
+
+    for future in futures:
+        future.add_done_callback(resolve)
+    return gathered
+
+
+# Response to a publication dropped by the client because another publisher owns the topic
+suppressed_response = {'type': 'pub', 'result': True, 'suppressed': True}
+
+
 class Client:
     def __init__(self,
                  req_addr = client_connect_req_address,
                  sub_addr = client_connect_sub_address,
-                 ip = get_ip()):
+                 ip = None,
+                 batch_max_msgs = default_batch_max_msgs,
+                 batch_max_bytes = default_batch_max_bytes,
+                 batch_linger_ms = default_batch_linger_ms,
+                 batch_acks = False,
+                 sub_hwm = default_sub_hwm,
+                 slow_consumer_policy = 'drop_oldest',
+                 data_addr = None,
+                 standby_req_addr = None,
+                 standby_sub_addr = None,
+                 request_timeout_ms = default_request_timeout_ms,
+                 request_retries = default_request_retries):
         self.sub_addr = sub_addr
         self.req_addr = req_addr
-        self.ip = ip
+        # Address the client registers with, found when the client is created rather than when the module is imported
+        self.ip = ip if ip is not None else get_ip()
+
+        # Given a data_addr, the client binds its own PUB socket there and its publishers send straight to
+        # their subscribers, with the broker only handling registration, ownership and liveness.
+        # Subscribers connect to this address, so it must be one they can reach
+        self.data_addr = data_addr
+
+        # Next sequence number of each topic published directly
+        self.direct_seqs = {}
+
+        # A sharded broker is given as a list of addresses, one per shard (see sharding.py).
+        # Each topic lives on the shard picked by consistent hashing and all of its requests go there
+        self.req_addrs = [req_addr] if isinstance(req_addr, str) else list(req_addr)
+        self.sub_addrs = [sub_addr] if isinstance(sub_addr, str) else list(sub_addr)
+        self.ring = HashRing(len(self.req_addrs))
+        self.topic_shards = {}
+
+        # Brokers with a standby (see Broker) are given its addresses as well, in the same form as req_addr and
+        # sub_addr. Requests go to one endpoint of each shard at a time, and move on to the next one when a
+        # request goes unanswered for request_timeout_ms. Publications are received from all endpoints
+        self.req_endpoints = [[addr] for addr in self.req_addrs]
+        if standby_req_addr is not None:
+            standby_req_addrs = [standby_req_addr] if isinstance(standby_req_addr, str) else list(standby_req_addr)
+            for endpoints, addr in zip(self.req_endpoints, standby_req_addrs):
+                endpoints.append(addr)
+        if standby_sub_addr is not None:
+            self.sub_addrs += [standby_sub_addr] if isinstance(standby_sub_addr, str) else list(standby_sub_addr)
+        self.active_endpoints = [0] * len(self.req_addrs)
+        self.request_timeout = request_timeout_ms / 1000
+        self.request_retries = request_retries
+
+        # Non-blocking publishes are coalesced per topic until a batch holds batch_max_msgs
+        # messages or batch_max_bytes bytes, or its oldest message is batch_linger_ms old.
+        # With batch_acks, every batch is acknowledged and publish() returns a Future for it
+        self.batch_max_msgs = batch_max_msgs
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_linger_ms = batch_linger_ms
+        self.batch_acks = batch_acks
+
+        # Wire ids assigned by each shard to this client, and to the topics it has registered
+        self.addr_ids = [0] * len(self.req_addrs)
+        self.topic_ids = {}
+
+        # Topics this client publishes, by (shard, topic id). The broker tells a publisher when another one
+        # owns its topic, and the client then sends only one sample every sample interval (seconds) of the
+        # topic in suppressed_topics, at the times in next_samples, until the broker hands the topic over
+        self.publisher_topics = {}
+        self.suppressed_topics = {}
+        self.next_samples = {}
+
+        # Compression agreed with the broker for the topics this client publishes, as (compressor, dictionary id)
+        self.topic_compression = {}
+
+        # Chunks received so far of the large message being received on each topic envelope, as (seq, chunks)
+        self.partial_publications = {}
+
+        # Futures of outstanding requests and acknowledged publishes, by request id. Ids come from
+        # one counter shared by the API threads and the I/O thread, so they are never reused
+        self.futures = {}
+        self.req_ids = itertools.count(1)
+
+        # Publications received by the I/O thread, waiting for notify()/poll(). One queue per topic
+        # envelope, holding (arrival number, frames) so poll() can return the oldest across topics
+        self.sub_queues = {}
+        self.sub_arrivals = itertools.count()
+        self.sub_cond = threading.Condition()
+
+        # At most sub_hwm messages are queued (0 for no limit), so a slow application cannot make the client grow
+        # without bound. When the queues are full, slow_consumer_policy decides: 'drop_oldest' drops the oldest
+        # queued message, 'drop_newest' the one that arrived, and 'disconnect' drops everything queued and
+        # unsubscribes from every topic until the next register_sub() or replay()
+        if slow_consumer_policy not in slow_consumer_policies:
+            raise ValueError('slow_consumer_policy must be one of %s' % (slow_consumer_policies,))
+        self.sub_hwm = sub_hwm
+        self.slow_consumer_policy = slow_consumer_policy
+        self.sub_queued = 0
+
+        # Messages dropped by the policy, messages that never arrived (gaps in the sequence numbers of a topic,
+        # dropped by the broker for this subscriber) and whether the client was disconnected.
+        # Reported to the broker in the pings that answer its heartbeats (see sub_stats())
+        self.sub_drops = {'dropped': 0, 'lost': 0, 'disconnected': False}
+
+        # Sequence number of the last message returned by notify()/poll(), by topic
+        self.delivered_seqs = {}
+
+        # Function called by the I/O thread with the envelope of every message it queues for notify()/poll(),
+        # or with None when it drops the queued messages (see AsyncClient in async_client.py)
+        self.publication_listener = None
+
         self.context = zmq.Context()
-        self.req_socket = self.context.socket(zmq.REQ)
+        # DEALER rather than REQ so requests can be pipelined. Every request carries an 'id'
+        # that the broker echoes back, and replies are matched to requests by that id
+        self.req_sockets = [self.context.socket(zmq.DEALER) for _ in self.req_addrs]
+        # Heartbeats are answered with one-way pings over their own connection, so they never
+        # queue behind (or hold up) publications. Pings go to every endpoint of the shard, so whichever
+        # broker is active keeps the client alive
+        self.ping_sockets = [[self.context.socket(zmq.DEALER) for _ in endpoints] for endpoints in self.req_endpoints]
         self.sub_socket = self.context.socket(zmq.SUB)
-
-        # Connect sockets to broker
-        print('Client connecting req socket to ', self.req_addr)
-        self.req_socket.connect(self.req_addr)
-        print('Client connecting sub socket to ', self.sub_addr)
-        self.sub_socket.connect(self.sub_addr)
+        self.data_socket = None
+        if self.data_addr is not None:
+            logger.info('Client binding data socket to %s', self.data_addr)
+            self.data_socket = self.context.socket(zmq.PUB)
+            self.data_socket.bind(self.data_addr)
+
+        # The sockets above belong to the I/O thread. API calls reach it through this inproc pipe, which any
+        # other thread may use while holding cmd_lock. The I/O thread drains the pipe, so it never sends on it
+        self.cmd_socket = self.context.socket(zmq.PULL)
+        self.cmd_socket.bind("inproc://client-cmd")
+        self.cmd_push = self.context.socket(zmq.PUSH)
+        self.cmd_push.connect("inproc://client-cmd")
+        self.cmd_lock = threading.Lock()
+
+        # Connect sockets to broker. One SUB socket receives the publications of every shard
+        for req_socket, ping_sockets, endpoints in zip(self.req_sockets, self.ping_sockets, self.req_endpoints):
+            logger.info('Client connecting req socket to %s', endpoints[0])
+            req_socket.connect(endpoints[0])
+            for ping_socket, endpoint in zip(ping_sockets, endpoints):
+                # Only the latest pings matter, so few wait for a broker that is not there
+                ping_socket.setsockopt(zmq.SNDHWM, starting_heartbeat_count)
+                ping_socket.connect(endpoint)
+        for sub_addr in self.sub_addrs:
+            logger.info('Client connecting sub socket to %s', sub_addr)
+            self.sub_socket.connect(sub_addr)
 
         # Subscribe to standard messages
-        self.sub_socket.setsockopt_string(zmq.SUBSCRIBE, "BROKER_CMD")
+        self.sub_socket.setsockopt(zmq.SUBSCRIBE, broker_cmd_topic)
 
-        # Send ping to broker
-        reg_msg = {'type': 'client_reg', 'addr': self.ip}
-        self.req_socket.send_pyobj(reg_msg)
+        self.io_thread = threading.Thread(target=self.run_io, daemon=True)
+        self.io_thread.start()
 
-        # Wait for broker response
-        reg_response = self.req_socket.recv_pyobj()
-        if reg_response['type'] == 'client_reg' and reg_response['result'] is True:
-            print('Client init successful')
-        else:
-            print('Client init failed')
+        # Register with every shard without waiting, so creating a client costs no round trip to the broker.
+        # Requests wait for the registration with their shard when they need its address id (see shard_addr_id()).
+        # A registration that failed is sent again by the next request, under reg_lock
+        self.reg_lock = threading.Lock()
+        self.registrations = [self.send_client_reg(shard) for shard in range(len(self.req_addrs))]
+
+    '''
+    Function that registers the client with a shard without waiting for it
+    Returns a Future resolved with whether the registration succeeded
+    '''
+    def send_client_reg(self, shard):
+        return chain_future(self.send_request(MSG_CLIENT_REG, body={'addr': self.ip}, shard=shard),
+                            lambda response: self.registered_client(shard, response))
+
+    '''
+    Function that keeps the address id a shard assigned to this client when it registered
+    Returns whether the registration succeeded
+    '''
+    def registered_client(self, shard, response):
+        if response['type'] == 'client_reg' and response['result'] is True:
+            self.addr_ids[shard] = response['addr_id']
+            logger.info('Client init successful')
+            return True
+        logger.warning('Client init failed')
+        return False
+
+    '''
+    Function that returns the address id a shard assigned to this client, waiting for the registration
+    with the shard if it has not been answered yet, and registering again if it failed (e.g. the broker
+    was not up yet). Only called by API threads, never by the I/O thread
+    Raises TimeoutError if the shard does not answer the registration
+    '''
+    def shard_addr_id(self, shard):
+        addr_id = self.addr_ids[shard]
+        if addr_id == 0:
+            with self.reg_lock:
+                registration = self.registrations[shard]
+                if registration.done() and (registration.exception() is not None or not registration.result()):
+                    registration = self.registrations[shard] = self.send_client_reg(shard)
+            registration.result()
+            addr_id = self.addr_ids[shard]
+        return addr_id
+
+    '''
+    Function that hands a command to the I/O thread. Never called on the I/O thread itself, which would
+    wait forever on a full pipe (or on cmd_lock, held by a thread waiting on the full pipe)
+    frames: Command frames, starting with one of the CMD_* values
+    '''
+    def send_command(self, frames):
+        with self.cmd_lock:
+            self.cmd_push.send_multipart(frames, copy=False)
+
+    '''
+    Function that returns the broker shard a topic lives on
+    '''
+    def topic_shard(self, topic):
+        shard = self.topic_shards.get(topic)
+        if shard is None:
+            shard = self.topic_shards[topic] = self.ring.shard_for(topic)
+        return shard
+
+    '''
+    Function that sends a request to the broker without waiting for the reply
+    Returns a Future that is resolved with the broker's response
+    msg_type: Message type (MSG_* from codec)
+    topic_id: Wire id of the topic the request is about, if any
+    body: Dict of additional request fields, if any
+    frames: Content frames, if any
+    codec: Content codec of the frames
+    shard: Broker shard to send the request to (the shard of the topic, for topic requests)
+    flags: Header flags besides FLAG_ACK
+    '''
+    def send_request(self, msg_type, topic_id=0, body=None, frames=(), codec=CODEC_NONE, shard=0, flags=0):
+        # Waits for the client's registration with the shard first, so a failed one leaves no Future behind
+        addr_id = 0 if msg_type == MSG_CLIENT_REG else self.shard_addr_id(shard)
+        req_id = next(self.req_ids)
+        future = Future()
+        self.futures[req_id] = future
+        parts = [CMD_SEND, SHARD_INFO.pack(shard), encode_header(msg_type, FLAG_ACK | flags, codec, topic_id, addr_id, req_id)]
+        if body is not None:
+            parts.append(encode_body(body))
+        parts.extend(frames)
+        # Content frames are passed on without copying (pyzmq still copies those below its copy threshold)
+        self.send_command(parts)
+        return future
+
+    '''
+    Function that sends a request to the broker and blocks until it is answered
+    Takes the same arguments as send_request()
+    '''
+    def request(self, msg_type, topic_id=0, body=None, frames=(), codec=CODEC_NONE, shard=0):
+        return self.send_request(msg_type, topic_id, body, frames, codec, shard).result()
+
+    '''
+    Function that closes the client. Pending batches are sent first
+    '''
+    def close(self):
+        self.send_command([CMD_STOP])
+        self.io_thread.join()
+        self.context.destroy(linger=heartbeat_interval_ms)
 
 
     # Wrapper functions that are useful for the publishers
@@ -324,108 +1568,1091 @@ class Client:
     topic: Topic that the publisher is pushing content for
     ownership_strength: The ownership strength of the publisher (default value is 0)
     history: The amount of history that the publisher maintains (default value is 0)
+    compression: Name of a compressor from codec.py (e.g. 'zlib') to compress every message of the topic
+                 with, if the broker accepts it. The response's 'compression' is the one agreed on (None if declined)
+    dictionary: Optional bytes holding content typical of the topic's messages, which makes small messages
+                compress well. The broker hands it to the topic's subscribers
     Broker receives values in the following form: address,topic,ownership_strength,history (csv)
     '''
-    def register_pub(self, topic, ownership_strength = 0, history = 0):
-        print("Registering publisher with broker")
-        values = {'type': 'pub_reg', 'addr': self.ip, 'topic': topic, 'ownStr': ownership_strength, 'history_cnt': history}
-        self.req_socket.send_pyobj(values)
-        response = self.req_socket.recv_pyobj()
+    def register_pub(self, topic, ownership_strength = 0, history = 0, compression = None, dictionary = None):
+        return self.send_register_pub(topic, ownership_strength, history, compression, dictionary).result()
+
+    '''
+    Function that registers a publisher without waiting for the broker
+    Returns a Future resolved with the broker's response. Takes the same arguments as register_pub()
+    '''
+    def send_register_pub(self, topic, ownership_strength = 0, history = 0, compression = None, dictionary = None):
+        logger.info('Registering publisher with broker')
+        values, dictionary_id = self.pub_registration(topic, ownership_strength, history, compression, dictionary)
+        shard = self.topic_shard(topic)
+        return chain_future(self.send_request(MSG_PUB_REG, body=values, shard=shard),
+                            lambda response: self.registered_pub(topic, shard, dictionary_id, response))
+
+    '''
+    Function that returns the fields of a publisher registration, and the id of its compression dictionary (0 if none)
+    Takes the same arguments as register_pub()
+    '''
+    def pub_registration(self, topic, ownership_strength = 0, history = 0, compression = None, dictionary = None):
+        values = {'topic': topic, 'ownStr': ownership_strength, 'history_cnt': history}
+        if self.data_addr is not None:
+            values['data_addr'] = self.data_addr
+        dictionary_id = 0
+        if compression is not None:
+            values['compression'] = compression
+            if dictionary is not None:
+                dictionary_id = register_dictionary(dictionary)
+                values['dictionary'] = base64.b64encode(dictionary).decode()
+        return values, dictionary_id
+
+    '''
+    Function that keeps what the broker assigned to a publisher registration
+    Returns the broker's response
+    '''
+    def registered_pub(self, topic, shard, dictionary_id, response):
+        if response['result'] is True:
+            self.topic_ids[topic] = response['topic_id']
+            self.publisher_topics[(shard, response['topic_id'])] = topic
+            # The broker tells a new registration again whether it owns the topic
+            self.suppressed_topics.pop(topic, None)
+            if response.get('compression') is not None:
+                self.topic_compression[topic] = (response['compression'], dictionary_id)
+            else:
+                self.topic_compression.pop(topic, None)
         return response
 
-    # This function is not required if we directly connect the publishers to the subscribers
+    '''
+    Function that tells the broker this client no longer publishes on a topic
+    Returns the response received by the broker
+    topic: Topic the publisher was registered for
+    '''
+    def unregister_pub(self, topic):
+        return self.request(MSG_DISCONNECT, self.topic_ids.get(topic, 0), shard=self.topic_shard(topic))
+
+    # With a data_addr, publishers are connected directly to the subscribers and the broker is left out
     '''
     Function that the publisher can use to publish data through this middleware/wrapper
     topic: Topic for which content is being published
+    content: The content that is being published. Bytes-like content is sent as is, anything else
+             is encoded with msgpack (JSON if msgpack is not installed)
+    block: If True, wait for the broker's response and return it. If False, add the content to
+           the topic's current batch and return immediately; the batch is sent once it is full or
+           has lingered. Returns a Future for the acknowledgement of the batch if batch_acks is set,
+           None otherwise
+    A client with a data_addr sends the content straight to the subscribers instead, and the response
+    only tells whether the topic is registered
+    While another publisher owns the topic, most publications are dropped without being sent (the
+    broker would not forward them) and the response is {'type': 'pub', 'result': True, 'suppressed': True}
+    '''
+    def publish(self, topic, content, block=True):
+        if self.data_socket is not None:
+            response = self.publish_direct(topic, [self.encode_publication(topic, content)])
+            if block:
+                return response
+            return self.resolved_future(response) if self.batch_acks else None
+
+        if block:
+            response = self.send_publish(topic, content).result()
+            return response
+
+        # Samples of a topic owned by another publisher are sent on their own rather than batched
+        if topic in self.suppressed_topics:
+            return self.publish_many(topic, [content])
+
+        codec, frame = self.encode_publication(topic, content)
+        future = None
+        token = 0
+        if self.batch_acks:
+            token = next(self.req_ids)
+            future = Future()
+            self.futures[token] = future
+        self.send_command([CMD_BATCH, BATCH_INFO.pack(self.topic_shard(topic), self.topic_ids.get(topic, 0), codec, token),
+                           frame])
+        return future
+
+    '''
+    Function that sends one publication without waiting for the broker's response
+    Returns a Future that is resolved with the broker's response
+    topic: Topic for which content is being published
     content: The content that is being published
     '''
-    def publish(self, topic, content):
-        pub_msg = {'type': 'pub', 'addr': self.ip, 'topic': topic, 'content': content}
-        self.req_socket.send_pyobj(pub_msg)
-        response = self.req_socket.recv_pyobj()
-        return response
+    def send_publish(self, topic, content):
+        if self.data_socket is not None:
+            return self.resolved_future(self.publish_direct(topic, [self.encode_publication(topic, content)]))
+        flags = self.suppression(topic)
+        if flags is None:
+            return self.resolved_future(dict(suppressed_response))
+        codec, frame = self.encode_publication(topic, content)
+        return self.send_request(MSG_PUB, self.topic_ids.get(topic, 0), frames=[frame], codec=codec,
+                                 shard=self.topic_shard(topic), flags=flags)
+
+    '''
+    Function that publishes several messages on a topic as one batch message
+    Returns a Future for the broker's acknowledgement if ack is set, None otherwise
+    topic: Topic for which content is being published
+    contents: The messages being published, in order
+    ack: Whether the broker should acknowledge the batch (defaults to batch_acks)
+    '''
+    def publish_many(self, topic, contents, ack=None):
+        if self.data_socket is not None:
+            response = self.publish_direct(topic, [self.encode_publication(topic, content) for content in contents])
+            return self.resolved_future(response) if ack or (ack is None and self.batch_acks) else None
+        flags = self.suppression(topic)
+        if flags is None:
+            return self.resolved_future(dict(suppressed_response)) if ack or (ack is None and self.batch_acks) else None
+
+        # One codec for the whole batch: raw if every message is bytes-like
+        if all(isinstance(content, (bytes, bytearray, memoryview)) for content in contents):
+            codec = CODEC_RAW
+        else:
+            codec = default_content_codec
+        encoded = [self.encode_publication(topic, content, codec) for content in contents]
+        if encoded:
+            codec = encoded[0][0]
+        frames = [frame for _, frame in encoded]
+
+        # The request id doubles as the batch sequence number that the broker acknowledges
+        shard = self.topic_shard(topic)
+        addr_id = self.shard_addr_id(shard)
+        req_id = next(self.req_ids)
+        future = None
+        if ack or (ack is None and self.batch_acks):
+            future = Future()
+            self.futures[req_id] = future
+        header = encode_header(MSG_PUB_BATCH, (FLAG_ACK if future else 0) | flags, codec,
+                               self.topic_ids.get(topic, 0), addr_id, req_id)
+        self.send_command([CMD_SEND, SHARD_INFO.pack(shard), header] + frames)
+        return future
+
+    '''
+    Function that encodes a message for a topic, compressed if the topic was registered with compression
+    Returns the tuple (codec, buffer) like encode_content()
+    '''
+    def encode_publication(self, topic, content, codec=None):
+        compression = self.topic_compression.get(topic)
+        if compression is None:
+            return encode_content(content, codec)
+        return compress_content(*encode_content(content, codec), *compression)
+
+    '''
+    Function that tells whether a publication may be sent while another publisher owns its topic
+    Returns 0 if the client owns the topic (or was not told otherwise), FLAG_SUPPRESSED if the publication
+    is sent as the topic's next sample, which keeps this publisher in the running to take the topic over,
+    and None if it should be dropped
+    '''
+    def suppression(self, topic):
+        interval = self.suppressed_topics.get(topic)
+        if interval is None:
+            return 0
+        now = time.time()
+        if now < self.next_samples.get(topic, 0):
+            return None
+        self.next_samples[topic] = now + interval
+        return FLAG_SUPPRESSED
+
+    '''
+    Function that handles the broker telling a publisher whether it owns a topic
+    '''
+    def set_suppressed(self, shard, topic_id, owner, sample_interval_ms):
+        topic = self.publisher_topics.get((shard, topic_id))
+        if topic is None:
+            return
+        if owner:
+            self.suppressed_topics.pop(topic, None)
+        elif topic not in self.suppressed_topics:
+            logger.info('Another publisher owns topic %s, sending one sample every %d ms', topic, sample_interval_ms)
+            self.next_samples[topic] = time.time() + sample_interval_ms / 1000
+            self.suppressed_topics[topic] = sample_interval_ms / 1000
+
+    '''
+    Function that publishes messages on the client's own data socket, straight to the subscribers
+    Returns the response to the publish, {'type': 'pub', 'result': False} if the topic is not registered
+    topic: Topic for which content is being published
+    encoded: List of (codec, content frame), in order
+    '''
+    def publish_direct(self, topic, encoded):
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            return {'type': 'pub', 'result': False}
+        addr_id = self.shard_addr_id(self.topic_shard(topic))
+        seqs = self.direct_seqs.get(topic)
+        if seqs is None:
+            seqs = self.direct_seqs.setdefault(topic, itertools.count(1))
+
+        # Sequence numbers are taken under the command lock, so they reach the I/O thread in order
+        # even when several threads publish on the topic
+        with self.cmd_lock:
+            frames = [CMD_DIRECT, topic_envelope(topic)]
+            for codec, content in encoded:
+                frames.append(encode_header(MSG_PUB, 0, codec, topic_id, addr_id, next(seqs)))
+                frames.append(content)
+            self.cmd_push.send_multipart(frames, copy=False)
+        return {'type': 'pub', 'result': True}
+
+    '''
+    Function that returns a Future already resolved with a response, for publishes that get no reply
+    '''
+    def resolved_future(self, response):
+        future = Future()
+        future.set_result(response)
+        return future
+
+    '''
+    Function that sends pending batches without waiting for them to fill up or linger
+    '''
+    def flush(self):
+        self.send_command([CMD_FLUSH])
 
 
     # Wrapper functions that are useful for the subscribers
     '''
     Function that can be called to register the subscriber with the broker
     Returns the address of the best publisher available
-    topic: Topic that the subscriber wants to subscribe to
+    topic: Topic that the subscriber wants to subscribe to. A topic with wildcard levels ('+' for one level,
+           '#' for all levels below, see topic_trie.py) subscribes to every topic it matches
     history: The amount of history that the subscriber wants the publisher to maintain (default value is 0)
-    Returns publication history if available, or None otherwise
+    Returns publication history if available, or None otherwise (also when the topic has no publishers,
+    whatever history is asked for). History evicted by the broker to stay
+    within its memory budget is missing from the list. For a wildcard topic, the history is the last
+    messages of all matching topics together as a list of (topic, msg), in the order the broker forwarded them.
+    Messages of a wildcard subscription are received with notify()/poll() on the wildcard topic, and
+    poll() returns the topic each one was published on
     '''
     def register_sub(self, topic, history = 0):
-        print("Registering subscriber with broker")
-        values = {'type': 'sub_reg', 'topic': topic, 'history_cnt': history}
-        self.req_socket.send_pyobj(values)
-        response = self.req_socket.recv_pyobj()
+        return self.send_register_sub(topic, history).result()
+
+    '''
+    Function that registers a subscriber without waiting for the broker
+    Returns a Future resolved with what register_sub() returns. Takes the same arguments as register_sub()
+    '''
+    def send_register_sub(self, topic, history = 0):
+        logger.info('Registering subscriber with broker')
+        values = {'topic': topic, 'history_cnt': history}
+        if is_pattern(topic):
+            return self.send_register_pattern(topic, history)
+        return chain_future(self.send_request(MSG_SUB_REG, body=values, shard=self.topic_shard(topic)),
+                            lambda response: self.registered_sub(topic, response))
+
+    '''
+    Function that subscribes to a topic once the broker has answered its registration
+    Returns what register_sub() returns
+    '''
+    def registered_sub(self, topic, response):
+        self.send_subscriptions(self.subscription(topic, response))
+        return self.sub_history(response)
 
-        # Check for success. Subscribe to topic regardless
-        self.sub_socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+    '''
+    Function that has the I/O thread subscribe to topics
+    Callbacks of Futures run on the thread that resolves them, often the I/O thread, which subscribes
+    right away rather than sending itself a command
+    subscriptions: List of (topic envelope, owner) pairs, flattened as in CMD_SUBSCRIBE
+    '''
+    def send_subscriptions(self, subscriptions):
+        if threading.current_thread() is self.io_thread:
+            self.subscribe_topics(subscriptions)
+        else:
+            self.send_command([CMD_SUBSCRIBE] + subscriptions)
+
+    '''
+    Function that returns the CMD_SUBSCRIBE frames that subscribe to a topic registered with the broker
+    '''
+    def subscription(self, topic, response):
+        # Subscribe to topic regardless of success, and receive it from its owner if it is published directly
+        if 'data_addr' in response:
+            return [topic_envelope(topic), encode_body({'owner_id': response['owner_id'], 'data_addr': response['data_addr']})]
+        return [topic_envelope(topic), b'']
+
+    '''
+    Function that returns the history in a sub_reg response, decoded, or None if the registration failed
+    '''
+    def sub_history(self, response):
         if response['type'] == 'sub_reg' and response['result'] is True:
-            return response['history']
+            return [decode_content(codec, frame) for codec, frame in zip(response['codecs'], response.get('frames', []))]
         else:
             return None
 
+    '''
+    Function that registers a wildcard subscription with every broker shard, since matching topics may live on any
+    Returns a Future resolved with what register_sub() returns for a wildcard topic
+    pattern: Topic with wildcard levels
+    history: Number of messages of history wanted, across all matching topics
+    '''
+    def send_register_pattern(self, pattern, history):
+        futures = [self.send_request(MSG_SUB_REG, body={'topic': pattern, 'history_cnt': history}, shard=shard)
+                   for shard in range(len(self.req_addrs))]
+
+        def registered(responses):
+            self.send_subscriptions([topic_envelope(pattern), b''])
+            if not all(response['type'] == 'sub_reg' and response['result'] is True for response in responses):
+                return None
+            # Every shard sends its part in forwarding order, so merging them by time is enough
+            merged = heapq.merge(*[zip(response['times'], response['topics'], response['codecs'], response.get('frames', []))
+                                   for response in responses], key=lambda message: message[0])
+            return [(topic, decode_content(codec, frame))
+                    for sent, topic, codec, frame in collections.deque(merged, maxlen=history)]
+
+        return chain_future(gather_futures(futures), registered)
+
+    '''
+    Function that registers many publishers and subscribers at once, with one request to each broker shard
+    (and one per shard for each wildcard subscription), rather than one round trip per registration
+    Returns a list with the result of each registration, in order: the broker's response for a publisher,
+    as register_pub() returns, and the history (or None) for a subscriber, as register_sub() returns
+    registrations: List of ('pub', topic, ownership_strength, history, compression, dictionary) and
+                   ('sub', topic, history) tuples. The arguments after the topic are optional, with the
+                   defaults of register_pub() and register_sub()
+    '''
+    def register_many(self, registrations):
+        return self.send_register_many(registrations).result()
+
+    '''
+    Function that registers many publishers and subscribers without waiting for the broker
+    Returns a Future resolved with what register_many() returns. Takes the same arguments as register_many()
+    '''
+    def send_register_many(self, registrations):
+        logger.info('Registering %d publishers and subscribers with broker', len(registrations))
+        results = [None] * len(registrations)
+        if not registrations:
+            return self.resolved_future(results)
+
+        # Every registration is checked before any is sent, so a bad one leaves nothing half registered
+        for kind, topic, *args in registrations:
+            if not (kind == 'pub' and len(args) <= 4 or kind == 'sub' and len(args) <= 1):
+                raise ValueError("Registrations must be ('pub', topic, ownership_strength, history, compression, dictionary) "
+                                 "or ('sub', topic, history), with optional arguments after the topic, not %r"
+                                 % ((kind, topic) + tuple(args),))
+
+        # Request body of each shard, and where each of its registrations goes in the results
+        bodies = {}
+        places = {}
+        patterns = []
+        for index, (kind, topic, *args) in enumerate(registrations):
+            if kind == 'sub' and is_pattern(topic):
+                patterns.append((index, topic, args))
+                continue
+            shard = self.topic_shard(topic)
+            body = bodies.setdefault(shard, {'pubs': [], 'subs': []})
+            pub_places, sub_places = places.setdefault(shard, ([], []))
+            if kind == 'pub':
+                values, dictionary_id = self.pub_registration(topic, *args)
+                body['pubs'].append(values)
+                pub_places.append((index, topic, dictionary_id))
+            else:
+                body['subs'].append({'topic': topic, 'history_cnt': args[0] if args else 0})
+                sub_places.append((index, topic))
+        shards = list(bodies)
+        futures = [self.send_request(MSG_REG_MANY, body=bodies[shard], shard=shard) for shard in shards]
+        patterns = [(index, self.send_register_sub(topic, *args)) for index, topic, args in patterns]
+
+        def registered(responses):
+            # Every subscriber's history is a run of the shard's 'codecs' and 'frames', 'count' messages long
+            subscriptions = []
+            for shard, response in zip(shards, responses):
+                pub_places, sub_places = places[shard]
+                if response['type'] != 'reg_many':
+                    for index, topic, dictionary_id in pub_places:
+                        results[index] = response
+                    continue
+                for (index, topic, dictionary_id), result in zip(pub_places, response['pubs']):
+                    results[index] = self.registered_pub(topic, shard, dictionary_id, dict(result, type='pub_reg'))
+                codecs, frames = response.get('codecs', []), response.get('frames', [])
+                start = 0
+                for (index, topic), result in zip(sub_places, response['subs']):
+                    end = start + result.pop('count')
+                    result = dict(result, type='sub_reg', codecs=codecs[start:end], frames=frames[start:end])
+                    subscriptions += self.subscription(topic, result)
+                    results[index] = self.sub_history(result)
+                    start = end
+            # All topics are subscribed at once, right away on the I/O thread or with one command from another thread
+            if subscriptions:
+                self.send_subscriptions(subscriptions)
+            for (index, future), result in zip(patterns, responses[len(shards):]):
+                results[index] = result
+            return results
+
+        return chain_future(gather_futures(futures + [future for index, future in patterns]), registered)
+
     '''
     Function that the subscriber can use to wait on next available message (Blocking recv essentially)
+    Messages of other subscribed topics stay queued for later calls
     topic: Topic that the subscriber wants to wait for
     value: ???
+    timeout_ms: Give up and return None after this long (default 0, wait forever)
+    topics: If given instead of topic, wait for any of these topics and return (topic, msg) like poll()
     '''
-    def notify(self, topic, value, timeout_ms=0):
+    def notify(self, topic=None, value=None, timeout_ms=0, topics=None):
         # print("Client waiting for message")
+        if topics is not None:
+            return self.poll(topics, timeout_ms)
+        result = self.poll([topic], timeout_ms)
+        if result is None:
+            return None
+        return result[1]
 
-        # Set absolute time limits for timeout (pyzmq uses relative timeouts)
-        start_time = int(round(time.time() * 1000))
-        end_time = start_time + timeout_ms
+    '''
+    Function that waits for the oldest received message of any of the given topics
+    Returns the tuple (topic, msg), or None on timeout (right away if the client was disconnected as a slow consumer)
+    topics: Topics to wait for (default None, any subscribed topic)
+    timeout_ms: Give up and return None after this long (default 0, wait forever)
+    '''
+    def poll(self, topics=None, timeout_ms=0):
+        envelopes = None if topics is None else [topic_envelope(topic) for topic in topics]
 
-        # Loop until desired message topic arrives
-        while True:
-            # If timeout specified, determine remaining time. Otherwise, block indefinitely
-            if timeout_ms > 0:
-                remaining_time = end_time - int(round(time.time() * 1000))
-                if remaining_time <= 0:
+        # Set absolute time limit for timeout
+        end_time = time.time() + timeout_ms / 1000
+
+        # Batched publications must not sit in the client while it waits
+        self.flush()
+
+        with self.sub_cond:
+            while True:
+                envelope, frames = self.pop_publication(envelopes)
+                if envelope is not None:
+                    break
+
+                # A client disconnected as a slow consumer receives nothing more until it subscribes again
+                if self.sub_drops['disconnected']:
                     return None
-            else:
-                remaining_time = -1
-            self.sub_socket.RCVTIMEO = remaining_time
 
-            # Try to recv message. Catch timeout
+                # If timeout specified, determine remaining time. Otherwise, block indefinitely
+                if timeout_ms > 0:
+                    remaining_time = end_time - time.time()
+                    if remaining_time <= 0:
+                        return None
+                else:
+                    remaining_time = None
+                self.sub_cond.wait(remaining_time)
+
+        return self.decode_publication(envelope, frames)
+
+    '''
+    Function that returns the oldest received message of any of the given topics without waiting
+    Returns the tuple (topic, msg), or None if there is none
+    topics: Topics to look at (default None, any subscribed topic)
+    '''
+    def poll_nowait(self, topics=None):
+        envelopes = None if topics is None else [topic_envelope(topic) for topic in topics]
+        with self.sub_cond:
+            envelope, frames = self.pop_publication(envelopes)
+        if envelope is None:
+            return None
+        return self.decode_publication(envelope, frames)
+
+    '''
+    Function that removes the oldest queued message of any of the given topic envelopes. Called with sub_cond held
+    Returns the tuple (envelope, frames), or (None, None) if there is none
+    envelopes: Topic envelopes to look at, or None for all
+    '''
+    def pop_publication(self, envelopes):
+        # Oldest message at the head of any of the requested queues
+        envelope = None
+        for candidate in (self.sub_queues if envelopes is None else envelopes):
+            pending = self.sub_queues.get(candidate)
+            if pending and (envelope is None or pending[0][0] < self.sub_queues[envelope][0][0]):
+                envelope = candidate
+        if envelope is None:
+            return None, None
+        self.sub_queued -= 1
+        return envelope, self.sub_queues[envelope].popleft()[1]
+
+    '''
+    Function that decodes a message taken from the queues
+    Returns the tuple (topic, msg)
+    '''
+    def decode_publication(self, envelope, frames):
+        # Messages are [topic, header, content], received by the I/O thread without copying.
+        # Content is only decoded here, for the message actually returned
+        msg_type, flags, codec, topic_id, addr_id, seq = decode_header(frames[1])
+        msg = decode_content(codec, frames[2])
+        # Queued under the pattern for wildcard subscriptions, so the topic comes from the message's own envelope
+        topic = envelope_topic(envelope if frames[0] is None else frames[0].bytes)
+        self.delivered_seqs[topic] = seq
+        return topic, msg
+
+    '''
+    Function that returns the sequence number of the last message of a topic returned by notify()/poll()
+    Pass it plus one to replay() to resume after a reconnect without missing or repeating messages
+    Returns 0 if no message of the topic has been returned yet
+    '''
+    def last_seq(self, topic):
+        return self.delivered_seqs.get(topic, 0)
+
+    '''
+    Function that returns how well the subscriber keeps up with its topics, as a dict:
+    'queued': messages waiting for notify()/poll()
+    'dropped': messages dropped by slow_consumer_policy because the queues were full
+    'lost': messages that never reached the client (dropped by the broker, found from gaps in the sequence numbers)
+    'disconnected': True once the 'disconnect' policy has unsubscribed the client
+    '''
+    def sub_stats(self):
+        with self.sub_cond:
+            return dict(self.sub_drops, queued=self.sub_queued)
+
+    '''
+    Function that subscribes to a topic starting from a sequence number
+    Messages still kept in the broker's history are delivered first, then the live messages, all through
+    notify()/poll() in sequence order without gaps or duplicates. Any message the Client misses later
+    (found from a gap in the sequence numbers) is fetched from the history again
+    Returns True if every message from from_seq on was still in the broker's history, False if some were lost
+    topic: Topic to subscribe to
+    from_seq: Sequence number of the first message wanted (1 for everything kept)
+    '''
+    def replay(self, topic, from_seq):
+        return self.send_replay(topic, from_seq).result()
+
+    '''
+    Function that starts a replay() without waiting for the broker
+    Returns a Future resolved with what replay() returns. Takes the same arguments as replay()
+    '''
+    def send_replay(self, topic, from_seq):
+        shard = self.topic_shard(topic)
+        addr_id = self.shard_addr_id(shard)
+        req_id = next(self.req_ids)
+        future = Future()
+        self.futures[req_id] = future
+        header = encode_header(MSG_REPLAY, FLAG_ACK, CODEC_NONE, 0, addr_id, req_id)
+        self.send_command([CMD_REPLAY, SHARD_INFO.pack(shard), topic_envelope(topic), SEQ_INFO.pack(from_seq),
+                           header, encode_body({'topic': topic, 'from_seq': from_seq})])
+        return chain_future(future, lambda response: response['result'])
+
+    def shutdown_broker(self):
+        logger.info('Sending broker shutdown command')
+
+        # A sharded broker shuts down every shard
+        futures = [self.send_request(MSG_SHUTDOWN, shard=shard) for shard in range(len(self.req_addrs))]
+        result = all(future.result()['result'] for future in futures)
+
+        if result == True:
+            logger.info('Shutdown successful')
+        else:
+            logger.warning('Shutdown FAILED')
+
+        return result
+
+
+    # Functions run by the client's I/O thread, which owns the broker sockets
+    '''
+    Function that runs the I/O thread: forwards API commands to the broker, resolves the futures
+    of replies, answers heartbeats, queues publications for notify() and sends lingering batches
+    '''
+    def run_io(self):
+        self.poller = zmq.Poller()
+        self.poller.register(self.cmd_socket, zmq.POLLIN)
+        for req_socket in self.req_sockets:
+            self.poller.register(req_socket, zmq.POLLIN)
+        self.poller.register(self.sub_socket, zmq.POLLIN)
+
+        # Requests waiting for a reply, by request id, as (shard, frames, deadline, attempts). In the order they
+        # were sent, so the first one is the next to time out
+        self.in_flight = {}
+
+        # Pending batches by (shard, topic id), and the tokens of acknowledged batches by request id
+        self.batches = {}
+        self.batch_tokens = {}
+
+        # Lists received so far of replies that arrive in chunks, by request id
+        self.partial_responses = {}
+
+        # Topics subscribed with replay(), by envelope. Their messages are queued strictly in sequence order:
+        # 'expected' is the next sequence number to queue, 'held' the live messages that arrived ahead of it
+        # and 'pending' the request id of the replay that will fill the gap (None if there is none)
+        self.resumed = {}
+        self.replay_requests = {}
+
+        # Topic envelopes the SUB socket is subscribed to, and the sequence number of the last message
+        # received on each topic, to count messages lost on the way
+        self.subscriptions = set()
+        self.recv_seqs = {}
+
+        # Drop counters last reported to each shard. Pings only carry them when they change
+        self.reported_drops = [dict(self.sub_drops) for _ in self.req_addrs]
+
+        # Owner of each topic published directly, as (address id, data address), and the number of topics
+        # received from each data address the SUB socket is connected to
+        self.topic_owners = {}
+        self.data_sources = {}
+
+        while True:
+            # Wake up in time to send the oldest batch once it has lingered, and to retry the oldest request
+            wake_time = None
+            if self.batches:
+                wake_time = min(batch['start_time'] for batch in self.batches.values()) + self.batch_linger_ms / 1000
+            if self.in_flight:
+                deadline = next(iter(self.in_flight.values()))[2]
+                wake_time = deadline if wake_time is None else min(wake_time, deadline)
+            timeout = None if wake_time is None else max(0, (wake_time - time.time()) * 1000)
+            events = dict(self.poller.poll(timeout))
+
+            for shard, req_socket in enumerate(self.req_sockets):
+                if req_socket in events:
+                    for frames in self.recv_available(req_socket):
+                        self.dispatch_response(frames, shard)
+            if self.sub_socket in events:
+                for frames in self.recv_available(self.sub_socket):
+                    self.dispatch_publication(frames)
+            if self.cmd_socket in events:
+                for frames in self.recv_available(self.cmd_socket):
+                    if not self.run_command(frames):
+                        return
+
+            now = time.time()
+            for batch_key in list(self.batches):
+                if (now - self.batches[batch_key]['start_time']) * 1000 >= self.batch_linger_ms:
+                    self.send_batch(batch_key)
+            while self.in_flight and next(iter(self.in_flight.values()))[2] <= now:
+                self.fail_over(next(iter(self.in_flight.values()))[0], now)
+
+    '''
+    Function that receives the messages already waiting on a socket, up to io_burst of them
+    so that no socket starves the others
+    '''
+    def recv_available(self, sock):
+        for _ in range(io_burst):
             try:
-                recved_topic = self.sub_socket.recv_string()
+                yield sock.recv_multipart(zmq.NOBLOCK, copy=False)
             except zmq.error.Again:
-                return None
+                return
 
-            # Desired topic arrived. Read message and return.
-            if recved_topic == topic:
-                msg = self.sub_socket.recv_pyobj(zmq.NOBLOCK)
-                # print(msg)
-                return msg
+    '''
+    Function that carries out one API command in the I/O thread
+    Returns False once the thread should stop
+    '''
+    def run_command(self, frames):
+        command = frames[0].bytes
+        if command == CMD_BATCH:
+            self.add_to_batch(frames)
+        elif command == CMD_SEND:
+            # Send batched publications first so the broker sees messages in publication order
+            self.flush_batches()
+            self.send_to_shard(SHARD_INFO.unpack(frames[1].buffer)[0], frames[2:])
+        elif command == CMD_FLUSH:
+            self.flush_batches()
+        elif command == CMD_SUBSCRIBE:
+            self.subscribe_topics([frame.bytes for frame in frames[1:]])
+        elif command == CMD_DIRECT:
+            envelope = frames[1].bytes
+            for index in range(2, len(frames), 2):
+                self.data_socket.send_multipart([envelope, frames[index], frames[index + 1]], copy=False)
+        elif command == CMD_REPLAY:
+            self.flush_batches()
+            self.start_replay(frames)
+        elif command == CMD_STOP:
+            self.flush_batches()
+            return False
+        return True
 
-            # Handle special broker topic regardless of desired topic
-            elif recved_topic == "BROKER_CMD":
-                msg = self.sub_socket.recv_pyobj()
+    '''
+    Function that sends a request to a broker shard. Requests that expect a reply are kept until it arrives,
+    to be sent again if it does not
+    frames: Request frames, starting with the header
+    '''
+    def send_to_shard(self, shard, frames):
+        msg_type, flags, codec, topic_id, addr_id, req_id = decode_header(frames[0])
+        if flags & FLAG_ACK:
+            self.in_flight[req_id] = (shard, frames, time.time() + self.request_timeout, 1)
+        self.req_sockets[shard].send_multipart(frames, copy=False)
 
-                # Send back ping in response to heartbeat
-                if msg['type'] == 'heartbeat':
-                    ping = {'type': 'ping', 'addr': self.ip}
-                    self.req_socket.send_pyobj(ping)
-                    response = self.req_socket.recv_pyobj()
+    '''
+    Function that moves the requests of a shard to a new connection, to its next endpoint, after a request
+    went unanswered for request_timeout_ms (the Lazy Pirate pattern). The shard's requests waiting for a
+    reply are sent again there, and those that were sent request_retries times fail with TimeoutError.
+    Messages that expect no reply and were still queued for the old connection are lost
+    '''
+    def fail_over(self, shard, now):
+        endpoints = self.req_endpoints[shard]
+        old_endpoint = endpoints[self.active_endpoints[shard]]
+        self.active_endpoints[shard] = (self.active_endpoints[shard] + 1) % len(endpoints)
+        endpoint = endpoints[self.active_endpoints[shard]]
+        logger.warning('No reply from broker %s in %d ms, connecting to %s', old_endpoint, self.request_timeout * 1000, endpoint)
+
+        self.poller.unregister(self.req_sockets[shard])
+        self.req_sockets[shard].close(linger=0)
+        req_socket = self.req_sockets[shard] = self.context.socket(zmq.DEALER)
+        req_socket.connect(endpoint)
+        self.poller.register(req_socket, zmq.POLLIN)
+
+        for req_id, (request_shard, frames, deadline, attempts) in list(self.in_flight.items()):
+            if request_shard != shard:
+                continue
+            del self.in_flight[req_id]
+            self.partial_responses.pop(req_id, None)
+            if attempts >= self.request_retries:
+                self.fail_request(req_id, TimeoutError('No reply from the broker after %d attempts' % attempts))
+                continue
+            self.in_flight[req_id] = (shard, frames, now + self.request_timeout, attempts + 1)
+            req_socket.send_multipart(frames, copy=False)
 
-            # Discard all other messages
-            else:
-                self.sub_socket.recv_pyobj()
+    '''
+    Function that fails the Future(s) waiting on a request
+    '''
+    def fail_request(self, req_id, error):
+        # A replay that failed leaves its topic to be received like any other
+        envelope = self.replay_requests.pop(req_id, None)
+        if envelope is not None:
+            self.resumed.pop(envelope, None)
+        for token in self.batch_tokens.pop(req_id, [req_id]):
+            future = self.futures.pop(token, None)
+            if future is not None:
+                future.set_exception(error)
 
-    def shutdown_broker(self):
-        print("Sending broker shutdown command")
+    '''
+    Function that decodes a reply from the broker and resolves the Future(s) waiting on it
+    frames: The reply
+    shard: Broker shard the reply came from
+    '''
+    def dispatch_response(self, frames, shard):
+        msg_type, msg_flags, codec, topic_id, addr_id, req_id = decode_header(frames[0])
+        # Ownership notices answer no request
+        if msg_type == MSG_SUPPRESS:
+            body = decode_body(frames[1].buffer) if len(frames) > 1 else {}
+            self.set_suppressed(shard, topic_id, bool(msg_flags & FLAG_RESULT), body.get('sample_interval_ms', 0))
+            return
+        request = self.in_flight.pop(req_id, None)
+        response = {'type': msg_type_names.get(msg_type, 'unknown'), 'result': bool(msg_flags & FLAG_RESULT)}
+        if topic_id:
+            response['topic_id'] = topic_id
+        if addr_id:
+            response['addr_id'] = addr_id
+        if len(frames) > 1:
+            response.update(decode_body(frames[1].buffer))
+        if len(frames) > 2:
+            response['frames'] = frames[2:]
+
+        # Long replies (history) arrive in chunks. Every chunk but the last is marked 'more',
+        # and the lists of all chunks are joined before the request is resolved
+        chunks = self.partial_responses.pop(req_id, None)
+        if chunks is not None:
+            for key, value in chunks.items():
+                response[key] = value + response.get(key, [])
+        if response.pop('more', False):
+            self.partial_responses[req_id] = {key: value for key, value in response.items() if isinstance(value, list)}
+            # The rest of the reply is on its way
+            if request is not None:
+                shard, request_frames, deadline, attempts = request
+                self.in_flight[req_id] = (shard, request_frames, time.time() + self.request_timeout, attempts)
+            return
+
+        # Subscribers are given the compression dictionaries of their topics, before any message needs them
+        for dictionary in response.get('dictionaries', []):
+            self.add_dictionary(base64.b64decode(dictionary))
+
+        envelope = self.replay_requests.pop(req_id, None)
+        if envelope is not None:
+            self.finish_replay(envelope, response)
+
+        # An acknowledged batch resolves the future of every publish() that went into it
+        for token in self.batch_tokens.pop(req_id, [req_id]):
+            future = self.futures.pop(token, None)
+            if future is not None:
+                future.set_result(response)
 
-        values = {'type':'shutdown'}
-        self.req_socket.send_pyobj(values)
-        response = self.req_socket.recv_pyobj()
+    '''
+    Function that registers a compression dictionary handed out by the broker. Called on the I/O thread, so a
+    dictionary whose id is taken by another one (registered by the application, or on another shard) is only logged
+    '''
+    def add_dictionary(self, dictionary):
+        try:
+            register_dictionary(dictionary)
+        except ValueError as error:
+            logger.warning('%s', error)
 
-        if response['result'] == True:
-             print("Shutdown successful")
+    '''
+    Function that handles a message from the broker's PUB socket
+    '''
+    def dispatch_publication(self, frames):
+        envelope = frames[0].bytes
+        if envelope == broker_cmd_topic:
+            # Send back a one-way ping in response to heartbeat, to the shard that sent it
+            if decode_header(frames[1])[0] == MSG_HEARTBEAT:
+                shard = decode_body(frames[2].buffer).get('shard', 0) if len(frames) > 2 else 0
+                if shard < len(self.ping_sockets):
+                    self.send_ping(shard)
+            return
+
+        msg_type, flags, codec, topic_id, addr_id, seq = decode_header(frames[1])
+        if flags & (FLAG_MORE | FLAG_CHUNK):
+            frames = self.join_chunks(envelope, flags, seq, frames)
+            if frames is None:
+                return
+        if msg_type == MSG_OWNER:
+            self.set_owner(envelope, addr_id, decode_body(frames[2].buffer)['data_addr'])
+        elif msg_type == MSG_DICTIONARY:
+            self.add_dictionary(frames[2].buffer)
+        # Only messages from the topic's owner are taken: straight from it if it publishes directly,
+        # otherwise from the broker (address id 0)
+        elif addr_id != self.topic_owners.get(envelope, (0, None))[0]:
+            return
+        elif envelope in self.resumed:
+            self.order_publication(envelope, frames)
         else:
-            print("Shutdown FAILED")
+            # A gap in the sequence numbers means messages were dropped before they reached the client
+            last_seq = self.recv_seqs.get(envelope)
+            if last_seq is not None and seq > last_seq + 1:
+                self.sub_drops['lost'] += seq - last_seq - 1
+            self.recv_seqs[envelope] = seq
+            # Queue by topic without looking at the content. Messages matched by a wildcard subscription
+            # are queued under the pattern
+            if not envelope.endswith(topic_terminator):
+                envelope = envelope[:envelope.index(topic_terminator) + len(topic_terminator)]
+            self.queue_publication(envelope, frames)
+
+    '''
+    Function that collects the chunks of a large message (see Broker.send_chunks())
+    Returns the message frames with the whole content once its last chunk arrives, None until then.
+    A message missing a chunk (dropped by the broker for this subscriber) is dropped whole, and shows up
+    as a gap in the sequence numbers
+    '''
+    def join_chunks(self, envelope, flags, seq, frames):
+        partial = self.partial_publications.pop(envelope, None)
+        if not flags & FLAG_CHUNK:
+            partial = (seq, [])
+        elif partial is None or partial[0] != seq:
+            return None
+        partial[1].append(frames[2])
+        if flags & FLAG_MORE:
+            self.partial_publications[envelope] = partial
+            return None
+        return [frames[0], frames[1], b''.join(chunk.buffer for chunk in partial[1])]
+
+    '''
+    Function that answers a heartbeat with a one-way ping to the shard that sent it
+    The drop counters go along when they changed since the last ping to the shard
+    '''
+    def send_ping(self, shard):
+        frames = [encode_header(MSG_PING, 0, CODEC_NONE, 0, self.addr_ids[shard])]
+        if self.sub_drops != self.reported_drops[shard]:
+            self.reported_drops[shard] = dict(self.sub_drops)
+            frames.append(encode_body(self.reported_drops[shard]))
+        for ping_socket in self.ping_sockets[shard]:
+            try:
+                ping_socket.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.error.Again:
+                pass
+
+    '''
+    Function that switches a topic to the source announced by the broker: the owner's data socket if it
+    publishes directly, the broker otherwise
+    envelope: Topic envelope
+    owner_id: Address id of the owner (0 for the broker)
+    data_addr: Address of the owner's data socket, or None
+    '''
+    def set_owner(self, envelope, owner_id, data_addr):
+        current = self.topic_owners.get(envelope, (0, None))
+        if current == (owner_id, data_addr):
+            return
+        # Connect to the new source before leaving the old one, so the SUB socket stays subscribed throughout
+        if data_addr is not None:
+            self.data_sources[data_addr] = self.data_sources.get(data_addr, 0) + 1
+            if self.data_sources[data_addr] == 1:
+                self.sub_socket.connect(data_addr)
+            self.topic_owners[envelope] = (owner_id, data_addr)
+        else:
+            del self.topic_owners[envelope]
+        if current[1] is not None:
+            self.data_sources[current[1]] -= 1
+            if self.data_sources[current[1]] == 0:
+                del self.data_sources[current[1]]
+                self.sub_socket.disconnect(current[1])
+        # Every publisher numbers its own messages, so counting lost messages starts over
+        self.recv_seqs.pop(envelope, None)
+
+    '''
+    Function that subscribes to topics registered with the broker, and to their owners if published directly
+    Only called on the I/O thread
+    subscriptions: List of (topic envelope, owner) pairs, flattened as in CMD_SUBSCRIBE
+    '''
+    def subscribe_topics(self, subscriptions):
+        for index in range(0, len(subscriptions), 2):
+            envelope = subscriptions[index]
+            self.subscribe(envelope)
+            if subscriptions[index + 1]:
+                owner = decode_body(subscriptions[index + 1])
+                self.set_owner(envelope, owner['owner_id'], owner['data_addr'])
+
+    '''
+    Function that subscribes the SUB socket to a topic envelope. Subscribing again ends a slow consumer disconnect
+    '''
+    def subscribe(self, envelope):
+        self.sub_socket.setsockopt(zmq.SUBSCRIBE, envelope)
+        self.subscriptions.add(envelope)
+        with self.sub_cond:
+            self.sub_drops['disconnected'] = False
+
+    '''
+    Function that queues a message for notify()/poll(), applying slow_consumer_policy when the queues are full
+    '''
+    def queue_publication(self, envelope, frames):
+        with self.sub_cond:
+            # Messages still arriving after a disconnect are dropped
+            if self.sub_drops['disconnected']:
+                self.sub_drops['dropped'] += 1
+                return
+            if self.sub_hwm and self.sub_queued >= self.sub_hwm:
+                if self.slow_consumer_policy == 'drop_newest':
+                    self.sub_drops['dropped'] += 1
+                    return
+                if self.slow_consumer_policy == 'disconnect':
+                    self.disconnect_slow_consumer()
+                    return
+                self.drop_oldest_publication()
+
+            pending = self.sub_queues.get(envelope)
+            if pending is None:
+                pending = self.sub_queues[envelope] = collections.deque()
+            pending.append((next(self.sub_arrivals), frames))
+            self.sub_queued += 1
+            self.sub_cond.notify_all()
+        if self.publication_listener is not None:
+            self.publication_listener(envelope)
 
-        return response['result']
+    '''
+    Function that drops the oldest queued message of any topic. Called with sub_cond held
+    '''
+    def drop_oldest_publication(self):
+        oldest = min((pending for pending in self.sub_queues.values() if pending), key=lambda pending: pending[0][0])
+        oldest.popleft()
+        self.sub_queued -= 1
+        self.sub_drops['dropped'] += 1
+
+    '''
+    Function that drops every queued message and unsubscribes from every topic, for the 'disconnect'
+    policy. Called with sub_cond held
+    '''
+    def disconnect_slow_consumer(self):
+        self.sub_drops['dropped'] += self.sub_queued + 1
+        self.sub_drops['disconnected'] = True
+        self.sub_queues.clear()
+        self.sub_queued = 0
+        for envelope in self.subscriptions:
+            self.sub_socket.setsockopt(zmq.UNSUBSCRIBE, envelope)
+        self.subscriptions.clear()
+        # Messages published while unsubscribed are not lost on the way, so counting starts over
+        self.recv_seqs.clear()
+        self.resumed.clear()
+        self.sub_cond.notify_all()
+        if self.publication_listener is not None:
+            self.publication_listener(None)
+
+    '''
+    Function that starts a replay() in the I/O thread: subscribes to the topic, forgets queued messages that
+    the replay will deliver again, and sends the replay request
+    '''
+    def start_replay(self, frames):
+        shard = SHARD_INFO.unpack(frames[1].buffer)[0]
+        envelope = frames[2].bytes
+        from_seq = SEQ_INFO.unpack(frames[3].buffer)[0]
+        req_id = decode_header(frames[4])[5]
+        self.subscribe(envelope)
+        with self.sub_cond:
+            pending = self.sub_queues.get(envelope)
+            if pending:
+                kept = collections.deque(entry for entry in pending if decode_header(entry[1][1])[5] < from_seq)
+                self.sub_queued -= len(pending) - len(kept)
+                self.sub_queues[envelope] = kept
+
+        topic = envelope[:-len(topic_terminator)].decode()
+        self.resumed[envelope] = {'topic': topic, 'shard': shard, 'expected': from_seq, 'held': [], 'pending': req_id}
+        self.replay_requests[req_id] = envelope
+        self.send_to_shard(shard, frames[4:])
+
+    '''
+    Function that asks the broker for the messages missing before the held ones of a resumed topic
+    '''
+    def request_missing(self, envelope):
+        state = self.resumed[envelope]
+        req_id = next(self.req_ids)
+        header = encode_header(MSG_REPLAY, FLAG_ACK, CODEC_NONE, 0, self.addr_ids[state['shard']], req_id)
+        body = encode_body({'topic': state['topic'], 'from_seq': state['expected']})
+        state['pending'] = req_id
+        self.replay_requests[req_id] = envelope
+        self.send_to_shard(state['shard'], [header, body])
+
+    '''
+    Function that queues a live message of a resumed topic if it is the next one in sequence,
+    drops it if it was already queued, and holds it back otherwise
+    '''
+    def order_publication(self, envelope, frames):
+        state = self.resumed[envelope]
+        seq = decode_header(frames[1])[5]
+        if seq < state['expected']:
+            return
+        if seq == state['expected'] and state['pending'] is None:
+            self.queue_publication(envelope, frames)
+            state['expected'] += 1
+            return
+        state['held'].append((seq, frames))
+        if state['pending'] is None:
+            self.request_missing(envelope)
+
+    '''
+    Function that queues the messages of a replay reply, then the held live messages that follow them
+    Messages that the broker no longer keeps are skipped. If held messages still do not follow on, the
+    ones in between are requested again
+    '''
+    def finish_replay(self, envelope, response):
+        # The topic is no longer resumed if the client was disconnected as a slow consumer meanwhile
+        state = self.resumed.get(envelope)
+        if state is None:
+            return
+        state['pending'] = None
+        topic_id = response.get('topic_id', 0)
+        for seq, (codec, frame) in enumerate(zip(response['codecs'], response.get('frames', [])), response['seq']):
+            if seq >= state['expected']:
+                self.queue_publication(envelope, [None, encode_header(MSG_PUB, 0, codec, topic_id, 0, seq), frame])
+                state['expected'] = seq + 1
+
+        # Every message up to last_seq that the broker still had was in the reply
+        lost_until = response['last_seq'] + 1
+        held = sorted(state['held'], key=lambda entry: entry[0])
+        state['held'] = []
+        for index, (seq, frames) in enumerate(held):
+            if seq > state['expected'] and state['expected'] < lost_until:
+                state['expected'] = min(seq, lost_until)
+            if seq == state['expected']:
+                self.queue_publication(envelope, frames)
+                state['expected'] += 1
+            elif seq > state['expected']:
+                state['held'] = held[index:]
+                self.request_missing(envelope)
+                return
+        state['expected'] = max(state['expected'], lost_until)
+
+    '''
+    Function that adds a non-blocking publication to the batch of its topic
+    '''
+    def add_to_batch(self, frames):
+        shard, topic_id, codec, token = BATCH_INFO.unpack(frames[1].buffer)
+        batch_key = (shard, topic_id)
+        batch = self.batches.get(batch_key)
+        # A batch shares one codec, so a change of content type closes the current batch
+        if batch is not None and batch['codec'] != codec:
+            self.send_batch(batch_key)
+            batch = None
+        if batch is None:
+            batch = {'codec': codec, 'contents': [], 'tokens': [], 'bytes': 0, 'start_time': time.time()}
+            self.batches[batch_key] = batch
+        batch['contents'].append(frames[2])
+        batch['bytes'] += len(frames[2])
+        if token:
+            batch['tokens'].append(token)
+
+        if len(batch['contents']) >= self.batch_max_msgs or batch['bytes'] >= self.batch_max_bytes:
+            self.send_batch(batch_key)
+
+    '''
+    Function that sends the pending batch for a topic
+    batch_key: (shard, topic id) of the topic whose batch should be sent
+    '''
+    def send_batch(self, batch_key):
+        batch = self.batches.pop(batch_key)
+        shard, topic_id = batch_key
+        # The request id doubles as the batch sequence number that the broker acknowledges
+        req_id = next(self.req_ids)
+        header = encode_header(MSG_PUB_BATCH, FLAG_ACK if batch['tokens'] else 0, batch['codec'],
+                               topic_id, self.addr_ids[shard], req_id)
+        if batch['tokens']:
+            self.batch_tokens[req_id] = batch['tokens']
+        self.send_to_shard(shard, [header] + batch['contents'])
+
+    def flush_batches(self):
+        for batch_key in list(self.batches):
+            self.send_batch(batch_key)
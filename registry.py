@@ -0,0 +1,173 @@
+'''
+Publisher registry used by the Broker in middleware.py
+
+Publishers are indexed three ways:
+ - by (topic, addr) in a hash table, for authorizing every publication in O(1)
+ - per topic in ownership order (strongest first, earlier registration first on ties)
+ - per topic by history count, so the history a topic must keep is known without a scan
+
+Ownership is exclusive: only the owner's messages are forwarded, and the owner is cached per topic.
+It is arbitrated on the samples (publications) the publishers send rather than on registration:
+ - a publisher takes a topic over from its owner with its first sample if it is strictly stronger
+ - otherwise the owner keeps the topic until it has sent no sample for the ownership deadline, or leaves.
+   The topic then goes to the strongest publisher (earliest registered on ties) that has sent a sample
+   within the deadline
+So a stronger publisher that registers but does not publish yet takes nothing over, and publishers of
+equal strength never take a topic from each other while its owner is publishing.
+'''
+
+import itertools
+from sortedcontainers import SortedKeyList
+
+
+class PublisherRegistry:
+    def __init__(self):
+        # (topic, addr) -> publisher
+        self.publishers = {}
+
+        # topic -> {'by_strength': SortedKeyList, 'by_history': SortedKeyList, 'owner': publisher or None}
+        self.topics = {}
+
+        # Registration order, used to break ownership strength ties deterministically
+        self.registration_order = itertools.count()
+
+    '''
+    Function that adds a publisher, replacing an earlier registration of the same address for the topic
+    Returns the new publisher entry. Published messages are kept per topic by the broker's HistoryStore
+    topic: Topic the publisher publishes on
+    addr: Address of the publishing client
+    ownStr: Ownership strength
+    history_cnt: Number of messages of history the publisher keeps
+    data_addr: Address of the publisher's own PUB socket if it publishes directly to subscribers, or None
+    '''
+    def add(self, topic, addr, ownStr, history_cnt, data_addr=None):
+        self.remove(topic, addr)
+        publisher = {'topic': topic,
+                     'addr': addr,
+                     'ownStr': ownStr,
+                     'history_cnt': history_cnt,
+                     'data_addr': data_addr,
+                     'order': next(self.registration_order),
+                     # Time of the publisher's last sample, None until it publishes
+                     'last_sample': None}
+        self.publishers[(topic, addr)] = publisher
+
+        entry = self.topics.get(topic)
+        if entry is None:
+            entry = {'by_strength': SortedKeyList(key=lambda x: (-x['ownStr'], x['order'])),
+                     'by_history': SortedKeyList(key=lambda x: (x['history_cnt'], x['ownStr'], -x['order'])),
+                     'owner': None}
+            self.topics[topic] = entry
+        entry['by_strength'].add(publisher)
+        entry['by_history'].add(publisher)
+        return publisher
+
+    '''
+    Function that removes a publisher
+    Returns the removed publisher entry, or None if it was not registered
+    topic: Topic the publisher published on
+    addr: Address of the publishing client
+    '''
+    def remove(self, topic, addr):
+        publisher = self.publishers.pop((topic, addr), None)
+        if publisher is None:
+            return None
+
+        entry = self.topics[topic]
+        entry['by_strength'].remove(publisher)
+        entry['by_history'].remove(publisher)
+        if not entry['by_strength']:
+            del self.topics[topic]
+        elif entry['owner'] is publisher:
+            entry['owner'] = None
+        return publisher
+
+    '''
+    Function that looks up the publisher registered by an address for a topic
+    Returns the publisher entry, or None
+    '''
+    def get(self, topic, addr):
+        return self.publishers.get((topic, addr))
+
+    '''
+    Function that returns the owner of a topic, or None if no publisher owns it (yet)
+    '''
+    def owner(self, topic):
+        entry = self.topics.get(topic)
+        if entry is None:
+            return None
+        return entry['owner']
+
+    '''
+    Function that makes a publisher the owner of its topic, without arbitration
+    Used by a standby broker to take over the ownership arbitrated by the primary
+    '''
+    def set_owner(self, publisher):
+        self.topics[publisher['topic']]['owner'] = publisher
+
+    '''
+    Function that returns the strongest publisher of a topic, whether or not it publishes, or None
+    '''
+    def strongest(self, topic):
+        entry = self.topics.get(topic)
+        if entry is None:
+            return None
+        return entry['by_strength'][0]
+
+    '''
+    Function that records a sample from a publisher and arbitrates the ownership of its topic
+    Returns True if the publisher owns the topic, so its sample is forwarded
+    publisher: Publisher entry that sent the sample
+    now: Time of the sample
+    deadline: Seconds without samples after which an owner loses its topic to another publisher
+    '''
+    def arbitrate(self, publisher, now, deadline):
+        publisher['last_sample'] = now
+        entry = self.topics[publisher['topic']]
+        owner = entry['owner']
+        if owner is publisher:
+            return True
+        if owner is not None and publisher['ownStr'] <= owner['ownStr'] and now - owner['last_sample'] < deadline:
+            return False
+        # The owner is weaker, silent or gone. A stronger publisher that is still sending samples
+        # goes first, and takes the topic with its next one
+        for candidate in entry['by_strength']:
+            if candidate is publisher:
+                break
+            if candidate is not owner and candidate['last_sample'] is not None and now - candidate['last_sample'] < deadline:
+                return False
+        entry['owner'] = publisher
+        return True
+
+    '''
+    Function that returns the most history any publisher of a topic keeps (0 if it has no publishers)
+    This is how many messages the broker keeps for the topic
+    '''
+    def max_history(self, topic):
+        entry = self.topics.get(topic)
+        if entry is None:
+            return 0
+        # by_history ends with the publisher keeping the most history
+        return entry['by_history'][-1]['history_cnt']
+
+    '''
+    Function that returns every publisher in registration order
+    '''
+    def all_publishers(self):
+        return sorted(self.publishers.values(), key=lambda publisher: publisher['order'])
+
+    '''
+    Function that returns whether a topic has any publishers
+    '''
+    def has_publishers(self, topic):
+        # A topic is dropped with its last publisher
+        return topic in self.topics
+
+    '''
+    Function that returns the publishers of a topic in ownership order
+    '''
+    def topic_publishers(self, topic):
+        entry = self.topics.get(topic)
+        if entry is None:
+            return []
+        return list(entry['by_strength'])
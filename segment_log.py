@@ -0,0 +1,460 @@
+'''
+Durable history backend for the Broker in middleware.py
+
+Used instead of the in-memory HistoryStore when the Broker is given a history directory.
+Every topic has its own directory of append-only segment files. The offset of a message is
+its sequence number in the topic. Each segment is named after the offset of its first message
+and holds records of:
+    offset (8 bytes), time (8 bytes), content length (4 bytes), CRC32 of the content (4 bytes), codec (1 byte), content
+The time is when the broker forwarded the message, in seconds since the epoch (a double). Logs
+written before records carried a time (format 1 in meta.json) are still read, with every time 0,
+and their topics keep writing format 1 records.
+Next to every segment, a sparse index records the file position of one message every
+index_interval_bytes, so that reading from an offset only scans a few records.
+
+Appends go through buffered files and are fsynced in batches, at most sync_interval_ms after
+they were written. History is read through mmap, and contents are returned as memoryviews of the
+mapped file, so they are sent to subscribers without being copied into Python objects.
+
+When the Broker starts, each topic is recovered from its directory: only the tail of its last
+segment after the last index entry is scanned, so startup time does not grow with the amount of
+history kept. A record cut short by a crash (or failing its CRC) ends the log, and the segment
+is truncated there.
+
+Unlike the in-memory store, a topic's history is kept after its last publisher leaves, so that
+it can still be served after a restart. Whole segments are deleted once all of their messages
+are older than the topic's retention, the largest history any of its publishers asked for.
+'''
+
+import os
+import bisect
+import mmap
+import json
+import time
+import struct
+import zlib
+
+# Record headers by log format
+RECORD_FORMATS = {1: struct.Struct('!QIIB'),
+                  2: struct.Struct('!QdIIB')}
+RECORD_FORMAT = 2
+INDEX_ENTRY = struct.Struct('!QQ')
+
+default_segment_bytes = 64 * 1024 * 1024
+default_index_interval_bytes = 4096
+default_sync_interval_ms = 100
+
+# Write buffer of each segment file
+segment_buffer_bytes = 1024 * 1024
+
+
+class Segment:
+    '''
+    path: Path of the segment file, without extension
+    base_offset: Offset of the first message in the segment
+    log_format: Format of the segment's records
+    '''
+    def __init__(self, path, base_offset, log_format):
+        self.path = path
+        self.base_offset = base_offset
+        self.log_format = log_format
+        self.record = RECORD_FORMATS[log_format]
+        # Offset after the last message, and size of the file in bytes
+        self.next_offset = base_offset
+        self.size = 0
+        # Sparse index: offsets and positions of every indexed message
+        self.index_offsets = []
+        self.index_positions = []
+        self.last_indexed = 0
+        # Indexes of older segments are only read from disk when the segment is first read
+        self.index_loaded = True
+        # Open for appending while the segment is the last one of its topic
+        self.log_file = None
+        self.index_file = None
+        # Read-only map of the file, remapped when reads go past its end
+        self.map = None
+
+    '''
+    Function that opens the segment for appending
+    '''
+    def open_for_append(self):
+        self.log_file = open(self.path + '.log', 'ab', buffering=segment_buffer_bytes)
+        self.index_file = open(self.path + '.index', 'ab', buffering=segment_buffer_bytes)
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.index_file.close()
+            self.log_file = self.index_file = None
+        self.map = None
+
+    '''
+    Function that returns a map of the file covering at least its first size bytes
+    '''
+    def mapped(self, size):
+        if self.map is None or len(self.map) < size:
+            if self.log_file is not None:
+                self.log_file.flush()
+            with open(self.path + '.log', 'rb') as log_file:
+                self.map = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    '''
+    Function that reads the sparse index of the segment from its file
+    Entries pointing at or past the end of the segment are dropped, their records never reached the disk
+    '''
+    def load_index(self):
+        index_size = os.path.getsize(self.path + '.index')
+        with open(self.path + '.index', 'rb') as index_file:
+            entries = index_file.read(index_size - index_size % INDEX_ENTRY.size)
+        for entry_offset, entry_position in INDEX_ENTRY.iter_unpack(entries):
+            if entry_position >= self.size:
+                break
+            self.index_offsets.append(entry_offset)
+            self.index_positions.append(entry_position)
+        self.index_loaded = True
+
+    '''
+    Function that returns the file position of a message, starting from the closest index entry before it
+    '''
+    def position(self, offset):
+        if not self.index_loaded:
+            self.load_index()
+        entry = bisect.bisect_right(self.index_offsets, offset) - 1
+        current, position = (self.index_offsets[entry], self.index_positions[entry]) if entry >= 0 else (self.base_offset, 0)
+        data = self.mapped(self.size)
+        while current < offset:
+            position += self.record.size + self.record_length(data, position)
+            current += 1
+        return position
+
+    '''
+    Function that returns the content length of the record at a file position
+    '''
+    def record_length(self, data, position):
+        return self.record.unpack_from(data, position)[-3]
+
+    '''
+    Function that unpacks the record header at a file position
+    Returns (offset, time, length, crc, codec), with time 0 for format 1 records
+    '''
+    def unpack_record(self, data, position):
+        if self.log_format == 1:
+            record_offset, length, crc, codec = self.record.unpack_from(data, position)
+            return record_offset, 0.0, length, crc, codec
+        return self.record.unpack_from(data, position)
+
+    '''
+    Function that returns messages from an offset to the end of the segment, as a list of (offset, codec, memoryview)
+    timed: Return (offset, codec, memoryview, time) instead
+    '''
+    def read(self, offset, timed=False):
+        data = memoryview(self.mapped(self.size))
+        position = self.position(offset)
+        messages = []
+        while position < self.size:
+            _, sent, length, _, codec = self.unpack_record(data, position)
+            position += self.record.size
+            if timed:
+                messages.append((offset, codec, data[position:position + length], sent))
+            else:
+                messages.append((offset, codec, data[position:position + length]))
+            position += length
+            offset += 1
+        return messages
+
+
+'''
+Function that returns the name of a topic's directory. Topics are hex encoded, so any topic string is a valid name
+'''
+def topic_dir_name(topic):
+    return topic.encode().hex()
+
+
+class SegmentLog:
+    '''
+    directory: Directory holding the log. Created if needed, and recovered if it already holds a log
+    segment_bytes: Size at which a topic's segment is closed and a new one started
+    index_interval_bytes: Bytes of records between two entries of the sparse index
+    sync_interval_ms: Longest time written messages wait before being fsynced
+    '''
+    def __init__(self, directory,
+                 segment_bytes = default_segment_bytes,
+                 index_interval_bytes = default_index_interval_bytes,
+                 sync_interval_ms = default_sync_interval_ms):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval_bytes = index_interval_bytes
+        self.sync_interval = sync_interval_ms / 1000
+
+        # topic -> {'dir', 'capacity', 'format', 'segments': list of Segment, oldest first}
+        self.topics = {}
+
+        # Segments written since the last fsync, and when the oldest of those writes happened
+        self.dirty = set()
+        self.sync_deadline = None
+
+        self.bytes = 0
+        self.messages = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            self.recover_topic(os.path.join(directory, name))
+
+    '''
+    Function that loads a topic from its directory, rebuilding the index of its last segment from the file tail
+    topic_dir: Directory of the topic
+    '''
+    def recover_topic(self, topic_dir):
+        meta_path = os.path.join(topic_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+
+        log_format = meta.get('format', 1)
+        bases = sorted(int(name[:-len('.log')]) for name in os.listdir(topic_dir) if name.endswith('.log'))
+        segments = [Segment(os.path.join(topic_dir, '%020d' % base), base, log_format) for base in bases]
+        for segment, next_segment in zip(segments, segments[1:]):
+            segment.next_offset = next_segment.base_offset
+            segment.size = os.path.getsize(segment.path + '.log')
+            segment.index_loaded = False
+        if segments:
+            self.recover_tail(segments[-1])
+            segments[-1].open_for_append()
+            self.messages += segments[-1].next_offset - segments[0].base_offset
+
+        self.topics[meta['topic']] = {'dir': topic_dir, 'capacity': meta['capacity'], 'format': log_format,
+                                      'segments': segments}
+        for segment in segments:
+            self.bytes += segment.size
+
+    '''
+    Function that finds the end of the last segment of a topic. Scanning starts at the last index entry
+    and stops at the first incomplete or corrupt record, where the segment and its index are truncated
+    '''
+    def recover_tail(self, segment):
+        size = segment.size = os.path.getsize(segment.path + '.log')
+        offset, position = segment.base_offset, 0
+        if os.path.exists(segment.path + '.index'):
+            # Entries are written with the records they point to, but may have reached the disk first
+            segment.load_index()
+        if segment.index_offsets:
+            offset, position = segment.index_offsets[-1], segment.index_positions[-1]
+            segment.last_indexed = position
+
+        if size > 0:
+            with open(segment.path + '.log', 'rb') as log_file:
+                data = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+            with data:
+                record_size = segment.record.size
+                while position + record_size <= size:
+                    record_offset, _, length, crc, codec = segment.unpack_record(data, position)
+                    end = position + record_size + length
+                    if record_offset != offset or end > size or zlib.crc32(data[position + record_size:end]) != crc:
+                        break
+                    position = end
+                    offset += 1
+
+        segment.next_offset = offset
+        segment.size = position
+        if position < size:
+            os.truncate(segment.path + '.log', position)
+        with open(segment.path + '.index', 'ab') as index_file:
+            index_file.truncate(len(segment.index_offsets) * INDEX_ENTRY.size)
+
+    '''
+    Function that sets how many messages are kept for a topic
+    The log keeps a topic's history when its publishers leave, so a capacity of 0 is ignored
+    topic: Topic string
+    capacity: Number of messages to keep
+    '''
+    def set_capacity(self, topic, capacity):
+        entry = self.topics.get(topic)
+        if capacity <= 0 or (entry is not None and entry['capacity'] == capacity):
+            return
+        if entry is None:
+            # The first segment is created by the first append, named after its sequence number
+            topic_dir = os.path.join(self.directory, topic_dir_name(topic))
+            os.makedirs(topic_dir, exist_ok=True)
+            entry = self.topics[topic] = {'dir': topic_dir, 'capacity': capacity, 'format': RECORD_FORMAT, 'segments': []}
+        entry['capacity'] = capacity
+
+        # Written to a new file and renamed, so a crash never leaves a partial meta file
+        meta_path = os.path.join(entry['dir'], 'meta.json')
+        with open(meta_path + '.tmp', 'w') as meta_file:
+            json.dump({'topic': topic, 'capacity': capacity, 'format': entry['format']}, meta_file)
+        os.replace(meta_path + '.tmp', meta_path)
+        self.trim(entry)
+
+    '''
+    Function that returns how many messages are kept for a topic (0 if none)
+    '''
+    def capacity(self, topic):
+        entry = self.topics.get(topic)
+        return 0 if entry is None else entry['capacity']
+
+    '''
+    Function that returns the sequence number of the newest message kept for every topic
+    '''
+    def last_seqs(self):
+        return {topic: entry['segments'][-1].next_offset - 1 for topic, entry in self.topics.items() if entry['segments']}
+
+    '''
+    Function that appends forwarded messages to the log of their topic
+    Does nothing for topics that keep no history
+    topic: Topic string
+    codec: Content codec of the messages
+    contents: List of contents (zmq.Frame), oldest first
+    first_seq: Sequence number of the first message
+    now: Time the messages were forwarded at, in seconds
+    '''
+    def append(self, topic, codec, contents, first_seq, now):
+        entry = self.topics.get(topic)
+        if entry is None:
+            return
+        segments = entry['segments']
+        # Offsets in a topic's log have no gaps. Should messages be missing, the log starts over
+        if not segments or segments[-1].next_offset != first_seq:
+            self.delete_segments(entry, len(segments))
+            segment = Segment(os.path.join(entry['dir'], '%020d' % first_seq), first_seq, entry['format'])
+            segment.open_for_append()
+            segments.append(segment)
+        segment = segments[-1]
+        record = segment.record
+        for content in contents:
+            if segment.size >= self.segment_bytes:
+                segment = self.roll(entry)
+            if not isinstance(content, (bytes, bytearray, memoryview)):
+                content = content.buffer
+            if segment.size - segment.last_indexed >= self.index_interval_bytes:
+                segment.index_file.write(INDEX_ENTRY.pack(segment.next_offset, segment.size))
+                segment.index_offsets.append(segment.next_offset)
+                segment.index_positions.append(segment.size)
+                segment.last_indexed = segment.size
+            if segment.log_format == 1:
+                header = record.pack(segment.next_offset, len(content), zlib.crc32(content), codec)
+            else:
+                header = record.pack(segment.next_offset, now, len(content), zlib.crc32(content), codec)
+            segment.log_file.write(header)
+            segment.log_file.write(content)
+            segment.next_offset += 1
+            segment.size += record.size + len(content)
+            self.bytes += record.size + len(content)
+            self.messages += 1
+
+        self.dirty.add(segment)
+        if self.sync_deadline is None:
+            self.sync_deadline = time.time() + self.sync_interval
+        self.trim(entry)
+
+    '''
+    Function that closes the last segment of a topic and starts a new one
+    Returns the new segment
+    '''
+    def roll(self, entry):
+        segment = entry['segments'][-1]
+        self.sync_segment(segment)
+        self.dirty.discard(segment)
+        segment.close()
+        new_segment = Segment(os.path.join(entry['dir'], '%020d' % segment.next_offset), segment.next_offset,
+                              entry['format'])
+        new_segment.open_for_append()
+        entry['segments'].append(new_segment)
+        return new_segment
+
+    '''
+    Function that deletes the oldest segments of a topic once all of their messages are older than its retention
+    '''
+    def trim(self, entry):
+        segments = entry['segments']
+        if not segments:
+            return
+        first_kept = segments[-1].next_offset - entry['capacity']
+        count = 0
+        while count + 1 < len(segments) and segments[count + 1].base_offset <= first_kept:
+            count += 1
+        self.delete_segments(entry, count)
+
+    '''
+    Function that deletes the oldest segments of a topic
+    count: Number of segments to delete
+    '''
+    def delete_segments(self, entry, count):
+        for segment in entry['segments'][:count]:
+            self.dirty.discard(segment)
+            segment.close()
+            os.remove(segment.path + '.log')
+            os.remove(segment.path + '.index')
+            self.bytes -= segment.size
+            self.messages -= segment.next_offset - segment.base_offset
+            self.evictions += segment.next_offset - segment.base_offset
+        del entry['segments'][:count]
+
+    '''
+    Function that returns the last count messages of a topic, oldest first, as a list of (seq, codec, memoryview)
+    '''
+    def get(self, topic, count):
+        entry = self.topics.get(topic)
+        if entry is None or not entry['segments'] or count <= 0:
+            return []
+        return self.get_from(topic, entry['segments'][-1].next_offset - min(count, entry['capacity']))
+
+    '''
+    Function that returns the last count messages of a topic, oldest first, as a list of (seq, codec, memoryview, time)
+    '''
+    def get_timed(self, topic, count):
+        entry = self.topics.get(topic)
+        if entry is None or not entry['segments'] or count <= 0:
+            return []
+        return self.get_from(topic, entry['segments'][-1].next_offset - min(count, entry['capacity']), timed=True)
+
+    '''
+    Function that returns the messages of a topic from a sequence number onwards, as a list of (seq, codec, memoryview)
+    Starts at the oldest message kept if from_seq is older
+    timed: Return (seq, codec, memoryview, time) instead
+    '''
+    def get_from(self, topic, from_seq, timed=False):
+        entry = self.topics.get(topic)
+        if entry is None or not entry['segments']:
+            return []
+        segments = entry['segments']
+        offset = max(from_seq, segments[0].base_offset)
+        first = bisect.bisect_right([segment.base_offset for segment in segments], offset) - 1
+        messages = []
+        for segment in segments[first:]:
+            if segment.next_offset > offset:
+                messages.extend(segment.read(max(offset, segment.base_offset), timed))
+        return messages
+
+    def sync_segment(self, segment):
+        segment.log_file.flush()
+        segment.index_file.flush()
+        os.fsync(segment.log_file.fileno())
+        os.fsync(segment.index_file.fileno())
+
+    '''
+    Function that fsyncs the messages written since the last sync once they have waited sync_interval_ms
+    Returns the time at which it must be called again, or None if nothing is waiting
+    now: Current time in seconds
+    '''
+    def sync(self, now):
+        if self.sync_deadline is not None and now >= self.sync_deadline:
+            for segment in self.dirty:
+                self.sync_segment(segment)
+            self.dirty.clear()
+            self.sync_deadline = None
+        return self.sync_deadline
+
+    '''
+    Function that writes everything to disk and closes the log
+    '''
+    def close(self):
+        for segment in self.dirty:
+            self.sync_segment(segment)
+        self.dirty.clear()
+        self.sync_deadline = None
+        for entry in self.topics.values():
+            for segment in entry['segments']:
+                segment.close()
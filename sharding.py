@@ -0,0 +1,83 @@
+'''
+Sharded broker mode for middleware.py
+
+ShardedBroker starts one Broker process per shard. Every topic lives on exactly one
+shard, chosen with consistent hashing (see hash_ring.py). Clients given the list of
+shard addresses route pub_reg, sub_reg and publications for a topic straight to its
+shard, register and answer heartbeats on every shard, and receive publications from
+all shards' PUB sockets.
+Each shard expires clients on its own, and announces every client it evicts to the other
+shards on its PUB socket, so the client is evicted from all of them.
+'''
+
+import os
+import multiprocessing
+
+from middleware import Broker
+
+
+'''
+Function that returns the addresses of every shard
+Returns two lists: the request (ROUTER) addresses and the PUB addresses, indexed by shard
+num_shards: Number of shards
+host: Host to bind to ('*') or connect to
+base_port: Shard i uses ports base_port + 2i (requests) and base_port + 2i + 1 (publications)
+'''
+def shard_addresses(num_shards, host='*', base_port=7777):
+    rep_addrs = ['tcp://%s:%d' % (host, base_port + 2 * shard) for shard in range(num_shards)]
+    pub_addrs = ['tcp://%s:%d' % (host, base_port + 2 * shard + 1) for shard in range(num_shards)]
+    return rep_addrs, pub_addrs
+
+
+'''
+Function that runs one shard. Target of each shard process
+'''
+def run_shard(shard_id, pub_addr, rep_addr, history_dir=None, metrics_addr=None, metrics_interval_ms=0, peer_addrs=None):
+    broker = Broker(pub_addr=pub_addr, rep_addr=rep_addr, shard_id=shard_id, history_dir=history_dir,
+                    metrics_addr=metrics_addr, metrics_interval_ms=metrics_interval_ms, peer_addrs=peer_addrs)
+    broker.run()
+
+
+class ShardedBroker:
+    '''
+    num_shards: Number of broker processes to start
+    pub_addrs, rep_addrs: Addresses of each shard (default from shard_addresses())
+    history_dir: Directory for durable history, if any. Each shard keeps its log in its own subdirectory
+    metrics_addrs: Address of each shard's metrics socket, if any
+    metrics_interval_ms: How often each shard logs its metrics (0 to never log them)
+    '''
+    def __init__(self, num_shards, pub_addrs=None, rep_addrs=None, history_dir=None,
+                 metrics_addrs=None, metrics_interval_ms=0):
+        if pub_addrs is None or rep_addrs is None:
+            rep_addrs, pub_addrs = shard_addresses(num_shards)
+        self.pub_addrs = pub_addrs
+        self.rep_addrs = rep_addrs
+        shard_dirs = [None if history_dir is None else os.path.join(history_dir, 'shard-%d' % shard)
+                      for shard in range(num_shards)]
+        if metrics_addrs is None:
+            metrics_addrs = [None] * num_shards
+        # The shards run on this host, and connect to each other's PUB sockets to share client evictions
+        local_pub_addrs = [addr.replace('*', '127.0.0.1') for addr in pub_addrs]
+        self.processes = [multiprocessing.Process(target=run_shard,
+                                                  args=(shard, pub_addrs[shard], rep_addrs[shard], shard_dirs[shard],
+                                                        metrics_addrs[shard], metrics_interval_ms,
+                                                        local_pub_addrs[:shard] + local_pub_addrs[shard + 1:]))
+                          for shard in range(num_shards)]
+
+    '''
+    Function that starts every shard process
+    '''
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    '''
+    Function that blocks until every shard has shut down (Client.shutdown_broker() stops all of them)
+    '''
+    def run(self):
+        self.start()
+        self.join()
+
+    def join(self):
+        for process in self.processes:
+            process.join()
@@ -30,6 +30,7 @@ from middleware import Client, Broker
 import sys
 import json
 import time
+import logging
 
 if len(sys.argv) != 3:
     print("ERROR: test.py wasn\'t given exactly 2 arguments (IP addr, script file)")
@@ -45,8 +46,12 @@ sys.stderr.flush()
 
 testScript = json.load(open(testScriptFile))
 
+# Middleware events go to the node's log. The broker also logs its metrics every 5 seconds
+logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+
 if testScript['middlewareType'] == 'broker':
-    broker = Broker(pub_addr = 'tcp://'+myIP+':7778',rep_addr = 'tcp://'+myIP+':7777')
+    broker = Broker(pub_addr = 'tcp://'+myIP+':7778',rep_addr = 'tcp://'+myIP+':7777',
+                    metrics_addr = 'tcp://'+myIP+':9777', metrics_interval_ms = 5000)
     print("Starting Broker...")
     broker.run()
 
@@ -94,17 +99,17 @@ elif testScript['middlewareType'] == 'client':
             print("Notify received: ",results)
 
         # pause, in seconds
+        # The client's I/O thread keeps responding to heartbeats while the script sleeps
         elif command[0] == 'w':
             if len(command) == 2:
-                # Have client sleep by waiting for message of topic "" with timeout
-                # This allows client to continue responding to heartbeats
-                sleep_ms = int(command[1]*1000) #Convert to milliseconds
-                client.notify("", 0, timeout_ms=sleep_ms)
+                time.sleep(command[1])
 
         # send shutdown broker command
         elif command[0] == 'sb':
             results = client.shutdown_broker()
 
+    client.close()
+
 sys.stdout.flush()
 sys.stderr.flush()
 sys.exit(0)
@@ -0,0 +1,89 @@
+'''
+Checks that a standby broker synced while a topic is being published keeps the primary's owner of the topic.
+A publisher p1 owns the topic when the standby syncs. p2, of equal strength so it must not take the topic
+while p1 publishes, sends the first sample after the sync. The primary is then killed with SIGKILL, and
+p1 and p2 publish again on the promoted standby. The subscriber must receive every message of p1 and
+none of p2.
+
+Runs on a single machine without Mininet: python3 tests/test_standby_ownership.py (or with pytest)
+'''
+
+import os
+import sys
+import time
+import signal
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from middleware import Broker, Client, heartbeat_interval_ms
+
+primary_addrs = {'rep_addr': "tcp://127.0.0.1:7877", 'pub_addr': "tcp://127.0.0.1:7878",
+                 'replica_addr': "tcp://127.0.0.1:7879"}
+standby_addrs = {'rep_addr': "tcp://127.0.0.1:7887", 'pub_addr': "tcp://127.0.0.1:7888",
+                 'replica_addr': "tcp://127.0.0.1:7889"}
+client_addrs = {'req_addr': primary_addrs['rep_addr'], 'sub_addr': primary_addrs['pub_addr'],
+                'standby_req_addr': standby_addrs['rep_addr'], 'standby_sub_addr': standby_addrs['pub_addr']}
+
+# Long enough that p1 keeps the topic across the failover
+ownership_deadline_ms = 10 * heartbeat_interval_ms
+
+
+def run_primary():
+    Broker(ownership_deadline_ms=ownership_deadline_ms, **primary_addrs).run()
+
+
+def run_standby():
+    Broker(primary_addr=primary_addrs['replica_addr'], ownership_deadline_ms=ownership_deadline_ms,
+           **standby_addrs).run()
+
+
+def test_standby_ownership():
+    primary = multiprocessing.Process(target=run_primary)
+    primary.start()
+    time.sleep(0.5)
+    p1 = Client(ip='owner-p1', **client_addrs)
+    p2 = Client(ip='owner-p2', **client_addrs)
+    subscriber = Client(ip='owner-sub', **client_addrs)
+    standby = None
+    try:
+        subscriber.register_sub('owned')
+        p1.register_pub('owned', 1, 0)
+        p2.register_pub('owned', 1, 0)
+        for i in range(5):
+            p1.publish('owned', 'p1-%d' % i)
+
+        # The standby syncs while p1 owns the topic, and p2 sends the first sample after the sync
+        standby = multiprocessing.Process(target=run_standby)
+        standby.start()
+        time.sleep(2 * heartbeat_interval_ms / 1000)
+        p2.publish('owned', 'p2-0')
+        for i in range(5, 11):
+            p1.publish('owned', 'p1-%d' % i)
+
+        os.kill(primary.pid, signal.SIGKILL)
+        # p1 publishes first on the promoted standby, then p2
+        p1.publish('owned', 'p1-11')
+        p2.publish('owned', 'p2-1')
+        p1.publish('owned', 'p1-12')
+
+        received = []
+        while True:
+            msg = subscriber.notify('owned', timeout_ms=2 * heartbeat_interval_ms)
+            if msg is None:
+                break
+            received.append(msg)
+        assert received == ['p1-%d' % i for i in range(13)], received
+        subscriber.shutdown_broker()
+        standby.join(5)
+    finally:
+        for client in (p1, p2, subscriber):
+            client.close()
+        for process in (primary, standby):
+            if process is not None and process.is_alive():
+                process.kill()
+
+
+if __name__ == '__main__':
+    test_standby_ownership()
+    print('The promoted standby kept the owner of the topic')
@@ -0,0 +1,71 @@
+'''
+Hashed timer wheel used by the Broker to expire clients that stop sending traffic
+'''
+
+
+class TimerWheel:
+    '''
+    tick_ms: Resolution of the wheel
+    num_slots: Number of slots. Deadlines more than one revolution away are parked in the last
+               slot of the revolution and handed back early, to be rescheduled by the caller
+    now: Current time in seconds
+    '''
+    def __init__(self, tick_ms, num_slots, now):
+        self.tick = tick_ms / 1000
+        self.slots = [set() for _ in range(num_slots)]
+        self.current_tick = int(now / self.tick)
+
+        # Slot index of every scheduled key, so that rescheduling and cancelling are O(1)
+        self.key_slots = {}
+
+    '''
+    Function that schedules a key, replacing any earlier schedule for it
+    key: Hashable key
+    deadline: Time in seconds at which the key is due
+    '''
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        tick = int(deadline / self.tick)
+        tick = max(self.current_tick + 1, min(tick, self.current_tick + len(self.slots)))
+        slot = tick % len(self.slots)
+        self.slots[slot].add(key)
+        self.key_slots[key] = slot
+
+    '''
+    Function that removes a key from the wheel, if it is scheduled
+    key: Hashable key
+    '''
+    def cancel(self, key):
+        slot = self.key_slots.pop(key, None)
+        if slot is not None:
+            self.slots[slot].discard(key)
+
+    '''
+    Function that moves the wheel forward to the current time
+    Returns the keys of every slot that was passed. Keys are due at the latest at their slot's time,
+    so callers that refresh deadlines lazily must check each key and reschedule the ones still alive
+    now: Current time in seconds
+    '''
+    def advance(self, now):
+        due = []
+        target = int(now / self.tick)
+        # No point visiting a slot twice if the wheel fell more than one revolution behind
+        first = max(self.current_tick + 1, target - len(self.slots) + 1)
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                for key in slot:
+                    del self.key_slots[key]
+                due.extend(slot)
+                slot.clear()
+        self.current_tick = max(self.current_tick, target)
+        return due
+
+    '''
+    Function that returns the time in seconds of the next tick
+    '''
+    def next_tick_time(self):
+        return (self.current_tick + 1) * self.tick
+
+    def __len__(self):
+        return len(self.key_slots)
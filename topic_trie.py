@@ -0,0 +1,135 @@
+'''
+Wildcard topic matching used by the Broker in middleware.py
+
+Topics are hierarchical, with levels separated by '/'. A subscription pattern may use two wildcards,
+each standing for whole levels:
+    '+' matches exactly one level:           'sensors/+/temp' matches 'sensors/floor3/temp'
+    '#' matches any number of levels, as the last level of a pattern: 'sensors/#' matches
+        'sensors', 'sensors/floor3' and 'sensors/floor3/room1/temp'
+
+The broker compiles every wildcard subscription into a trie with one node per pattern level. A topic
+is matched by walking its levels down the trie, following the node for the level itself and the '+'
+node at every step, and collecting the '#' nodes passed on the way. The cost of a match grows with
+the depth of the topic (and the wildcards along its path), not with the number of subscriptions.
+'''
+
+level_separator = '/'
+single_level_wildcard = '+'
+multi_level_wildcard = '#'
+
+
+'''
+Function that tells whether a topic string is a wildcard pattern
+'''
+def is_pattern(topic):
+    return any(level in (single_level_wildcard, multi_level_wildcard) for level in topic.split(level_separator))
+
+
+'''
+Function that checks that a pattern is valid: wildcards take a whole level, and '#' only the last one
+Raises ValueError if it is not
+'''
+def check_pattern(pattern):
+    levels = pattern.split(level_separator)
+    for index, level in enumerate(levels):
+        if multi_level_wildcard in level and (level != multi_level_wildcard or index != len(levels) - 1):
+            raise ValueError("'#' must be the whole last level of a pattern: %r" % pattern)
+        if single_level_wildcard in level and level != single_level_wildcard:
+            raise ValueError("'+' must be a whole level of a pattern: %r" % pattern)
+
+
+'''
+Function that tells whether one topic matches one pattern, without a trie
+'''
+def topic_matches(pattern, topic):
+    pattern_levels = pattern.split(level_separator)
+    topic_levels = topic.split(level_separator)
+    for index, level in enumerate(pattern_levels):
+        if level == multi_level_wildcard:
+            return True
+        if index >= len(topic_levels) or (level != single_level_wildcard and level != topic_levels[index]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+class TrieNode:
+    __slots__ = ('children', 'pattern')
+
+    def __init__(self):
+        # Level string -> TrieNode
+        self.children = {}
+        # The pattern that ends at this node, if any
+        self.pattern = None
+
+
+class TopicTrie:
+    def __init__(self):
+        self.root = TrieNode()
+        self.size = 0
+
+    '''
+    Function that adds a pattern. Adding a pattern that is already there does nothing
+    '''
+    def add(self, pattern):
+        check_pattern(pattern)
+        node = self.root
+        for level in pattern.split(level_separator):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TrieNode()
+            node = child
+        if node.pattern is None:
+            node.pattern = pattern
+            self.size += 1
+
+    '''
+    Function that removes a pattern, and the nodes no other pattern needs
+    '''
+    def remove(self, pattern):
+        path = [self.root]
+        levels = pattern.split(level_separator)
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].pattern is None:
+            return
+        path[-1].pattern = None
+        self.size -= 1
+        for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+            if node.children or node.pattern is not None:
+                break
+            del parent.children[level]
+
+    '''
+    Function that returns the patterns a topic matches
+    '''
+    def match(self, topic):
+        matches = []
+        nodes = [self.root]
+        for level in topic.split(level_separator):
+            next_nodes = []
+            for node in nodes:
+                # '#' matches this level and everything below it
+                rest = node.children.get(multi_level_wildcard)
+                if rest is not None and rest.pattern is not None:
+                    matches.append(rest.pattern)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                child = node.children.get(single_level_wildcard)
+                if child is not None:
+                    next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                return matches
+
+        for node in nodes:
+            if node.pattern is not None:
+                matches.append(node.pattern)
+            # '#' also matches no levels at all: 'sensors/#' matches 'sensors'
+            rest = node.children.get(multi_level_wildcard)
+            if rest is not None and rest.pattern is not None:
+                matches.append(rest.pattern)
+        return matches